@@ -1,8 +1,14 @@
 import numpy as np
+import copy
 from operator import itemgetter, attrgetter
 from itertools import groupby
+from fractions import Fraction
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 
+import rfSoC_emulator as rfe
+import rfSoC_compiler as rfc
+
 import logging
 
 
@@ -16,10 +22,14 @@ class Pulse:
 	#initializing the array storing instances of the class Pulse
 	objs = []
 
-	def __init__(self, t_init, t_duration, channel, parent):
+	def __init__(self, t_init, t_duration, channel, parent, sequence=None):
 
-		#adding the new instance to the objs array
-		Pulse.objs.append(self)
+		#adding the new instance to its sequence, or else to the objs array
+		if sequence is None and len(Sequence._active)>0:
+			sequence=Sequence._active[-1]
+		self._sequence=None
+		if sequence is None:
+			Pulse.objs.append(self)
 		#initializing the object attribute
 		#initial time with respect to the parent pulse end #### ME: I think it actually defines the time with respect to the parent pulse beginning 
 		self.t_init = t_init
@@ -31,6 +41,17 @@ class Pulse:
 		#type : None if no parent (root event)
 		self.parent = parent
 
+		if sequence is not None:
+			sequence.add(self)
+
+
+	def __setattr__(self, name, value):
+
+		object.__setattr__(self, name, value)
+		#changing a pulse invalidates what its sequence computed
+		if not name.startswith('_') and self.__dict__.get('_sequence') is not None:
+			self._sequence.modified()
+
 
 
 
@@ -41,7 +62,437 @@ class Pulse:
 		Pulse with respect to the beginning of the sequence (take adventage of
 		the parent attribure).
 		'''
-		for obj in cls.objs:
+		Sequence(cls.objs,own=False).absolute_init_time()
+
+
+	@classmethod
+	def sort_and_groupby_timewise(cls):
+		'''
+		Method to sort ADC and DAC events timewise and grouping simultaneous
+		events.
+		'''
+		return Sequence(cls.objs,own=False).sort_and_groupby_timewise()
+
+
+	@classmethod
+	def generate_sequence_and_DAC_memory(cls,nb_loop,acq_mode,mix_freq,link_throughput=None,FIFO_size=None):
+		'''
+		Method to generate the SCPI command for filling the DAC memory and
+		the sequence memory based on the instances of the Pulse class, see
+		Sequence.generate_sequence_and_DAC_memory.
+		'''
+		sequence=Sequence(cls.objs,own=False)
+		scpi_str=sequence.generate_sequence_and_DAC_memory(nb_loop,acq_mode,mix_freq,link_throughput,FIFO_size)
+		cls.DAC_memory=sequence.DAC_memory
+
+		return scpi_str
+
+
+class PulseGeneration(Pulse):
+	'''
+	Child class of the Pulse class for DAC events
+	'''
+	objs=[]
+
+	def __init__(self, t_init, t_duration, channel, wform, params, CW_mode=False, DC_offset=0, parent=None, sequence=None):
+
+		super().__init__(t_init, t_duration, channel, parent, sequence)
+		if self._sequence is None:
+			PulseGeneration.objs.append(self)
+		self.wform = wform
+		self.params = params
+		self.CW_mode = CW_mode
+		self.DC_offset = DC_offset
+
+	#the waveform parameters are kept as a tuple: they are changed by
+	#assigning new ones, which invalidates the sequence, never in place
+	@property
+	def params(self):
+
+		return self._params
+
+	@params.setter
+	def params(self, params):
+
+		self._params = tuple(params)
+
+	#overwritting the __repr__ native method for nice display of the object
+	def __repr__(self):
+
+		return('Pulse(DAC {}, t_abs={} s,  t_init={} s, t_duration={} s, waveform : {}, params={}, CW_mode={}'.format(
+				self.channel, self._t_abs, self.t_init, self.t_duration, self.wform, self.params, self.CW_mode))
+
+
+	def CW_period_rows(self):
+		'''
+		Smallest number of DAC memory rows (8 points of 500 ps) holding a
+		whole number of periods of every frequency of the waveform.
+		'''
+
+		if self.wform=='SIN':
+			freqs=[self.params[0]]
+		elif self.wform=='SIN+SIN':
+			freqs=[self.params[0],self.params[3]]
+		else:
+			raise ValueError('Wrong waveform')
+
+		rows=1
+		for freq in freqs:
+			#periods per row as a fraction, its denominator is the number of rows
+			rows=np.lcm(rows,Fraction(freq*4.e-9).limit_denominator(16384).denominator)
+
+		return int(rows)
+
+
+	def fill_2D_memory(self,trigger=None):
+		'''
+		Generate a 2D memory for the DAC, see fill_2D_memories.
+		'''
+
+		return PulseGeneration.fill_2D_memories([self],[trigger])[0]
+
+
+	@staticmethod
+	def fill_2D_memories(pulses,triggers=None):
+		'''
+		Generate the 2D memories (flat rows of 8 points, 2 triggers and the
+		repetition) of several DAC pulses. The pulses of the same waveform
+		and length are computed together, directly in the integer memory
+		layout, and the tables are memoized on the waveform parameters.
+
+		The triggers of one pulse are couples (TRIG1, TRIG2 or BOTH, time at
+		which the trigger is set); repeated rows of pulses without triggers
+		are played with the repetition field.
+		'''
+
+		if triggers is None:
+			triggers=[None]*len(pulses)
+
+		tables=[None]*len(pulses)
+		to_compute={}
+
+		for k, (pulse, trigger) in enumerate(zip(pulses,triggers)):
+
+			pulse._check_waveform()
+
+			trigger=None if trigger is None else tuple((trig_name,trig_time) for trig_name, trig_time in trigger)
+			key=(pulse.wform,tuple(pulse.params),pulse.t_duration,pulse.DC_offset,pulse.CW_mode,trigger)
+
+			if key in _DAC_tables:
+				_DAC_tables.move_to_end(key)
+				tables[k]=_DAC_tables[key]
+			else:
+				N_point, fold = pulse._memory_points()
+				to_compute.setdefault((pulse.wform,N_point,fold),{}).setdefault(key,[]).append(k)
+
+		for (wform, N_point, fold), keys in to_compute.items():
+
+			params=np.array([key[1] for key in keys],dtype=float)
+			durations=np.array([key[2] for key in keys])
+			DC_offsets=np.array([key[3] for key in keys])
+
+			#time base of the oscillations: one period of 2 pi over the pulse
+			#duration, or exact 500 ps steps for folded CW waveforms
+			if fold:
+				t = np.arange(N_point)*2*np.pi/N_point
+				durations = np.full(len(keys),N_point*0.5e-9)
+			else:
+				t = np.linspace(0, 2 * np.pi,N_point)
+
+			offset, oscillation = DAC_WAVEFORMS[wform](params,DC_offsets,durations,t)
+
+			# adding zeros at the end so that N_point_tot is dividable by 8
+			# because the table is to be divided in chunks of 8 values
+			n_rows = -(-N_point//8)
+			memory = np.zeros((len(keys),n_rows,11),dtype=int)
+			samples = np.zeros((len(keys),8*n_rows))
+			samples[:,:N_point] = oscillation
+			memory[:,:,:8] = (offset[:,None] + samples).reshape(len(keys),n_rows,8)
+
+			for memory_table, (key, indices) in zip(memory,keys.items()):
+
+				trigger=key[5]
+				if trigger is None:
+					#repeated rows are played with the repetition field
+					table=rfc.compress_rows(memory_table.reshape(-1))
+
+				else:
+					trig_names=np.array([trig_name for trig_name, trig_time in trigger])
+					trig_rows=np.array([int(round(trig_time/(0.5e-9 * 8))) for trig_name, trig_time in trigger])
+
+					if not np.all(np.isin(trig_names,['TRIG1','TRIG2','BOTH'])):
+						raise ValueError('Wrong trigger value')
+
+					memory_table[trig_rows[np.isin(trig_names,['TRIG1','BOTH'])],-1]=1
+					memory_table[trig_rows[np.isin(trig_names,['TRIG2','BOTH'])],-2]=1
+					table=memory_table.reshape(-1)
+
+				table.setflags(write=False)
+				_DAC_tables[key]=table
+				while len(_DAC_tables)>DAC_TABLES_CACHE_SIZE:
+					_DAC_tables.popitem(last=False)
+
+				for k in indices:
+					tables[k]=table
+
+		return tables
+
+
+	def _check_waveform(self):
+		'''
+		Check the parameters of the waveform before filling the memory.
+
+		TODO : add ramp, square, etc...
+		'''
+
+		#check waveform
+		if self.wform=='SIN':
+
+			freq, amplitude, phase = self.params ### ME (phase must be given in degrees)
+			#size of the memory is 65536 and the time step of the DACS is 500 ps
+
+			# if freq > 1./0.5e-9 or amplitude > 2 or self.t_duration > 64.e-6:
+			print(self.channel, ' - DAC duration SIN: ', (self.t_duration)*1e6, ' us; DELAY: ', (self.t_init)*1e6) # ME
+			if freq > 1./0.5e-9 or amplitude > 2 or self.t_duration+self.t_init > 64.e-6 or phase > 360 or phase < 0: ### ME
+				raise ValueError('One of the parameters is not correct, duration:', (self.t_duration+self.t_init)*1e6, ' us')
+
+			else :
+				if freq > 1./(4.*0.5e-9):
+				    raise ValueError('Warning : bellow 4 points per period, the signal might be unstable.')
+
+		elif self.wform=='SIN+SIN':
+
+			freq1, amp1, phase1, freq2, amp2, phase2 = self.params ### phases must be given in degrees
+
+			print(self.channel, ' - DAC duration SIN+SIN: ', (self.t_duration)*1e6, ' us; DELAY: ', (self.t_init)*1e6) # ME
+			if freq1 > 1./0.5e-9 or freq1 > 1./0.5e-9 or amp1 + amp2 > .926 or self.t_duration+self.t_init > 64.e-6:
+				raise ValueError('One of the parameters is not correct, duration:', (self.t_duration+self.t_init)*1e6, ' us')
+			elif  phase1 > 360 or phase1 < 0 or phase2 > 360 or phase2 < 0: ### ME
+				raise ValueError('One of the phase parameters is not correct') ### ME
+
+			else :
+				if freq1 > 1./(4.*0.5e-9) or freq2 > 1./(4.*0.5e-9):
+				    raise ValueError('Warning : bellow 4 points per period, the signal might be unstable.')
+
+		elif self.wform not in DAC_WAVEFORMS:
+
+			raise ValueError('Wrong waveform')
+
+
+	def _memory_points(self):
+		'''
+		Number of points of the table and whether it is a CW waveform folded
+		to a whole number of periods.
+		'''
+
+		N_point = int(round(self.t_duration/0.5e-9))
+
+		#CW waveforms are folded to a whole number of periods
+		if self.CW_mode and 8*self.CW_period_rows() < N_point:
+			return 8*self.CW_period_rows(), True
+
+		return N_point, False
+
+
+	def send_DAC_2D_memory(self,adress=0,table=None):
+
+		"""
+		Send the waveform to the DAC memory
+
+		Input : beginning adress for the memory (for CW pulses, the rows
+		reserved at the end of the memory, see generate_sequence_and_DAC_memory),
+		optional table already computed by fill_2D_memory
+
+		Output : SCPI command
+		"""
+		# convert the element of table_bit to int and then to string for sending
+		# then forming a whole string with values separated by commas by using
+		# the join method
+
+		if table is None:
+			table=self.fill_2D_memory()
+		table_bit=(table.astype(int)).astype(str)
+		separator = ','
+		table_bit = separator.join(table_bit)
+
+		#managing the beginning adress of the memory depending on the mode
+		#(CW or pulse)
+		if self.channel in ['CH1','CH2','CH3','CH4','CH5','CH6','CH7','CH8']:
+
+			#fill the end of the memory for the CW mode
+			if self.CW_mode == False:
+				return 'DAC:DATA:'+self.channel+' '+str(adress)+','+table_bit+','+'0,0,0,0,0,0,0,0,0,0,16383'
+
+			else:
+				return 'DAC:DATA:'+self.channel+' '+str(adress)+','+table_bit
+
+		else:
+			raise ValueError('Wrong channel value')
+
+
+
+# DAC values are coded on signed 14 bits = +/- 8192 for 0.926 V
+DAC_SCALE = 8192/0.926
+
+def _sin_waveform(params,DC_offsets,durations,t):
+	'''
+	SIN waveform: params are (frequency, amplitude, phase in degrees).
+	'''
+	freq, amplitude, phase = params.T
+
+	DAC_amplitude = amplitude * 8192/0.926
+	phase_rad = phase*2*np.pi/360 ### ME
+	n_oscillation = freq*durations
+
+	return DC_offsets*8192/0.926, DAC_amplitude[:,None]*np.sin(n_oscillation[:,None]*t + phase_rad[:,None])
+
+
+def _sin_sin_waveform(params,DC_offsets,durations,t):
+	'''
+	SIN+SIN waveform: params are (frequency, amplitude, phase in degrees)
+	of both tones, without DC offset.
+	'''
+	freq1, amp1, phase1, freq2, amp2, phase2 = params.T
+
+	table1 = (amp1 * 8192/0.926)[:,None]*np.sin((freq1*durations)[:,None]*t + (phase1*2*np.pi/360)[:,None])
+	table2 = (amp2 * 8192/0.926)[:,None]*np.sin((freq2*durations)[:,None]*t + (phase2*2*np.pi/360)[:,None])
+
+	return np.zeros(len(params)), table1 + table2
+
+
+# waveform functions of the DAC pulses: (params, DC_offsets, durations,
+# time base) -> offsets, oscillating parts, one row per pulse
+DAC_WAVEFORMS = {'SIN': _sin_waveform, 'SIN+SIN': _sin_sin_waveform}
+
+# memoized DAC tables, see PulseGeneration.fill_2D_memories
+DAC_TABLES_CACHE_SIZE = 256
+_DAC_tables = OrderedDict()
+
+
+
+class PulseReadout(Pulse):
+	'''
+	Child class of the Pulse class for ADC events
+	'''
+	objs=[]
+
+	def __init__(self,t_init, t_duration, channel, parent=None, sequence=None):
+
+		super().__init__(t_init, t_duration, channel, parent, sequence)
+		if self._sequence is None:
+			PulseReadout.objs.append(self)
+
+	def __repr__(self):
+
+		return('Pulse(ADC {}, t_abs={} s,  t_init={} s, t_duration={} s'.format(
+				self.channel, self._t_abs, self.t_init, self.t_duration))
+
+
+
+class Sequence:
+	'''
+	Set of DAC and ADC pulses played together.
+
+	Unlike the class registries (Pulse.objs, PulseGeneration.objs and
+	PulseReadout.objs), which keep every pulse ever created, a sequence
+	only holds its own pulses. Their absolute times, time ordering and the
+	generated SCPI commands are kept until one of them is modified.
+
+	Pulses join a sequence with sequence=seq, or when created inside a
+	"with seq:" block, and are then not added to the class registries.
+	'''
+
+	#sequences of the nested "with" blocks
+	_active=[]
+
+	def __init__(self,pulses=(),own=True):
+
+		self.pulses=[]
+		self.own=own
+		self.DAC_memory=None
+		self._cache={}
+
+		for pulse in pulses:
+			self.add(pulse)
+
+	def __enter__(self):
+
+		Sequence._active.append(self)
+		return self
+
+	def __exit__(self,*args):
+
+		Sequence._active.remove(self)
+
+	def __len__(self):
+
+		return len(self.pulses)
+
+	def __iter__(self):
+
+		return iter(self.pulses)
+
+	def add(self,pulse):
+
+		if self.own:
+			pulse._sequence=self
+		self.pulses.append(pulse)
+		self.modified()
+
+	def remove(self,pulse):
+
+		self.pulses.remove(pulse)
+		pulse._sequence=None
+		self.modified()
+
+	def modified(self):
+		'''
+		Drop the cached times, ordering and SCPI commands (called when a
+		pulse of the sequence changes).
+		'''
+		self._cache.clear()
+
+	@property
+	def DAC_pulses(self):
+
+		return [p for p in self.pulses if type(p)==PulseGeneration]
+
+	@property
+	def ADC_pulses(self):
+
+		return [p for p in self.pulses if type(p)==PulseReadout]
+
+	def clone(self,changes=None):
+		'''
+		Copy of the sequence with copies of its pulses (parents pointing to
+		the copies, waveform parameters shared as they are immutable).
+		changes is an optional {pulse: {attribute: value}} dict applied to
+		the copies of the given pulses of this sequence.
+		'''
+		copies={p: copy.copy(p) for p in self.pulses}
+
+		sequence=Sequence()
+		for pulse in copies.values():
+
+			pulse._sequence=None
+			pulse._DAC_2D_memory=None
+			if pulse.parent in copies:
+				pulse.parent=copies[pulse.parent]
+			sequence.add(pulse)
+
+		for pulse, attributes in (changes or {}).items():
+			for name, value in attributes.items():
+				setattr(copies[pulse],name,value)
+
+		return sequence
+
+
+	def absolute_init_time(self):
+		'''
+		Store the initial time of each pulse with respect to the beginning of
+		the sequence (take adventage of the parent attribure).
+		'''
+		for obj in self.pulses:
 
 			#initialize absolute time and parent
 			t_abs=obj.t_init
@@ -66,37 +517,55 @@ class Pulse:
 			obj._t_abs=t_abs
 
 
-	@classmethod
-	def sort_and_groupby_timewise(cls):
+	def sort_and_groupby_timewise(self):
 		'''
 		Method to sort ADC and DAC events timewise and grouping simultaneous
-		events.
+		events, kept until a pulse is modified.
 		'''
-		cls.absolute_init_time()
+		if 'groups' in self._cache:
+			return self._cache['groups']
+
+		self.absolute_init_time()
 
 		#initializing the list containing groups of simultaneous events
 		groups=[]
 
 		#sort the Pulse instances timewise
-		new=sorted(cls.objs , key=attrgetter('_t_abs'))
+		new=sorted(self.pulses , key=attrgetter('_t_abs'))
 		#group by absolute initial time
 		for _ , g in groupby(new, key=attrgetter('_t_abs')):
 
 			groups.append(list(g))
 
+		self._cache['groups']=groups
+
 		return groups
 
 
-	@classmethod
-	def generate_sequence_and_DAC_memory(cls,nb_loop,acq_mode,mix_freq):
+	def generate_sequence_and_DAC_memory(self,nb_loop,acq_mode,mix_freq,link_throughput=None,FIFO_size=None):
 		'''
 		Method to generate the SCPI command for filling the DAC memory and
-		the sequence memory based on the instances of the Pulse class.
+		the sequence memory based on the pulses of the sequence. The DAC
+		memory commands are stored in the _DAC_2D_memory attribute of the
+		DAC pulses. Both are kept until a pulse is modified.
+
+		With the measured link_throughput (bytes/s) the final wait is the
+		shortest one sending the data of each repetition in time (see
+		rfSoC_emulator.plan_repetition) instead of the fixed 100 MB/s
+		estimate with safety factors.
 		
 		TODO : account for simultaneous events.
 		'''
 
-		sorted_seq=np.array(cls.sort_and_groupby_timewise())
+		key=('SEQ',nb_loop,acq_mode,mix_freq,link_throughput,FIFO_size)
+		if key in self._cache:
+			return self._cache[key]
+
+		#only one set of DAC memory commands is stored in the pulses
+		for k in [k for k in self._cache if k[0]=='SEQ']:
+			del self._cache[k]
+
+		sorted_seq=self.sort_and_groupby_timewise()
 		# print(sorted_seq)
 
 		Tseq=max([max([p[i]._t_abs + p[i].t_duration for i in range(len(p))]) for  p in sorted_seq])
@@ -111,6 +580,7 @@ class Pulse:
 		#the sequence
 		N_seq_loop=1
 		N_data_transfer=0
+		ADC_events=[]
 
 
 		if acq_mode=='SUM':
@@ -128,6 +598,20 @@ class Pulse:
 		#the momort adress
 		last_DAC_channel_event=[None,None,None,None,None,None,None,None]
 
+		#DAC memory of each channel, identical waveforms share their rows
+		#and every pulse is followed by an idle row
+		self.DAC_memory=rfc.DACMemoryAllocator(16384,block_gap=1)
+		n_DAC_pulses=[0,0,0,0,0,0,0,0]
+		CW_adresses={}
+		#DAC tables of all the pulses computed together
+		DAC_tables=dict(zip(self.DAC_pulses,PulseGeneration.fill_2D_memories(self.DAC_pulses)))
+		for p in self.pulses:
+			if type(p)==PulseGeneration:
+				n_DAC_pulses[int(p.channel[2])-1]+=1
+				if p.CW_mode:
+					#CW waveforms sit at the end of the memory
+					CW_adresses[p]=self.DAC_memory.reserve_end(int(p.channel[2]),len(DAC_tables[p])//11)
+
 		#TODO : get rid of the groupy method and directly loop through groupby
 		#(sorted listn key)
 
@@ -137,6 +621,7 @@ class Pulse:
 			N_wait = int(round(gp[0].t_init/(4.e-9)))
 			ctrl_dac_adc=0
 			N_adc_duration=0
+			gp_ADC_events=[]
 
 			if N_wait!=0.:
 				scpi_str=scpi_str+',1,{}'.format(N_wait-1)
@@ -152,23 +637,29 @@ class Pulse:
 		
 
 					#managing DAC memory adress
-					if last_DAC_channel_event[int(obj.channel[2])-1]==None:
-				
-						obj._DAC_2D_memory=obj.send_DAC_2D_memory()
-						print('adress=0')
+					if obj.CW_mode:
+
+						obj._DAC_2D_memory=obj.send_DAC_2D_memory(CW_adresses[obj],DAC_tables[obj])
+
+					else:
 
-					else :
-						#computing new start adress for the new wform of the DAC
-						new_adress= int(round(last_DAC_channel_event[int(obj.channel[2])-1].t_duration/(4.e-9))) + 1
+						table=DAC_tables[obj]
+						new_adress=self.DAC_memory.allocate(int(obj.channel[2]),table,'{} pulse at {} s'.format(obj.channel,obj._t_abs))
 						print('new_adress = {}'.format(new_adress))
 
-						#adding delay or not
-						scpi_str=scpi_str+',{},{}'.format(4096+int(obj.channel[2]),new_adress)
-						N_seq_loop+=1
-						
+						#the adress is set unless the only pulse of the channel
+						#is at the default adress 0
+						if last_DAC_channel_event[int(obj.channel[2])-1]!=None or new_adress!=0 or n_DAC_pulses[int(obj.channel[2])-1]>1:
+							scpi_str=scpi_str+',{},{}'.format(4096+int(obj.channel[2]),new_adress)
+							N_seq_loop+=1
+
 						#storing the filling DAC memory SCPI instruction as an
-						#attribute of the PulseGeneration object
-						obj._DAC_2D_memory=obj.send_DAC_2D_memory(new_adress)
+						#attribute of the PulseGeneration object, nothing to
+						#write if an identical waveform is already in memory
+						if self.DAC_memory.blocks[int(obj.channel[2])-1][-1][3]:
+							obj._DAC_2D_memory=None
+						else:
+							obj._DAC_2D_memory=obj.send_DAC_2D_memory(new_adress,table)
 
 					#updating last event of the DAC
 					last_DAC_channel_event[int(obj.channel[2])-1]=obj
@@ -203,9 +694,13 @@ class Pulse:
 
 
 					scpi_str=scpi_str+',{},{}'.format(4106+int(obj.channel[2]),N_acq)
+					gp_ADC_events.append((N_temp,int(obj.channel[2]),N_acq))
 					
 					N_seq_loop+= 1
 
+			for N_temp, ch, N_acq in gp_ADC_events:
+				ADC_events.append((N_seq_loop+1+N_temp,ch,N_acq))
+
 			if N_adc_duration!=0:
 
 				scpi_str=scpi_str+',4096,{},1,{}'.format(ctrl_dac_adc,N_adc_duration-1)
@@ -217,6 +712,20 @@ class Pulse:
 				N_seq_loop+= 1
 
 		
+		log.info('DAC memory use: ' + ', '.join('CH{} {}/{} rows ({} reused)'.format(ch,*usage) for ch, usage in self.DAC_memory.utilisation().items()))
+
+		if link_throughput is not None:
+
+			#the final wait completes the body to at least Tseq
+			N_mix=int(round(1./(4.e-9 * mix_freq))) if mix_freq!=0. else 1
+			plan=rfe.plan_repetition(N_seq_loop,ADC_events,acq_mode_val,period_sync=N_mix,
+									 link_throughput=link_throughput,FIFO_size=FIFO_size,
+									 min_cycles=Tseq/4.e-9)
+			log.info('Repetition period {} clock cycles, limited by {}'.format(plan['period_cycles'],plan['limited_by']))
+
+			self._cache[key]=scpi_str+',1,{},513,0,0,0'.format(plan['wait_arg'])
+			return self._cache[key]
+
 		N_add=0
 		N_seq_loop+=3 #end of loop and wait at the end for adjustment
 		# print('N_seq_loop={}'.format(N_seq_loop))
@@ -254,245 +763,45 @@ class Pulse:
 	
 
 		# print(scpi_str)
+		self._cache[key]=scpi_str
 		return scpi_str
 
 
-class PulseGeneration(Pulse):
-	'''
-	Child class of the Pulse class for DAC events
-	'''
-	objs=[]
-
-	def __init__(self, t_init, t_duration, channel, wform, params, CW_mode=False, DC_offset=0, parent=None):
-
-		super().__init__(t_init, t_duration, channel, parent)
-		PulseGeneration.objs.append(self)
-		self.wform = wform
-		self.params = params
-		self.CW_mode = CW_mode
-		self.DC_offset = DC_offset
-
-	#overwritting the __repr__ native method for nice display of the object
-	def __repr__(self):
-
-		return('Pulse(DAC {}, t_abs={} s,  t_init={} s, t_duration={} s, waveform : {}, params={}, CW_mode={}'.format(
-				self.channel, self._t_abs, self.t_init, self.t_duration, self.wform, self.params, self.CW_mode))
-
-
-	def fill_2D_memory(self,trigger=None):
+	def adc_events(self):
 		'''
-		Generate a 2D memory for the DAC.
-		First version with NO repetion of chunks of 8 values.
-
-		TODO : add ramp, square, etc...
+		Number of acquisition points of each ADC event per channel and
+		channel order of the events in one loop of the sequence, see
+		adc_events.
 		'''
+		if 'adc_events' not in self._cache:
+			self._cache['adc_events']=adc_events(self.sort_and_groupby_timewise())
 
-		#check waveform
-		if self.wform=='SIN':
-			###### TO DO add the phase ()
-			# freq, amplitude= self.params
-			freq, amplitude, phase = self.params ### ME (phase must be given in degrees)
-			#size of the memory is 65536 and the time step of the DACS is 500 ps
-
-			#control parameters of the wform
-			#TODO : move those control to the init of the PulseGeneration object
+		return self._cache['adc_events']
 
-			# if freq > 1./0.5e-9 or amplitude > 2 or self.t_duration > 64.e-6:
-			print(self.channel, ' - DAC duration SIN: ', (self.t_duration)*1e6, ' us; DELAY: ', (self.t_init)*1e6) # ME
-			if freq > 1./0.5e-9 or amplitude > 2 or self.t_duration+self.t_init > 64.e-6 or phase > 360 or phase < 0: ### ME
-				raise ValueError('One of the parameters is not correct, duration:', (self.t_duration+self.t_init)*1e6, ' us')
-
-			else :
-				if freq > 1./(4.*0.5e-9):
-				    raise ValueError('Warning : bellow 4 points per period, the signal might be unstable.')
 
-			# DAC values are coded on signed 14 bits = +/- 8192
-			DAC_amplitude = amplitude * 8192/0.926
-			phase_rad = phase*2*np.pi/360 ### ME
 
-			N_point = int(round(self.t_duration/0.5e-9))
-			n_oscillation = freq*self.t_duration
-			t = np.linspace(0, 2 * np.pi,N_point)
-
-			# table = (self.DC_offset* 8192/0.926) + DAC_amplitude*np.concatenate((np.sin(n_oscillation*t),np.zeros(N_point%8)))
-
-			table = (self.DC_offset* 8192/0.926) + DAC_amplitude*np.concatenate((np.sin(n_oscillation*t + phase_rad),np.zeros(N_point%8))) ### ME
-			# plt.plot(t, table)
-			# adding zeros at the end so that N_point_tot is dividable by 8
-			# because the table is to be divided in chunks of 8 values
-
-			#reshaping +andadding initialized values for trigger and repetition
-			#number
-
-			table=table.reshape(int(round(table.shape[0]/8.)),8)
-			memory_table=np.concatenate((table,np.zeros((table.shape[0],1)),np.zeros((table.shape[0],2))),axis=1)
-
-			# the triggers of one channel are stored in a tuple
-			# the tuple is composed of couples of string for the trigger val
-			# and float for the time at wich a trigger is set
-			# by default trigger is set to none and all trigger is set to 0
-
-			#TODO : made before coding the class. Maybe put the trigger as an
-			#       attribute of the PulseGeneration class.
-
-			#triggers not used or tested so far
-			if trigger is None:
-			    return memory_table.reshape((1,memory_table.shape[0]*memory_table.shape[1]))[0]
-
-			else :
-			    for trig in trigger :
-			        trig_name=trig[0]
-			        trig_time=trig[1]
-			        trig_row_index=int(round(trig_time/(0.5e-9 * 8)))
-
-			        if trig_name=='TRIG1':
-			            memory_table[trig_row_index,-1]=1.
-
-			        elif trig_name=='TRIG2':
-			            memory_table[trig_row_index,-2]=1.
-
-			        elif trig_name=='BOTH':
-			            memory_table[trig_row_index,-1]=1.
-			            memory_table[trig_row_index,-2]=1.
-
-			        else :
-			            raise ValueError('Wrong trigger value')
-
-			    return memory_table.reshape((1,memory_table.shape[0]*memory_table.shape[1]))[0]
-
-
-
-			#check waveform
-		if self.wform=='SIN+SIN':
-
-			freq1, amp1, phase1, freq2, amp2, phase2 = self.params ### phases must be given in degrees
-
-			#size of the memory is 65536 and the time step of the DACS is 500 ps
-
-			#control parameters of the wform
-			#TODO : move those control to the init of the PulseGeneration object
-			print(self.channel, ' - DAC duration SIN+SIN: ', (self.t_duration)*1e6, ' us; DELAY: ', (self.t_init)*1e6) # ME
-			if freq1 > 1./0.5e-9 or freq1 > 1./0.5e-9 or amp1 + amp2 > .926 or self.t_duration+self.t_init > 64.e-6:
-				raise ValueError('One of the parameters is not correct, duration:', (self.t_duration+self.t_init)*1e6, ' us')
-			elif  phase1 > 360 or phase1 < 0 or phase2 > 360 or phase2 < 0: ### ME
-				raise ValueError('One of the phase parameters is not correct') ### ME
-
-			else :
-				if freq1 > 1./(4.*0.5e-9) or freq2 > 1./(4.*0.5e-9):
-				    raise ValueError('Warning : bellow 4 points per period, the signal might be unstable.')
-
-			# DAC values are coded on signed 14 bits = +/- 8192
-			DAC_amp1 = amp1 * 8192/0.926
-			DAC_amp2 = amp2 * 8192/0.926
-			phase_rad1 = phase1*2*np.pi/360 ### ME
-			phase_rad2 = phase2*2*np.pi/360 ### ME
-
-			N_point = int(round(self.t_duration/0.5e-9))
-			n_oscillation1 = freq1*self.t_duration
-			n_oscillation2 = freq2*self.t_duration
-			t = np.linspace(0, 2 * np.pi,N_point)
-
-			table1=DAC_amp1*np.concatenate((np.sin(n_oscillation1*t + phase_rad1),np.zeros(N_point%8)))
-			table2=DAC_amp2*np.concatenate((np.sin(n_oscillation2*t + phase_rad2),np.zeros(N_point%8)))
-
-			table = table1 + table2
-			# print(table)
-			# adding zeros at the end so that N_point_tot is dividable by 8
-			# because the table is to be divided in chunks of 8 values
-
-			#reshaping +andadding initialized values for trigger and repetition
-			#number
-
-			table=table.reshape(int(round(table.shape[0]/8.)),8)
-			memory_table=np.concatenate((table,np.zeros((table.shape[0],1)),np.zeros((table.shape[0],2))),axis=1)
-
-			# the triggers of one channel are stored in a tuple
-			# the tuple is composed of couples of string for the trigger val
-			# and float for the time at wich a trigger is set
-			# by default trigger is set to none and all trigger is set to 0
-
-			#TODO : made before coding the class. Maybe put the trigger as an
-			#       attribute of the PulseGeneration class.
-
-			#triggers not used or tested so far
-			if trigger is None:
-			    return memory_table.reshape((1,memory_table.shape[0]*memory_table.shape[1]))[0]
-
-			else :
-			    for trig in trigger :
-			        trig_name=trig[0]
-			        trig_time=trig[1]
-			        trig_row_index=int(round(trig_time/(0.5e-9 * 8)))
-
-			        if trig_name=='TRIG1':
-			            memory_table[trig_row_index,-1]=1.
-
-			        elif trig_name=='TRIG2':
-			            memory_table[trig_row_index,-2]=1.
-
-			        elif trig_name=='BOTH':
-			            memory_table[trig_row_index,-1]=1.
-			            memory_table[trig_row_index,-2]=1.
-
-			        else :
-			            raise ValueError('Wrong trigger value')
-
-			    return memory_table.reshape((1,memory_table.shape[0]*memory_table.shape[1]))[0]
-
-
-
-
-	def send_DAC_2D_memory(self,adress=0):
-
-		"""
-		Send the waveform to the DAC memory
-
-		Input : beginning adress for the memory
-
-		Output : SCPI command
-		"""
-		# convert the element of table_bit to int and then to string for sending
-		# then forming a whole string with values separated by commas by using
-		# the join method
-
-		table=self.fill_2D_memory()
-		table_bit=(table.astype(int)).astype(str)
-		separator = ','
-		table_bit = separator.join(table_bit)
-
-		#managing the beginning adress of the memory depending on the mode
-		#(CW or pulse)
-		if self.channel in ['CH1','CH2','CH3','CH4','CH5','CH6','CH7','CH8']:
-
-			#fill the end of the memory for the CW mode
-			if self.CW_mode == False:
-				return 'DAC:DATA:'+self.channel+' '+str(adress)+','+table_bit+','+'0,0,0,0,0,0,0,0,0,0,16383'
-
-			else:
-				new_adress = int(round(16384 - self.t_duration/(4.e-9)))
-
-				return 'DAC:DATA:'+self.channel+' '+str(new_adress)+','+table_bit
-
-		else:
-			raise ValueError('Wrong channel value')
-
-
-
-class PulseReadout(Pulse):
+def adc_events(groups):
 	'''
-	Child class of the Pulse class for ADC events
+	Layout of the ADC events of groups of simultaneous pulses (see
+	Sequence.sort_and_groupby_timewise): the number of acquisition points
+	of each event for each channel and the list of the channels measured in
+	one loop of the sequence, in order.
 	'''
-	objs=[]
+	sorted_adcs=[p for gp in groups for p in gp if type(p) is PulseReadout]
 
-	def __init__(self,t_init, t_duration, channel, parent=None):
+	#store the nb of acq point for each unique event of each channel
+	length_vec=[[],[],[],[],[],[],[],[]]
 
-		super().__init__(t_init, t_duration, channel, parent)
-		PulseReadout.objs.append(self)
+	#ch vec list of the order of adc ch measured in one loop of the sequence
+	ch_vec=np.zeros(len(sorted_adcs),dtype=int)
 
-	def __repr__(self):
+	for i in range(len(sorted_adcs)):
 
-		return('Pulse(ADC {}, t_abs={} s,  t_init={} s, t_duration={} s'.format(
-				self.channel, self._t_abs, self.t_init, self.t_duration))
+		length_vec[int(sorted_adcs[i].channel[2])-1].append(int(round((sorted_adcs[i].t_duration)/0.5e-9)))
+
+		ch_vec[i]=int(sorted_adcs[i].channel[2])-1
+
+	return(length_vec,ch_vec)
 
 
 
@@ -13,6 +13,7 @@ from qcodes.instrument.channel import InstrumentChannel
 from qcodes.instrument.parameter import ParameterWithSetpoints, Parameter
 
 import SequenceGeneration_v2 as sqg
+import rfSoC_acquisition as rfa
 from qcodes.utils.delaykeyboardinterrupt import DelayedKeyboardInterrupt
 from qcodes.utils.validators import Numbers, Arrays
 
@@ -295,6 +296,16 @@ class RFSoC(VisaInstrument):
 
 		self.dummy_array_size_8 = 8
 
+		# measured output link throughput in bytes/s, None for the fixed
+		# transfer time estimate of the sequence generation
+		self.link_throughput = None
+
+		# sqg.Sequence to play, None for the pulses of the sqg class registries
+		self.sequence = None
+
+		# ADC event layout (length_vec, ch_vec) of the uploaded sequence
+		self.uploaded_adc_events = None
+
 		#Add the channels to the instrument
 		for adc_num in np.arange(1,9):
 			adc_name='ADC{}'.format(adc_num)
@@ -410,9 +421,21 @@ class RFSoC(VisaInstrument):
 	def write_sequence_and_DAC_memory(self):
 
 		self.log.info(__name__+ ' sending sequence'+'  \n')
-		self.write(sqg.Pulse.generate_sequence_and_DAC_memory(self.nb_measure.get()-1,self.acquisition_mode.get(),self.base_fmixer.get()))
+		if self.sequence is not None:
+			self.write(self.sequence.generate_sequence_and_DAC_memory(self.nb_measure.get()-1,self.acquisition_mode.get(),self.base_fmixer.get(),self.link_throughput))
+			DAC_pulses = self.sequence.DAC_pulses
+		else:
+			self.write(sqg.Pulse.generate_sequence_and_DAC_memory(self.nb_measure.get()-1,self.acquisition_mode.get(),self.base_fmixer.get(),self.link_throughput))
+			DAC_pulses = sqg.PulseGeneration.objs
 
-		for obj in sqg.PulseGeneration.objs:
+		# the readout layout only changes with the sequence
+		self.uploaded_adc_events = self.compute_adc_events()
+
+		for obj in DAC_pulses:
+
+			#pulses identical to an earlier one share its memory
+			if obj._DAC_2D_memory is None:
+				continue
 
 			self.log.info(__name__+ ' sending DAC {} 2D memory'.format(obj.channel)+'  \n')
 			self.write(obj._DAC_2D_memory)
@@ -461,32 +484,20 @@ class RFSoC(VisaInstrument):
 	def adc_events(self):
 		'''
 		will be used to organize the data saving
+		Layout of the uploaded sequence, computed in write_sequence_and_DAC_memory.
 		'''
-		sorted_seq=np.array(sqg.Pulse.sort_and_groupby_timewise())
-		
-		# sorted_seq=np.array(sqg.Pulse.sort_and_groupby_timewise()).flatten()
-		sorted_seq=np.concatenate( sorted_seq, axis=0 )
-		# print('sorted_seq={}'.format(sorted_seq))
-
-		mask=[type(p) is sqg.PulseReadout for p in sorted_seq]
-
-		sorted_adcs=sorted_seq[mask]
+		if self.uploaded_adc_events is not None:
+			return self.uploaded_adc_events
 
-		#store the nb of acq point for each unique event of each channel
-		length_vec=[[],[],[],[],[],[],[],[]]
+		return self.compute_adc_events()
 
-		N_adc_events=len(sorted_adcs)
 
-		#ch vec list of the order of adc ch measured in one loop of the sequence
-		ch_vec=np.zeros(N_adc_events,dtype=int)
+	def compute_adc_events(self):
 
-		for i in range(len(sorted_adcs)):
+		if self.sequence is not None:
+			return self.sequence.adc_events()
 
-			length_vec[int(sorted_adcs[i].channel[2])-1].append(int(round((sorted_adcs[i].t_duration)/0.5e-9)))
-
-			ch_vec[i]=int(sorted_adcs[i].channel[2])-1
-
-		return(length_vec,ch_vec)
+		return sqg.adc_events(sqg.Pulse.sort_and_groupby_timewise())
 
 
 
@@ -494,342 +505,29 @@ class RFSoC(VisaInstrument):
 
 	def get_readout_pulse(self):
 		'''
-		 This function reformat the data reading the header contents.
+		 This function reformat the data reading the header contents
+		 (see rfSoC_acquisition).
 		'''
 
 		self.reset_output_data()
 		mode = self.acquisition_mode()
 		nb_measure = self.nb_measure()
 		length_vec,ch_vec = self.adc_events()
-		N_adc_events = len(ch_vec)
-		n_pulses = len(length_vec[0])
 
 		ch_active = np.zeros(8,dtype=int)
 		for i in range(8):
 			if len(np.where(ch_vec==i)[0])>0:
 				ch_active[i] = 1
-		
-		if mode == 'SUM':
-			'''
-				Get data
-			'''
-			N_acq = np.sum(np.sum(length_vec))
-
-			data_unsorted = []
-			count_meas = 0
-			empty_packet_count = 0
-
-			self.write("SEQ:START")
-			time.sleep(0.1)
-
-			getting_valid_dataset = True
-
-			while getting_valid_dataset:
-
-				while (count_meas//(16*N_adc_events))<self.nb_measure.get():
 
-					r = self.ask('OUTPUT:DATA?')
-
-					if r == 'ERR':
+		if mode == 'SUM':
 
-						log.error('rfSoC: Instrument returned ERR!')
-
-						# reset measurement
-						data_unsorted = []
-						count_meas = 0
-						empty_packet_count = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
-
-						continue
-
-					elif len(r)>1:
-
-						empty_packet_count = 0
-						# print(datetime.datetime.now())
-						data_unsorted = data_unsorted+r
-						# print(datetime.datetime.now(),'\n')
-						count_meas+=len(r)
-
-
-					elif r == [3338] or r == [2573]: # new empty packet?
-
-						empty_packet_count += 1
-						time.sleep(0.5)
-
-					if empty_packet_count>20:
-
-						log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.nb_measure.get())+').')
-						
-						# reset measurement
-						data_unsorted = []
-						count_meas = 0
-						empty_packet_count = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
-
-						continue
-
-				if count_meas//(16*N_adc_events) == self.nb_measure.get():
-
-					getting_valid_dataset = False
-
-				else:
-
-					log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.nb_measure.get())+').')
-
-					# reset measurement
-					data_unsorted = []
-					count_meas = 0
-					empty_packet_count = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
-					self.write("SEQ:START")
-					time.sleep(0.1)
-
-			self.write("SEQ:STOP")
-
-			'''
-				Process data
-			'''
-
-			data_unsorted = np.array(data_unsorted,dtype=int)
-
-			# separate header from IQ data
-			raw_IQ_data_dump_header = data_unsorted.reshape(int(len(data_unsorted)/8),8)[0::2]
-			raw_I_data_dump_data = data_unsorted.reshape(int(len(data_unsorted)/8),8)[1::2][:,0:4]
-			raw_Q_data_dump_data = data_unsorted.reshape(int(len(data_unsorted)/8),8)[1::2][:,4:8]
-
-			# extract channel number from first byte of header
-			ch_num = (raw_IQ_data_dump_header%256).T[0]
-
-			# extract number of accumulated points for normalization from 3rd to 6th byte of header 
-			num_points = np.frombuffer(np.stack((raw_IQ_data_dump_header.T[1], raw_IQ_data_dump_header.T[2]), axis=1).astype('int16').tobytes(), dtype=np.long)
-
-			# vectors indicating channel that the data originated from 
-			ch_1 = ch_num*(ch_num == np.ones(len(ch_num)))
-			ch_2 = ch_num*(ch_num == 2*np.ones(len(ch_num)))/2
-			ch_3 = ch_num*(ch_num == 3*np.ones(len(ch_num)))/3
-			ch_4 = ch_num*(ch_num == 4*np.ones(len(ch_num)))/4
-			ch_5 = ch_num*(ch_num == 5*np.ones(len(ch_num)))/5
-			ch_6 = ch_num*(ch_num == 6*np.ones(len(ch_num)))/6
-			ch_7 = ch_num*(ch_num == 7*np.ones(len(ch_num)))/7
-			ch_8 = ch_num*(ch_num == 8*np.ones(len(ch_num)))/8
-
-			# data conversion form four 16 bit integers to one 64 bit longlong (*(0.3838e-3/16))
-			I_all_data = 2 + np.frombuffer(raw_I_data_dump_data.astype('int16').tobytes(), dtype=np.longlong)*0.3838e-3/(16*num_points)
-			Q_all_data = 2 + np.frombuffer(raw_Q_data_dump_data.astype('int16').tobytes(), dtype=np.longlong)*0.3838e-3/(16*num_points)
-
-			I = [((I_all_data*ch_1)[I_all_data*ch_1!=0]-2).reshape(nb_measure*ch_active[0],n_pulses).T,
-				 ((I_all_data*ch_2)[I_all_data*ch_2!=0]-2).reshape(nb_measure*ch_active[1],n_pulses).T,
-				 ((I_all_data*ch_3)[I_all_data*ch_3!=0]-2).reshape(nb_measure*ch_active[2],n_pulses).T,
-				 ((I_all_data*ch_4)[I_all_data*ch_4!=0]-2).reshape(nb_measure*ch_active[3],n_pulses).T,
-				 ((I_all_data*ch_5)[I_all_data*ch_5!=0]-2).reshape(nb_measure*ch_active[4],n_pulses).T,
-				 ((I_all_data*ch_6)[I_all_data*ch_6!=0]-2).reshape(nb_measure*ch_active[5],n_pulses).T,
-				 ((I_all_data*ch_7)[I_all_data*ch_7!=0]-2).reshape(nb_measure*ch_active[6],n_pulses).T,
-				 ((I_all_data*ch_8)[I_all_data*ch_8!=0]-2).reshape(nb_measure*ch_active[7],n_pulses).T]
-			Q = [((Q_all_data*ch_1)[Q_all_data*ch_1!=0]-2).reshape(nb_measure*ch_active[0],n_pulses).T,
-				 ((Q_all_data*ch_2)[Q_all_data*ch_2!=0]-2).reshape(nb_measure*ch_active[1],n_pulses).T,
-				 ((Q_all_data*ch_3)[Q_all_data*ch_3!=0]-2).reshape(nb_measure*ch_active[2],n_pulses).T,
-				 ((Q_all_data*ch_4)[Q_all_data*ch_4!=0]-2).reshape(nb_measure*ch_active[3],n_pulses).T,
-				 ((Q_all_data*ch_5)[Q_all_data*ch_5!=0]-2).reshape(nb_measure*ch_active[4],n_pulses).T,
-				 ((Q_all_data*ch_6)[Q_all_data*ch_6!=0]-2).reshape(nb_measure*ch_active[5],n_pulses).T,
-				 ((Q_all_data*ch_7)[Q_all_data*ch_7!=0]-2).reshape(nb_measure*ch_active[6],n_pulses).T,
-				 ((Q_all_data*ch_8)[Q_all_data*ch_8!=0]-2).reshape(nb_measure*ch_active[7],n_pulses).T]
+			I,Q = rfa.acquire_IQ(self, nb_measure, length_vec, ch_vec, ch_active, empty_pause=0.5)
 
 		elif mode == 'RAW':
 
-
 			self.reset_output_data()
 
-			#for now we consider only the one same type of acq on all adc
-			mode=self.acquisition_mode.get()
-
-			length_vec,ch_vec=self.adc_events()
-
-			N_adc_events=len(ch_vec)
-
-			N_acq=np.sum(np.sum(length_vec))
-
-			getting_valid_dataset = True
-
-			while getting_valid_dataset:
-
-				adcdataI = [[],[],[],[],[],[],[],[]]
-				adcdataQ = [[],[],[],[],[],[],[],[]]
-
-				rep=[]
-
-				keep_trying = True
-				empty_packet_count = 0
-
-				self.write("SEQ:START")
-				time.sleep(0.1)
-
-				while keep_trying:
-
-					r = self.ask('OUTPUT:DATA?')
-
-					if r == 'ERR':
-
-						log.error('rfSoC: Instrument returned ERR!')
-
-						# reset measurement
-						rep = []
-						empty_packet_count = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
-
-						continue
-
-					if len(r)>1:
-
-						rep = rep+r
-
-					elif r==[3338] or r==[2573]:
-
-						empty_packet_count += 1
-						time.sleep(0.1)
-
-						if empty_packet_count>10:
-
-							keep_trying = False
-
-				self.write("SEQ:STOP")
-
-				i=0
-				TSMEM=0
-				while (i + 8 )<= len(rep) : # at least one header left
-
-					entete = np.array(rep[i:i+8])
-					X =entete.astype('int16').tobytes()
-					V = X[0]-1 # channel (1 to 8)
-					DSPTYPE = X[1]
-					#N does not have the same meaning depending on DSTYPE
-					N = struct.unpack('I',X[2:6])[0]
-					#number of acquisition points in continuous
-					#depends on the point length
-					NpCont = X[7]*256 + X[6]
-					TS= struct.unpack('Q',X[8:16])[0]
-
-					# print the header for each packet
-					# print("Channel={}; N={}; DSP_type={}; TimeStamp={}; Np_Cont={}; Delta_TimeStamp={}".format(V,N,DSPTYPE,TS,NpCont,TS-TSMEM))
-
-					TSMEM=TS
-
-					iStart=i+8
-					# if not in continuous acq mode
-					if ((DSPTYPE &  0x2)!=2):
-						# raw adcdata for each Np points block
-						if ((DSPTYPE  &  0x1)==0):
-							Np=N
-							adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(rep[iStart:iStart+Np],4)*0.3838e-3))
-
-						#in the accumulation mode, only 1 I and Q point even w mixer OFF
-						#mixer ON or OFF
-						if ((DSPTYPE  & 0x01)==0x1):
-							Np=8
-							D=np.array(rep[iStart:iStart+Np])
-							X = D.astype('int16').tobytes()
-
-							#I  dvided N and 2 bcse signed 63 bits aligned to the left
-							# mod div by 4 to fix amplitude -Arpit, Martina
-							I=  struct.unpack('q',X[0:8])[0]*(0.3838e-3)/(N*2*4)
-							Q=  struct.unpack('q',X[8:16])[0]*(0.3838e-3)/(N*2*4)
-
-							# print the point
-							# print("I/Q:",I,Q,"Amplitude:",np.sqrt(I*I+Q*Q),"Phase:",180*np.arctan2(I,Q)/np.pi)
-
-							adcdataI[V]=np.append(adcdataI[V], I)
-							adcdataQ[V]=np.append(adcdataQ[V], Q)
-
-
-					#in our case we dont need the continuous mode for now
-					# continuoous acquisition mode with accumulation (reduce the flow of data)
-					elif ((DSPTYPE &  0x3)==0x3):
-						# mixer OFF : onlyI @2Gs/s or 250Ms/s
-						if ((DSPTYPE  & 0x20)==0x0):
-							# points are already averaged in the PS part
-							# format : 16int
-							Np = NpCont
-							adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(rep[iStart:iStart+Np],4)*0.3838e-3))
-
-						# mixer ON : I and Q present
-						elif ((DSPTYPE  & 0x20)==0x20):
-							Np = NpCont
-							adcdataI[V]=np.concatenate((adcdataI[V],np.right_shift(rep[iStart:Np:2],4)*0.3838e-3))
-							adcdataQ[V]=np.concatenate((adcdataQ[V], np.right_shift(rep[iStart+1:Np:2],4)*0.3838e-3))
-
-
-					i = iStart+Np # index of the new data block, new header
-
-				# print("********************************************************************")
-				# print(len(rep),"Pts treated in ",time.perf_counter()-tstart,"seconds")
-				# print("********************************************************************")
-
-				#reshaping results
-
-				points_rec = 0
-				points_expected = 0
-
-				for index in range(8):
-
-					if len(adcdataI[index]) > 0:
-
-						points_rec += adcdataI[index].size
-					
-					points_expected += int(self.nb_measure() * np.sum(length_vec[index],dtype=int))
-
-				if points_rec == points_expected:
-
-					getting_valid_dataset = False
-
-					adcdataI=[np.array(adcdataI[v]).reshape(self.nb_measure.get(),np.sum(length_vec[v],dtype=int)) for v in range(8)]
-
-					# adcdataI=[np.array(adcdataI[v]).reshape(self.nb_measure.get(),np.sum(np.sum(ch[v],dtype=int))) for v in range(8)]
-					adcdataI=[np.mean(adcdataI[v],axis=0) for v in range(8)]
-
-					adcdataI=np.array([np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))]) for v in range(8)])
-
-					I,Q = adcdataI,adcdataQ
-
-				else:
-
-					log.error('Data curruption: rfSoC did not send all data points({}/'.format(points_rec)+str(points_expected)+').')
+			I,Q = rfa.acquire_RAW(self, nb_measure, length_vec)
 
 		else:
 
@@ -850,20 +548,7 @@ class RFSoC(VisaInstrument):
 				str: The instrument's response.
 			"""
 			with DelayedKeyboardInterrupt():
-				keep_trying = True
-				count = 0
-				while keep_trying:
-					count += 1
-					self.visa_log.debug(f"Querying: {cmd}")
-					try:
-						response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False)
-						self.visa_log.debug(f"Response: {response}")
-					except:
-						response = 'ERR'
-					if response != 'ERR' and response != [3338]:
-						keep_trying = False
-					if count>10:
-						keep_trying = False
+				response = rfa.query_binary(self.visa_handle, cmd, self.visa_log)
 
 			return response
 
@@ -9,6 +9,7 @@
 import time
 import datetime
 import numpy as np
+import os
 import sys
 import struct
 import ctypes  # only for DLL-based instrument
@@ -22,6 +23,10 @@ from qcodes.instrument.channel import InstrumentChannel
 from qcodes.instrument.parameter import ParameterWithSetpoints, Parameter
 
 import SequenceGeneration_v2 as sqg
+import rfSoC_compiler as rfc
+import rfSoC_acquisition as rfa
+import rfSoC_dsp as rfd
+import rfSoC_store as rfs
 from qcodes.utils.delaykeyboardinterrupt import DelayedKeyboardInterrupt
 from qcodes.utils.validators import Numbers, Arrays
 
@@ -31,10 +36,6 @@ from IPython.display import display, HTML
 from ipywidgets import IntProgress
 import matplotlib.pyplot as plt
 
-import functools
-import operator
-from itertools import chain
-
 sys.path.append('C:\\QCodes drivers and scripts\\Scripts\\Arpit\\Modules')
 from progress_barV2 import bar
 
@@ -298,6 +299,65 @@ class ADC_power_dBm_std(Parameter):
 
 
 
+class PSD_freq_axis(Parameter):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._channel = self._instrument._adc_channel
+
+	def get_raw(self):
+
+		return self._instrument._parent.PSD_frequencies(self._channel)
+
+
+class PSD(ParameterWithSetpoints):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._channel = self._instrument._adc_channel
+
+	def get_raw(self):
+
+		return self._instrument._parent.get_PSD()[self._channel-1]
+
+
+
+class RepIndex(Parameter):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+
+	def get_raw(self):
+
+		return self._instrument._parent.shot_reps()
+
+
+class PulseIndex(Parameter):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+
+	def get_raw(self):
+
+		return np.arange(self._instrument._parent.n_pulses(self._instrument._adc_channel))
+
+
+class Shots(ParameterWithSetpoints):
+
+	def __init__(self, quadrature, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._channel = self._instrument._adc_channel
+		self._quadrature = quadrature
+
+	def get_raw(self):
+
+		dataI, dataQ = self._instrument._parent.get_readout_pulse()
+
+		return (dataI if self._quadrature == 'I' else dataQ)[self._channel-1]
+
+
+
+
 #TODO : add the different results we would return
 class AcqChannel(InstrumentChannel):
 
@@ -348,7 +408,6 @@ class AcqChannel(InstrumentChannel):
 		self.add_parameter(name='RAW',
 						   unit='V',
 						   label='Channel {}'.format(self._adc_channel),
-						   channel=self._adc_channel,
 						   parameter_class=RAW,
 						   snapshot_value = False
 						   )
@@ -356,16 +415,57 @@ class AcqChannel(InstrumentChannel):
 		self.add_parameter(name='IQINT',
 						   unit='V',
 						   label='Channel {}'.format(self._adc_channel),
-						   channel=self._adc_channel,
 						   parameter_class=IQINT,
 						   snapshot_value = False)
 
 		self.add_parameter(name='IQINT_AVG',
 						   unit='V',
 						   label='Integrated averaged I Q for channel {}'.format(self._adc_channel),
-						   channel=self._adc_channel,
 						   parameter_class=IQINT_AVG,
 						   snapshot_value = False)
+
+		self.add_parameter(name='PSD_freq_axis',
+						   unit='Hz',
+						   label='ADC{} PSD frequency'.format(self._adc_channel),
+						   parameter_class=PSD_freq_axis,
+						   vals=Arrays(shape=(parent.PSD_n_freq,)),
+						   snapshot_value = False)
+
+		self.add_parameter(name='PSD',
+						   unit='V^2/Hz',
+						   label='Power spectral density of channel {}'.format(self._adc_channel),
+						   setpoints=(self.PSD_freq_axis,),
+						   parameter_class=PSD,
+						   vals=Arrays(shape=(parent.PSD_n_freq,)),
+						   snapshot_value = False)
+		# shots (pulse, repetition) for the datasets, see RFSoC.write_shots.
+		# The shapes are shared by the shots and their setpoints, as qcodes
+		# compares them, and follow the repetitions being written.
+		n_pulses = lambda: parent.n_pulses(self._adc_channel)
+		n_shots = lambda: len(parent.shot_reps())
+
+		self.add_parameter(name='pulse_index',
+						   label='ADC{} pulse'.format(self._adc_channel),
+						   parameter_class=PulseIndex,
+						   vals=Arrays(shape=(n_pulses,)),
+						   snapshot_value = False)
+
+		self.add_parameter(name='rep_index',
+						   label='ADC{} repetition'.format(self._adc_channel),
+						   parameter_class=RepIndex,
+						   vals=Arrays(shape=(n_shots,)),
+						   snapshot_value = False)
+
+		for quadrature in ['I', 'Q']:
+			self.add_parameter(name='{}_shots'.format(quadrature),
+							   unit='V',
+							   label='Integrated {} shots of channel {}'.format(quadrature, self._adc_channel),
+							   quadrature=quadrature,
+							   setpoints=(self.pulse_index, self.rep_index),
+							   parameter_class=Shots,
+							   vals=Arrays(shape=(n_pulses, n_shots)),
+							   snapshot_value = False)
+
 		self.status('OFF')
 
 	def MHz_to_Hz(self,value):
@@ -390,8 +490,15 @@ class RFSoC(VisaInstrument):
 
 		self.sampling_rate = 2e9
 		self.FPGA_clock = 250e6
+		# rows of 8 samples per DAC channel, the last one is the idle row closing each upload
+		self.DAC_memory_rows = 16384
 		self.DAC_amplitude_calib = [1.08,1.08,1.08,1.08,1.08,1.08,1.08,1.08]
 
+		# measured output link throughput in bytes/s (see transfer_speed) and
+		# output FIFO size in bytes, None to only keep the sync with freq_sync
+		self.link_throughput = None
+		self.output_FIFO_size = None
+
 		self.pulses = pd.DataFrame()
 		self.ADC_ch_active = np.zeros(8)
 		self.length_vec = [[],[],[],[],[],[],[],[]]
@@ -405,6 +512,36 @@ class RFSoC(VisaInstrument):
 
 		self.raw_dump_location = "C:/Data_tmp"
 
+		# compiled programs are reused whenever the same pulse table and settings come back
+		self.use_program_cache = True
+		self.program_cache = rfc.ProgramCache()
+
+		# ping-pong mode: each DAC memory is split in two halves, the next
+		# program is written to the idle half while the current one runs
+		# (see stage_program and swap_program)
+		self.DAC_ping_pong = False
+		self.DAC_half = 0
+		self.DAC_half_data = [{}, {}]
+		self.staged_program = None
+
+		# long acquisitions are run as several shorter ones and merged (see
+		# get_readout_pulse_chunked), with chunks adapted to last about
+		# chunk_target_time seconds
+		self.chunk_acquisition = False
+		self.first_chunk_rep = 1000
+		self.max_chunk_rep = None
+		self.chunk_target_time = 10.
+		self.chunk_planner = None
+
+		# Welch estimators of the last get_PSD, one per ADC channel
+		self.PSD_estimators = None
+
+		# single shot discrimination, {channel: discriminator} (see get_populations)
+		self.discriminators = {}
+		self.shot_counter = None
+		# repetitions of the shots being written by write_shots
+		self._shot_reps = None
+
 		#Add the channels to the instrument
 		for adc_num in np.arange(1,9):
 			adc_name='ADC{}'.format(adc_num)
@@ -422,6 +559,26 @@ class RFSoC(VisaInstrument):
 							initial_value = int(1),
 							parameter_class=ManualParameter)
 
+		# Welch power spectral density of the RAW traces (see get_PSD)
+		self.add_parameter('PSD_segment_length',
+							label='PSD segment length in points',
+							get_parser=int,
+							initial_value=4096,
+							vals=vals.Ints(8),
+							parameter_class=ManualParameter)
+
+		self.add_parameter('PSD_window',
+							label='PSD window',
+							initial_value='hann',
+							vals=vals.Enum(*rfd.WINDOWS),
+							parameter_class=ManualParameter)
+
+		self.add_parameter('PSD_overlap',
+							label='PSD segment overlap',
+							initial_value=0.5,
+							vals=vals.Numbers(0,0.95),
+							parameter_class=ManualParameter)
+
 		self.add_parameter('acquisition_mode',
 							label='ADCs acquisition mode',
 							get_parser=str,
@@ -527,475 +684,290 @@ class RFSoC(VisaInstrument):
 
 	def process_sequencing(self):
 
-		log.info('Started sequence processing'+'  \n')
+		program = self.compile_sequencing()
 
-		n_rep = self.n_rep()
-		pulses_raw_df = self.pulses
+		self.upload_program(program)
 
-		if len(set(pulses_raw_df['label'])) < len(pulses_raw_df['label']):
+		log.info('Waveform and sequence processing complete' + '\n')
 
-			log.error('Duplicate Labels: Labels need to be unique for consistent identification of pulse hierarchy.')
 
-		pulses_raw_df.set_index('label', inplace = True)
+	def compile_settings(self):
+		'''
+		Instrument settings the compilation depends on (see rfSoC_compiler).
+		'''
 
-		if self.debug_mode:
+		return dict(n_rep=self.n_rep(),
+					acquisition_mode=self.acquisition_mode(),
+					freq_sync=self.freq_sync(),
+					sampling_rate=self.sampling_rate,
+					FPGA_clock=self.FPGA_clock,
+					DAC_amplitude_calib=list(self.DAC_amplitude_calib),
+					DAC_memory_rows=self.DAC_memory_rows//2 if self.DAC_ping_pong else self.DAC_memory_rows,
+					link_throughput=self.link_throughput,
+					output_FIFO_size=self.output_FIFO_size,
+					decimation=[self.submodules['ADC{}'.format(ch)].decfact.get_latest() or 1 for ch in range(1,9)])
 
-			display(pulses_raw_df)
 
-		resolve_hierarchy = True
-		while resolve_hierarchy:
+	def active_program_cache(self):
 
-			for index, row in pulses_raw_df.iterrows():
+		return self.program_cache if self.use_program_cache else None
 
-				if row['parent'] != None:
 
-					if pulses_raw_df.loc[row['parent']]['parent'] == None:
+	def compile_sequencing(self, pulses=None):
+		'''
+		Compile a pulse table (self.pulses by default) into an RFSoCProgram
+		holding the SEQ command, the DAC memory of each channel and the ADC
+		event layout. Nothing is sent to the instrument.
+		'''
 
-						pulses_raw_df.loc[index,'start'] = pulses_raw_df.loc[index,'start'] +  pulses_raw_df.loc[row['parent']]['start'] + pulses_raw_df.loc[row['parent']]['length']
-						pulses_raw_df.loc[index,'parent'] = None
-			
-			resolve_hierarchy = False
-			for val in pulses_raw_df['parent']:
-				if val != None:
-					resolve_hierarchy = True
-
-		if self.debug_mode:
-
-			print('Hierarchy resolution...')
-			display(pulses_raw_df)
-
-		pulses_df = pd.DataFrame()
-		time_ADC = [0,0,0,0,0,0,0,0]
-		time_DAC = [0,0,0,0,0,0,0,0]
-		length_vec = [[],[],[],[],[],[],[],[]]
-		ch_vec = []
-		wait_color_count = int("D3D3D3", 16)
-		DAC_color_count = int("306cc7", 16)
-		ADC_color_count = int("db500b", 16)
-		color_dict = {}
-		termination_time = 0
-
-		tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'ADC']
-		for index, row in tmp_df.iterrows():
-			
-			if row['start'] > time_ADC[int(row['channel'])-1]:
-				
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_ADC[int(row['channel'])-1]
-				stop = row['start']
-				time = row['start'] - time_ADC[int(row['channel'])-1]
-				module = row['module']
-				Channel = 'ADC ch' + str(int(row['channel']))
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = row['channel']
-				
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-			
-			label = index
-			start = row['start']
-			stop = row['start'] + row['length']
-			time = row['length']
-			module = row['module']
-			Channel = 'ADC ch' + str(int(row['channel']))
-			mode = row['mode']
-			color = ADC_color_count
-			ADC_color_count += 1
-			color_dict[str(color)] = '#{0:06X}'.format(color)
-			param = row['param']
-			ch_num = row['channel']
-
-			pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-
-			length_vec[int(row['channel'])-1].append(int(time*1e-6*self.sampling_rate))
-			ch_vec.append(int(row['channel'])-1)
-			
-			time_ADC[int(row['channel'])-1] = stop
-			
-			if stop>termination_time:
-				
-				termination_time = stop
-			
-		tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'DAC']
-		for index, row in tmp_df.iterrows():
-			
-			if row['start'] > time_DAC[int(row['channel'])-1]:
-				
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_DAC[int(row['channel'])-1]
-				stop = row['start']
-				time = row['start'] - time_DAC[int(row['channel'])-1]
-				module = row['module']
-				Channel = 'DAC ch' + str(int(row['channel']))
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = row['channel']
-				
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-			
-			label = index
-			start = row['start']
-			stop = row['start'] + row['length']
-			time = row['length']
-			module = row['module']
-			Channel = 'DAC ch' + str(int(row['channel']))
-			mode = row['mode']
-			color = DAC_color_count
-			DAC_color_count += 1
-			color_dict[str(color)] = '#{0:06X}'.format(color)
-			param = row['param']
-			ch_num = row['channel']
-
-			pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-			
-			time_DAC[int(row['channel'])-1] = stop
-			
-			if stop>termination_time:
-				
-				termination_time = stop
-	
-		for ch in range(1,9):
-			
-			if termination_time>time_ADC[ch-1] and time_ADC[ch-1]>0:
-				
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_ADC[ch-1]
-				stop = termination_time
-				time = stop - start
-				module = 'ADC'
-				Channel = 'ADC ch' + str(ch)
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = ch
-				
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
-				
-		for ch in range(1,9):
-			
-			if termination_time>time_DAC[ch-1] and time_DAC[ch-1]>0:
-				
-				label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
-				start = time_DAC[ch-1]
-				stop = termination_time
-				time = stop - start
-				module = 'DAC'
-				Channel = 'DAC ch' + str(ch)
-				mode = 'wait'
-				color = wait_color_count
-				wait_color_count += 1
-				color_dict[str(color)] = '#{0:06X}'.format(color)
-				param = row['param']
-				ch_num = ch
-				
-				pulses_df = pulses_df.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num), ignore_index=True)
+		if pulses is None:
+			pulses = self.pulses
+
+		program = rfc.compile_program(pulses, self.compile_settings(), self.active_program_cache(), self.debug_mode)
 
 		if self.display_sequence:
+			self.display_program(program)
 
-			fig = px.bar(pulses_df, x="time", y="Channel", color='color', orientation='h', text="label",
-						 color_discrete_map=color_dict,
-						 hover_data=["start","stop"],
-						 height=300,
-						 title='pulse sequence')
-			fig.update_layout(showlegend=False) 
-			fig.show()
+		return program
 
-		self.length_vec = length_vec
-		self.ch_vec = ch_vec
 
-		event_time_list = list(dict.fromkeys(pulses_df['start']))
-		event_time_list.sort()
+	def display_program(self, program):
 
-		termination_time = np.max(pulses_df['stop'])
+		fig = px.bar(program.timeline, x="time", y="Channel", color='color', orientation='h', text="label",
+					 color_discrete_map=program.color_dict,
+					 hover_data=["start","stop"],
+					 height=300,
+					 title='pulse sequence')
+		fig.update_layout(showlegend=False) 
+		fig.show()
 
-		if self.debug_mode:
 
-			display(pulses_df)
-			display(pulses_df.sort_values('start'))
+	def program_hash(self, pulses):
 
-			print('Events detected at: ',event_time_list)
+		return rfc.program_hash(pulses, self.compile_settings())
 
-			print('Termination of sequence detected at : ',termination_time)
 
-		global_sequence = np.array([])
-		event_time_prev = 0
-		DAC_pulses_array = [np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([]),np.array([])]
-		DAC_pulses_pointer = [[],[],[],[],[],[],[],[]]
-		ADC_state = np.array([0,0,0,0,0,0,0,0])
-		self.ADC_ch_active = np.array([0,0,0,0,0,0,0,0])
-		n_clock_cycles = 0
-		n_clock_cycles_global = 0
+	def upload_program(self, program):
+		'''
+		Send a compiled program (see compile_sequencing) to the instrument.
+		Programs returned as diffs by compile_sweep only carry the DAC
+		channels that changed, and no SEQ command if the sequence is unchanged.
+		'''
 
+		if self.DAC_ping_pong:
 
-		for event_time in event_time_list:
-			
-			# adding wait till this event
-			if event_time>0:
-				
-				global_sequence = np.append(global_sequence,1)
-				global_sequence = np.append(global_sequence,int((event_time-event_time_prev)*250)-1)
-				n_clock_cycles_global = n_clock_cycles_global + int((event_time-event_time_prev)*250)
-
-				if self.debug_mode:
-
-					print('adding wait till this event')
-					print(1,int((event_time-event_time_prev)*250)-1)
-				
-			n_clock_cycles = 0
-			event_time_prev = event_time
-			tmp_df = pulses_df.loc[pulses_df['start'] == event_time]
-			tmp_df = tmp_df.sort_values(by='module', ascending=False)
-			
-			
-			for index, row in tmp_df.iterrows():
-				
-				if self.debug_mode:
-
-					print(event_time,row['mode'], row['label'])
-
-				ch_num = int(row['ch_num'])
-
-				if row['module'] == 'DAC':
-						
-					if row['mode'] != 'wait':
-						
-						# generate sequence and add to corresponding channel
-						SCPI_command = self.pulse_gen_SCPI(row['mode'],row['param'],row['time'],ch_num)
-						
-						# adding pointer for this pulse
-						pulse_addr = int(len(DAC_pulses_array[ch_num-1])/11)
-						DAC_pulses_pointer[ch_num-1].append(pulse_addr)
-						
-						# adding pulse to waveform
-						DAC_pulses_array[ch_num-1] = np.append(DAC_pulses_array[ch_num-1],SCPI_command)
-						
-						# adding sequencer command to point to address of this pulse
-						n_clock_cycles += 1
-						global_sequence = np.append(global_sequence,4096+ch_num)
-						global_sequence = np.append(global_sequence,pulse_addr)
-
-						if self.debug_mode:
-
-							print('adding sequencer command to point to address of this pulse')
-							print(4096+ch_num,pulse_addr)
-						
-						# adding sequencer command to start output
-						n_clock_cycles += 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))
-						for i in [8,7,6,5,4,3,2,1]:
-							if i == ch_num:
-								bin_trig_cmd += '011'
-							else:
-								bin_trig_cmd += '000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to start output')
-							print(4096,int(bin_trig_cmd,2))
-						
-					elif row['mode'] == 'wait':
-						
-						# adding sequencer command to stop output
-						n_clock_cycles += 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))
-						for i in [8,7,6,5,4,3,2,1]:
-							if i == ch_num:
-								bin_trig_cmd += '001'
-							else:
-								bin_trig_cmd += '000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to stop output')
-							print(4096,int(bin_trig_cmd,2))
-						
-					else:
-						
-						log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
-						
-				if row['module'] == 'ADC':
-					
-					if row['mode'] != 'wait':
-						
-						# adding sequencer command to set acq points
-						n_clock_cycles += 1
-						global_sequence = np.append(global_sequence,4106+ch_num)
-						global_sequence = np.append(global_sequence,int(row['time']*1e-6*self.sampling_rate))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to set acq points')
-							print(4106+ch_num,int(row['time']*1e-6*self.sampling_rate))
-						
-						# adding sequencer command to start acq
-						n_clock_cycles += 1
-						ADC_state[7-(ch_num-1)] = 1
-						self.ADC_ch_active[ch_num-1] = 1
-						bin_trig_cmd = ''.join(ADC_state.astype(str))+'000000000000000000000000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to start acq')
-							print(4096,int(bin_trig_cmd,2))
-						
-					elif row['mode'] == 'wait':
-						
-						# adding sequencer command to stop acq
-						n_clock_cycles += 1
-						ADC_state[7-(ch_num-1)] = 0
-						bin_trig_cmd = ''.join(ADC_state.astype(str))+'000000000000000000000000'
-						global_sequence = np.append(global_sequence,4096)
-						global_sequence = np.append(global_sequence,int(bin_trig_cmd,2))
-
-						if self.debug_mode:
-
-							print('adding sequencer command to stop acq')
-							print(4096,int(bin_trig_cmd,2))
-						
-					else:
-						
-						log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
-						
-			n_clock_cycles_global += n_clock_cycles
-				
-		#terminate the sequence
-		global_sequence = np.append(global_sequence,1)
-		global_sequence = np.append(global_sequence,int((termination_time-event_time_prev)*250)-1)
-		n_clock_cycles_global = n_clock_cycles_global + int((termination_time-event_time_prev)*250)
-		global_sequence = np.append(global_sequence,4096)
-		global_sequence = np.append(global_sequence,0)
-		n_clock_cycles_global += 1
-
-		if self.acquisition_mode() == 'RAW':
-			acq_mode = 0
-		elif self.acquisition_mode() == 'IQ':
-			acq_mode = 286331153
+			self.stage_program(program)
+			self.swap_program()
+
+			return
+
+		for ch, DAC_data in program.DAC_data.items():
+
+			self.write('DAC:DATA:CH{}:CLEAR'.format(str(ch)))
+			self.write_DAC_data(ch, DAC_data)
+
+		if program.sequence_str is not None:
+
+			log.info('Writing global sequence' + '\n')
+			self.write(program.sequence_str)
+
+			# just to keep in log
+			self.sequence_str = program.sequence_str
+
+		self.length_vec = program.length_vec
+		self.ch_vec = program.ch_vec
+		self.ADC_ch_active = program.ADC_ch_active
+
+		self.DAC_half = 0
+		self.DAC_half_data = [{}, {}]
+
+
+	def write_DAC_data(self, ch, DAC_data, address=0):
+
+		if self.debug_mode and self.debug_mode_plot_waveforms:
+
+			fig = plt.figure(figsize=(8,5))
+			plt.plot(range(len(DAC_data)),DAC_data)
+			plt.grid()
+			plt.legend(fontsize = 14)
+			plt.show()
+
+		DAC_SCPI_cmd = 'DAC:DATA:CH' + str(ch) + ' ' + str(address) + ',' + ','.join(DAC_data.astype(str)) + ',0,0,0,0,0,0,0,0,0,0,16383'
+
+		if self.debug_mode and self.debug_mode_waveform_string:
+
+			print('DAC sequence for CH '+str(ch)+': ',DAC_SCPI_cmd)
+
+		log.info('Writing waveform for CH'+str(ch)+'  \n')
+		self.write(DAC_SCPI_cmd)
+
+
+	def stage_program(self, program):
+		'''
+		Ping-pong mode: write the DAC data of a program compiled with
+		DAC_ping_pong on to the idle half of the DAC memories. This can be
+		done while the sequence runs from the active half; the program
+		starts with swap_program. Channels whose data is already in the
+		idle half are not written again, and channels missing from a diff
+		program (see compile_sweep) are copied from the active half.
+		'''
+
+		half = 1 - self.DAC_half
+		half_rows = self.DAC_memory_rows//2
+
+		if program.sequence_str is not None:
+			sequence_str = program.sequence_str
 		else:
-			log.error('Invalid acquisition mode\n')
-			
-		period_sync = int(self.FPGA_clock/self.freq_sync())
-		wait_sync = period_sync-(n_clock_cycles_global%period_sync)-1 -3 #(2 clock cycles for jump)
+			sequence_str = self.staged_program_sequence()
 
-		global_sequence_str = 'SEQ 0,1,9,4106,' + str(acq_mode) + ',257,' + str(int(n_rep-1)) + ',' + ','.join((global_sequence.astype(int)).astype(str)) + ',1,' + str(wait_sync) + ',513,0,0,0'
+		DAC_data = dict(self.DAC_half_data[self.DAC_half])
+		DAC_data.update(program.DAC_data)
 
-		# just to keep in log
-		self.sequence_str = global_sequence_str
+		for ch in sorted(set(program.DAC_data) | set(rfc.sequence_DAC_channels(sequence_str))):
 
-		if self.debug_mode:
+			if ch not in DAC_data:
+				continue
 
-			print('Sequence programmer command: ',global_sequence_str)
+			if len(DAC_data[ch])//11 > half_rows-1:
+				raise ValueError('rfSoC: CH{} needs {} DAC rows, more than half of the memory ({} rows). Compile the program with DAC_ping_pong on.'.format(ch,len(DAC_data[ch])//11,half_rows-1))
 
-		for i in range(8):
+			idle_data = self.DAC_half_data[half].get(ch)
+			if idle_data is not None and np.array_equal(idle_data, DAC_data[ch]):
+				continue
+
+			self.write_DAC_data(ch, DAC_data[ch], half*half_rows)
+			self.DAC_half_data[half][ch] = DAC_data[ch]
 
-			if len(DAC_pulses_array[i])>0:
+		self.staged_program = rfc.relocate_program(program._replace(sequence_str=sequence_str), half*half_rows)
 
-				self.write('DAC:DATA:CH{}:CLEAR'.format(str(i+1)))
 
-				if self.debug_mode and self.debug_mode_plot_waveforms:
+	def staged_program_sequence(self):
+		'''
+		SEQ command of the program running from the active half, with the
+		DAC addresses of the beginning of the memory.
+		'''
 
-					fig = plt.figure(figsize=(8,5))
-					plt.plot(range(len(DAC_pulses_array[i])),DAC_pulses_array[i])
-					plt.grid()
-					plt.legend(fontsize = 14)
-					plt.show()
+		return rfc.relocate_sequence(self.sequence_str, -self.DAC_half*(self.DAC_memory_rows//2))
 
-				DAC_SCPI_cmd = 'DAC:DATA:CH' + str(i+1) + ' 0,' + ','.join((DAC_pulses_array[i].astype(int)).astype(str)) + ',0,0,0,0,0,0,0,0,0,0,16383'
 
-				if self.debug_mode and self.debug_mode_waveform_string:
+	def swap_program(self):
+		'''
+		Ping-pong mode: point the sequencer to the program written by
+		stage_program, whose half becomes the active one.
+		'''
+
+		program = self.staged_program
 
-					print('DAC sequence for CH '+str(i+1)+': ',DAC_SCPI_cmd)
+		if program is None:
 
-				log.info('Writing waveform for CH'+str(i+1)+'  \n')
-				self.write(DAC_SCPI_cmd)
+			log.error('rfSoC: no staged program to swap to.')
+			return
 
 		log.info('Writing global sequence' + '\n')
-		self.write(global_sequence_str)
+		self.write(program.sequence_str)
+		self.sequence_str = program.sequence_str
 
-		log.info('Waveform and sequence processing complete' + '\n')
-	
+		self.length_vec = program.length_vec
+		self.ch_vec = program.ch_vec
+		self.ADC_ch_active = program.ADC_ch_active
 
+		self.DAC_half = 1 - self.DAC_half
+		self.staged_program = None
 
-	def pulse_gen_SCPI(self,mode,param,duration,ch):
-	
-		period = 1./self.sampling_rate
-		time_vec = np.arange(period,duration*1e-6+period/2,period)
-		
-		if mode == 'sin+sin':
-			
-			wavepoints1 = (2**13)*self.DAC_amplitude_calib[ch-1]*param['amp1']*np.sin(-param['phase_offset1'] + 2*np.pi*param['freq1']*1e6*time_vec)
-			wavepoints2 = (2**13)*self.DAC_amplitude_calib[ch-1]*param['amp2']*np.sin(-param['phase_offset2'] + 2*np.pi*param['freq2']*1e6*time_vec)
-			
-			wavepoints = (2**13)*self.DAC_amplitude_calib[ch-1]*param['dc_offset'] + wavepoints1 + wavepoints2
-			
-			if self.debug_mode and self.debug_mode_plot_waveforms:
-				print('plot of sinsin mode 1')
-				fig = plt.figure(figsize=(8,5))
-				plt.plot(time_vec,wavepoints1)
-				plt.grid()
-				plt.show()
-				print('plot of sinsin mode 2')
-				fig = plt.figure(figsize=(8,5))
-				plt.plot(time_vec,wavepoints2)
-				plt.grid()
-				plt.show()
-				print('plot of sinsin mode total')
-				fig = plt.figure(figsize=(8,5))
-				plt.plot(time_vec,wavepoints)
-				plt.grid()
-				plt.show()
-				
-				
-			
-		elif mode == 'sin':
-			
-			wavepoints = (2**13)*self.DAC_amplitude_calib[ch-1]*param['dc_offset'] + (2**13)*self.DAC_amplitude_calib[ch-1]*param['amp']*np.sin(-param['phase_offset'] + 2*np.pi*param['freq']*1e6*time_vec)
-			
-			if self.debug_mode and self.debug_mode_plot_waveforms:
-				print('plot of sin mode')
-				fig = plt.figure(figsize=(8,5))
-				plt.plot(time_vec,wavepoints)
-				plt.grid()
-				plt.legend(fontsize = 14)
-				plt.show()
-			
-			
-			
-		else:
-			
-			log.error('Wrong waveform mode: ',mode)
-		
-		
-		
-		# adding zeros to make length multiple of 8
-		wavepoints = np.append(wavepoints,np.zeros(len(time_vec)%8))
 
-		trig_rep_len = int(len(wavepoints)/8)
-		# adding trigger vectors
-		wavepoints = np.concatenate((wavepoints.reshape(trig_rep_len,8), np.array(np.zeros(trig_rep_len))[:,None]),axis=1)
-		wavepoints = np.concatenate((wavepoints, np.array(np.zeros(trig_rep_len))[:,None]),axis=1)
+	def compile_sweep(self, sweep, pulses=None, diff=False):
+		'''
+		Compile all the points of a sweep of pulse parameters at once, see
+		rfSoC_compiler.compile_sweep. The programs are uploaded with
+		upload_program.
+		'''
+
+		if pulses is None:
+			pulses = self.pulses
+
+		return rfc.compile_sweep(pulses, sweep, self.compile_settings(), diff, self.active_program_cache())
+
+
+	def compile_batched_sweep(self, sweep, pulses=None, max_batch=None, gap=0):
+		'''
+		Pack the points of a sweep into as few sequences as the DAC memory
+		allows, see rfSoC_compiler.compile_batched_sweep.
+		'''
+
+		if pulses is None:
+			pulses = self.pulses
+
+		return rfc.compile_batched_sweep(pulses, sweep, self.compile_settings(), max_batch, gap, self.active_program_cache())
+
+
+	def demux_batch(self, I, Q, batch):
+
+		return rfc.demux_batch(I, Q, batch)
+
+
+	def get_batched_sweep(self, sweep, pulses=None, max_batch=None, gap=0):
+		'''
+		Compile, run and demux a sweep in as few sequencer runs as the DAC
+		memory allows. Returns one (I, Q) pair per sweep point.
+		'''
+
+		data = []
+		for batch in self.compile_batched_sweep(sweep, pulses, max_batch, gap):
+
+			self.upload_program(batch['program'])
+			I, Q = self.get_readout_pulse()
+			data += self.demux_batch(I, Q, batch)
+
+		return data
+
+
+	def precompile(self, pulse_tables, max_workers=None):
+		'''
+		Compile a list of pulse tables in parallel worker processes with the
+		current settings and store the programs in the program cache, so
+		that process_sequencing on any of those tables skips compilation.
+		'''
+
+		settings = self.compile_settings()
+		programs = rfc.precompile_programs(pulse_tables, settings, max_workers)
+
+		if self.use_program_cache:
+			for pulses, program in zip(pulse_tables, programs):
+				self.program_cache.put(rfc.program_hash(pulses, settings), program)
+
+		return programs
+
+
+	def get_ping_pong_sweep(self, programs):
+		'''
+		Run a list of programs compiled with DAC_ping_pong on (e.g. by
+		compile_sweep), writing the DAC data of each program while the
+		previous one acquires. Returns one (I, Q) pair per program.
+		'''
+
+		if not self.DAC_ping_pong:
+
+			raise ValueError('rfSoC: get_ping_pong_sweep needs DAC_ping_pong on, with the programs compiled in that mode.')
+
+		programs = list(programs)
+		self.upload_program(programs[0])
+
+		data = []
+		for k in range(len(programs)):
+
+			if k+1 < len(programs):
+				I, Q = self.get_readout_pulse(while_running=lambda: self.stage_program(programs[k+1]))
+				data.append((I, Q))
+				self.swap_program()
+			else:
+				data.append(self.get_readout_pulse())
 
-		# adding repetation (0 for once)
-		wavepoints = np.concatenate((wavepoints, np.array(np.zeros(trig_rep_len))[:,None]),axis=1)
+		return data
 
-		# convert to 1D array 
-		wavepoints = wavepoints.reshape(1,len(wavepoints)*len(wavepoints[0]))
-		
-		return wavepoints[0]
 
+	def pulse_gen_SCPI(self,mode,param,duration,ch):
+
+		return rfc.pulse_gen_SCPI(mode,param,duration,ch,self.compile_settings())
 
 
 
@@ -1014,514 +986,461 @@ class RFSoC(VisaInstrument):
 
 
 
-	def get_readout_pulse(self):
+	def get_readout_pulse(self, while_running=None, n_rep=None, stats=None):
 		'''
-		 This function reformat the data reading the header contents.
+		 This function reformat the data reading the header contents
+		 (see rfSoC_acquisition). while_running is called once the sequence
+		 has started (see get_ping_pong_sweep). n_rep is the number of
+		 repetitions of the uploaded sequence if it is not n_rep().
 		'''
 
+		if n_rep is None:
+
+			if self.chunk_acquisition and self.n_rep() > self.first_chunk_rep:
+
+				return self.get_readout_pulse_chunked(while_running=while_running)
+
+			n_rep = self.n_rep()
+
 		self.reset_output_data()
 		mode = self.acquisition_mode()
-		n_rep = self.n_rep()
 		length_vec = self.length_vec
 		ch_vec = self.ch_vec
-		N_adc_events = len(ch_vec)
-		n_pulses = len(length_vec[0])
 
-		ch_active = self.ADC_ch_active
-		
 		if mode == 'IQ':
-			'''
-				Get data
-			'''
 
-			data_unsorted = {}
-			count_meas = 0
-			empty_packet_count = 0
-			run_num = 0
+			I,Q = rfa.acquire_IQ(self, n_rep, length_vec, ch_vec, self.ADC_ch_active,
+								 packet_pause=0.01, progress=self._IQ_progress(), while_running=while_running, stats=stats)
 
-			self.write("SEQ:START")
-			time.sleep(0.1)
+		elif mode == 'RAW':
 
-			getting_valid_dataset = True
+			self.reset_output_data()
 
-			if self.display_IQ_progress:
-
-				self.display_IQ_progress_bar = IntProgress(min=0, max=self.n_rep.get()) # instantiate the bar
-				display(self.display_IQ_progress_bar) # display the bar
-
-			while getting_valid_dataset:
-
-				while (count_meas//(16*N_adc_events))<self.n_rep.get():
-
-					a = datetime.datetime.now()
-
-					r = self.ask('OUTPUT:DATA?')
-
-					b = datetime.datetime.now()
-					# print('\nget data: ',b-a)
-
-					if r == 'ERR':
-
-						log.error('rfSoC: Instrument returned ERR!')
-
-						# reset measurement
-						data_unsorted = {}
-						count_meas = 0
-						empty_packet_count = 0
-						run_num = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
-
-						continue
-
-					elif len(r)>1:
-
-						a = datetime.datetime.now()
-						empty_packet_count = 0
-						data_unsorted['{}'.format(run_num)] = r
-						r_size = len(r)
-						count_meas += r_size
-						if self.display_IQ_progress:
-							self.display_IQ_progress_bar.value = count_meas//(16*N_adc_events)
-						run_num += 1
-						b = datetime.datetime.now()
-						# print('end storing: ',b-a)
-
-						time.sleep(0.01)
-
-
-					elif r == [3338] or r == [2573]: # new empty packet?
-
-						# log.warning('Received empty packet.')
-						empty_packet_count += 1
-						time.sleep(0.1)
-
-					if empty_packet_count>20:
-
-						log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.n_rep.get())+').')
-						
-						# reset measurement
-						data_unsorted = {}
-						count_meas = 0
-						empty_packet_count = 0
-						run_num = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
-
-						continue
-
-				if count_meas//(16*N_adc_events) == self.n_rep.get():
-
-					getting_valid_dataset = False
-
-				else:
-
-					log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.n_rep.get())+').')
-
-					# reset measurement
-					data_unsorted = []
-					count_meas = 0
-					empty_packet_count = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
-					self.write("SEQ:START")
-					time.sleep(0.1)
-
-			self.write("SEQ:STOP")
-
-			'''
-				Process data
-			'''
-
-			# data_unsorted = list(chain.from_iterable(data_unsorted.values()))
-			data_unsorted = functools.reduce(operator.iconcat, list(data_unsorted.values()), [])
-			data_unsorted = np.array(data_unsorted,dtype=int)
-
-			# separate header from IQ data
-			raw_IQ_data_dump_header = data_unsorted.reshape(int(len(data_unsorted)/8),8)[0::2]
-			raw_I_data_dump_data = data_unsorted.reshape(int(len(data_unsorted)/8),8)[1::2][:,0:4]
-			raw_Q_data_dump_data = data_unsorted.reshape(int(len(data_unsorted)/8),8)[1::2][:,4:8]
-
-			# extract channel number from first byte of header
-			ch_num = (raw_IQ_data_dump_header%256).T[0]
-
-			# extract number of accumulated points for normalization from 3rd to 6th byte of header 
-			num_points = np.frombuffer(np.stack((raw_IQ_data_dump_header.T[1], raw_IQ_data_dump_header.T[2]), axis=1).astype('int16').tobytes(), dtype=np.long)
-
-			# vectors indicating channel that the data originated from 
-			ch_1 = ch_num*(ch_num == np.ones(len(ch_num)))
-			ch_2 = ch_num*(ch_num == 2*np.ones(len(ch_num)))/2
-			ch_3 = ch_num*(ch_num == 3*np.ones(len(ch_num)))/3
-			ch_4 = ch_num*(ch_num == 4*np.ones(len(ch_num)))/4
-			ch_5 = ch_num*(ch_num == 5*np.ones(len(ch_num)))/5
-			ch_6 = ch_num*(ch_num == 6*np.ones(len(ch_num)))/6
-			ch_7 = ch_num*(ch_num == 7*np.ones(len(ch_num)))/7
-			ch_8 = ch_num*(ch_num == 8*np.ones(len(ch_num)))/8
-
-			# data conversion form four 16 bit integers to one 64 bit longlong (*(0.3838e-3/16))
-			I_all_data = 2 + np.frombuffer(raw_I_data_dump_data.astype('int16').tobytes(), dtype=np.longlong)*0.3838e-3/(16*num_points)
-			Q_all_data = 2 + np.frombuffer(raw_Q_data_dump_data.astype('int16').tobytes(), dtype=np.longlong)*0.3838e-3/(16*num_points)
-
-			I = [((I_all_data*ch_1)[I_all_data*ch_1!=0]-2).reshape(n_rep*ch_active[0],n_pulses).T,
-				 ((I_all_data*ch_2)[I_all_data*ch_2!=0]-2).reshape(n_rep*ch_active[1],n_pulses).T,
-				 ((I_all_data*ch_3)[I_all_data*ch_3!=0]-2).reshape(n_rep*ch_active[2],n_pulses).T,
-				 ((I_all_data*ch_4)[I_all_data*ch_4!=0]-2).reshape(n_rep*ch_active[3],n_pulses).T,
-				 ((I_all_data*ch_5)[I_all_data*ch_5!=0]-2).reshape(n_rep*ch_active[4],n_pulses).T,
-				 ((I_all_data*ch_6)[I_all_data*ch_6!=0]-2).reshape(n_rep*ch_active[5],n_pulses).T,
-				 ((I_all_data*ch_7)[I_all_data*ch_7!=0]-2).reshape(n_rep*ch_active[6],n_pulses).T,
-				 ((I_all_data*ch_8)[I_all_data*ch_8!=0]-2).reshape(n_rep*ch_active[7],n_pulses).T]
-			Q = [((Q_all_data*ch_1)[Q_all_data*ch_1!=0]-2).reshape(n_rep*ch_active[0],n_pulses).T,
-				 ((Q_all_data*ch_2)[Q_all_data*ch_2!=0]-2).reshape(n_rep*ch_active[1],n_pulses).T,
-				 ((Q_all_data*ch_3)[Q_all_data*ch_3!=0]-2).reshape(n_rep*ch_active[2],n_pulses).T,
-				 ((Q_all_data*ch_4)[Q_all_data*ch_4!=0]-2).reshape(n_rep*ch_active[3],n_pulses).T,
-				 ((Q_all_data*ch_5)[Q_all_data*ch_5!=0]-2).reshape(n_rep*ch_active[4],n_pulses).T,
-				 ((Q_all_data*ch_6)[Q_all_data*ch_6!=0]-2).reshape(n_rep*ch_active[5],n_pulses).T,
-				 ((Q_all_data*ch_7)[Q_all_data*ch_7!=0]-2).reshape(n_rep*ch_active[6],n_pulses).T,
-				 ((Q_all_data*ch_8)[Q_all_data*ch_8!=0]-2).reshape(n_rep*ch_active[7],n_pulses).T]
+			I,Q = rfa.acquire_RAW(self, n_rep, length_vec, while_running=while_running, stats=stats)
 
-		elif mode == 'RAW':
+		else:
 
+			log.error('rfSoC: Instrument mode not recognized.')
 
-			self.reset_output_data()
+		return I,Q
 
-			#for now we consider only the one same type of acq on all adc
-			mode=self.acquisition_mode.get()
 
-			N_adc_events=len(ch_vec)
+	def get_readout_pulse_chunked(self, merge=None, while_running=None, **merge_kwargs):
+		'''
+		 Acquire the n_rep() repetitions of the uploaded program as several
+		 shorter runs, changing only the loop count of the SEQ command, so
+		 that an error only restarts the current chunk. The chunk size
+		 adapts to the repetition rate and to the restarts (see
+		 rfSoC_acquisition.ChunkPlanner, kept in chunk_planner).
+
+		 merge is 'shots' (default in IQ mode, same result as
+		 get_readout_pulse), 'statistics' or 'histogram' in IQ mode and
+		 'average' (default in RAW mode); merge_kwargs go to the merger
+		 (e.g. bins and range of the histograms). merge can also be a merger
+		 (update(I, Q, n_rep) for each chunk, then result()), e.g. a
+		 rfSoC_dsp.CovarianceAccumulator.
+		'''
 
-			N_acq=np.sum(np.sum(length_vec))
+		if merge is None:
+			merge = 'average' if self.acquisition_mode() == 'RAW' else 'shots'
 
-			getting_valid_dataset = True
+		# the loop count is changed in the program last uploaded
+		sequence_str = self.sequence_str
+		if not isinstance(sequence_str, str):
+			raise ValueError('rfSoC: no program uploaded, run upload_program before a chunked acquisition.')
 
-			while getting_valid_dataset:
+		n_rep = self.n_rep()
+		planner = rfa.ChunkPlanner(n_rep, self.first_chunk_rep, self.chunk_target_time, max_chunk=self.max_chunk_rep)
+		merger = rfa.make_merger(merge, n_rep, **merge_kwargs) if isinstance(merge, str) else merge
+		self.chunk_planner = planner
 
-				adcdataI = [[],[],[],[],[],[],[],[]]
-				adcdataQ = [[],[],[],[],[],[],[],[]]
+		try:
 
-				rep=[]
+			while not planner.done:
 
-				keep_trying = True
-				empty_packet_count = 0
+				chunk = planner.next_chunk()
+				self.write(rfc.set_repetitions(sequence_str, chunk))
 
-				self.write("SEQ:START")
-				time.sleep(0.1)
+				stats = {}
+				start = time.perf_counter()
+				I, Q = self.get_readout_pulse(while_running=while_running, n_rep=chunk, stats=stats)
+				planner.update(chunk, time.perf_counter()-start, stats.get('restarts', 0))
+				merger.update(I, Q, chunk)
 
-				while keep_trying:
+				while_running = None
+				log.info('Chunk of {} repetitions ({}/{}), {} restarts'.format(chunk,planner.n_done,n_rep,stats.get('restarts', 0)))
 
-					r = self.ask('OUTPUT:DATA?')
+		finally:
 
-					if r == 'ERR':
+			# back to the uploaded program
+			self.write(sequence_str)
 
-						log.error('rfSoC: Instrument returned ERR!')
+		return merger.result()
 
-						# reset measurement
-						rep = []
-						empty_packet_count = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
 
-						continue
+	def get_PSD(self):
+		'''
+		 Welch power spectral density (V^2/Hz) of the RAW traces of the 8 ADC
+		 channels with PSD_segment_length, PSD_window and PSD_overlap, over
+		 the n_rep repetitions of the uploaded program. Each trace is added
+		 to the average as its packet is decoded, nothing else is kept
+		 (estimators in PSD_estimators). Channels without data give NaN.
+		'''
 
-					if len(r)>1:
+		if self.acquisition_mode() != 'RAW':
 
-						rep = rep+r
+			raise ValueError('rfSoC: the PSD is computed from RAW traces, set acquisition_mode to RAW.')
 
-					elif r==[3338] or r==[2573]:
+		estimators = [rfd.WelchPSD(self.PSD_segment_length(), self.PSD_window(), self.PSD_overlap(), self.ADC_sampling_rate(ch))
+					  for ch in range(1,9)]
 
-						empty_packet_count += 1
-						time.sleep(0.1)
+		def on_event(ch, I, Q):
+			estimators[ch-1].update(I)
 
-						if empty_packet_count>10:
+		def on_clear():
+			for estimator in estimators:
+				estimator.reset()
 
-							keep_trying = False
+		self.reset_output_data()
+		self.reset_output_data()
 
-				self.write("SEQ:STOP")
+		rfa.acquire_RAW_stream(self, self.n_rep(), self.length_vec, on_event, on_clear)
+		self.PSD_estimators = estimators
 
-				i=0
-				TSMEM=0
-				while (i + 8 )<= len(rep) : # at least one header left
+		for ch in range(1,9):
+			if self.length_vec[ch-1] and estimators[ch-1].n_segments == 0:
+				log.warning('rfSoC: ADC{} traces are shorter than PSD_segment_length.'.format(ch))
 
-					entete = np.array(rep[i:i+8])
-					X =entete.astype('int16').tobytes()
-					V = X[0]-1 # channel (1 to 8)
-					DSPTYPE = X[1]
-					#N does not have the same meaning depending on DSTYPE
-					N = struct.unpack('I',X[2:6])[0]
-					#number of acquisition points in continuous
-					#depends on the point length
-					NpCont = X[7]*256 + X[6]
-					TS= struct.unpack('Q',X[8:16])[0]
+		return [estimator.psd() for estimator in estimators]
 
-					# print the header for each packet
-					# print("Channel={}; N={}; DSP_type={}; TimeStamp={}; Np_Cont={}; Delta_TimeStamp={}".format(V,N,DSPTYPE,TS,NpCont,TS-TSMEM))
 
-					TSMEM=TS
+	def ADC_sampling_rate(self, ch):
 
-					iStart=i+8
-					# if not in continuous acq mode
-					if ((DSPTYPE &  0x2)!=2):
-						# raw adcdata for each Np points block
-						if ((DSPTYPE  &  0x1)==0):
-							Np=N
-							adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(rep[iStart:iStart+Np],4)*0.3838e-3))
+		return self.sampling_rate/(self.submodules['ADC{}'.format(ch)].decfact.get_latest() or 1)
 
-						#in the accumulation mode, only 1 I and Q point even w mixer OFF
-						#mixer ON or OFF
-						if ((DSPTYPE  & 0x01)==0x1):
-							Np=8
-							D=np.array(rep[iStart:iStart+Np])
-							X = D.astype('int16').tobytes()
 
-							#I  dvided N and 2 bcse signed 63 bits aligned to the left
-							# mod div by 4 to fix amplitude -Arpit, Martina
-							I=  struct.unpack('q',X[0:8])[0]*(0.3838e-3)/(N*2*4)
-							Q=  struct.unpack('q',X[8:16])[0]*(0.3838e-3)/(N*2*4)
+	def PSD_n_freq(self):
 
-							# print the point
-							# print("I/Q:",I,Q,"Amplitude:",np.sqrt(I*I+Q*Q),"Phase:",180*np.arctan2(I,Q)/np.pi)
+		return self.PSD_segment_length()//2 + 1
 
-							adcdataI[V]=np.append(adcdataI[V], I)
-							adcdataQ[V]=np.append(adcdataQ[V], Q)
 
+	def PSD_frequencies(self, ch):
 
-					#in our case we dont need the continuous mode for now
-					# continuoous acquisition mode with accumulation (reduce the flow of data)
-					elif ((DSPTYPE &  0x3)==0x3):
-						# mixer OFF : onlyI @2Gs/s or 250Ms/s
-						if ((DSPTYPE  & 0x20)==0x0):
-							# points are already averaged in the PS part
-							# format : 16int
-							Np = NpCont
-							adcdataI[V]=np.concatenate((adcdataI[V], np.right_shift(rep[iStart:iStart+Np],4)*0.3838e-3))
+		return np.fft.rfftfreq(self.PSD_segment_length(), 1/self.ADC_sampling_rate(ch))
 
-						# mixer ON : I and Q present
-						elif ((DSPTYPE  & 0x20)==0x20):
-							Np = NpCont
-							adcdataI[V]=np.concatenate((adcdataI[V],np.right_shift(rep[iStart:Np:2],4)*0.3838e-3))
-							adcdataQ[V]=np.concatenate((adcdataQ[V], np.right_shift(rep[iStart+1:Np:2],4)*0.3838e-3))
 
 
-					i = iStart+Np # index of the new data block, new header
+	def get_DDC(self, freqs, decimation=None, taps=None):
+		'''
+		 Software down conversion of the RAW traces of the 8 ADC channels at
+		 all the frequencies freqs (MHz, as fmixer) from a single acquisition
+		 of n_rep repetitions (see rfSoC_dsp.DDCBank), each pulse being
+		 demodulated as soon as its points are decoded.
+
+		 Returns amp, power: per channel and pulse, the complex amplitude of
+		 each tone averaged over the repetitions (shape (n_tones,), or
+		 (n_tones, n_out) decimated by decimation with the FIR taps) and the
+		 mean power of each tone in dBm (incoherent average, as
+		 ADC_power_dBm). Channels without data give empty lists.
+		'''
 
-				# print("********************************************************************")
-				# print(len(rep),"Pts treated in ",time.perf_counter()-tstart,"seconds")
-				# print("********************************************************************")
+		if self.acquisition_mode() != 'RAW':
 
-				#reshaping results
+			raise ValueError('rfSoC: the software DDC works on RAW traces, set acquisition_mode to RAW.')
 
-				points_rec = 0
-				points_expected = 0
+		n_rep = self.n_rep()
+		freqs = np.atleast_1d(freqs)*1e6
+		banks = [rfd.DDCBank(freqs, self.ADC_sampling_rate(ch), decimation, taps) for ch in range(1,9)]
+		amp_sum = [{} for ch in range(8)]
+		pow_sum = [{} for ch in range(8)]
 
-				for index in range(8):
+		def on_pulse(ch, pulse, trace):
+			z = banks[ch-1].demodulate(trace)
+			amp_sum[ch-1][pulse] = amp_sum[ch-1].get(pulse, 0) + z
+			pow_sum[ch-1][pulse] = pow_sum[ch-1].get(pulse, 0) + np.abs(z)**2
 
-					if len(adcdataI[index]) > 0:
+		assembler = rfa.PulseAssembler(self.length_vec, on_pulse)
 
-						points_rec += adcdataI[index].size
+		def on_clear():
+			assembler.clear()
+			for ch in range(8):
+				amp_sum[ch].clear()
+				pow_sum[ch].clear()
 
-					points_expected += int(self.n_rep() * np.sum(length_vec[index],dtype=int))
+		self.reset_output_data()
+		self.reset_output_data()
 
-				if points_rec == points_expected:
+		rfa.acquire_RAW_stream(self, n_rep, self.length_vec, lambda ch, I, Q: assembler.add(ch, I), on_clear)
 
-					getting_valid_dataset = False
+		# decimated traces: power averaged over the output points too
+		mean_pow = lambda p: p/n_rep if decimation is None else np.mean(p, axis=-1)/n_rep
 
-					adcdataI=[np.array(adcdataI[v]).reshape(self.n_rep.get(),np.sum(length_vec[v],dtype=int)) for v in range(8)]
+		amp = [[amp_sum[ch][pulse]/n_rep for pulse in sorted(amp_sum[ch])] for ch in range(8)]
+		power = [[10*np.log10(1e3*mean_pow(pow_sum[ch][pulse])/(50*2)) for pulse in sorted(pow_sum[ch])] for ch in range(8)]
 
-					# adcdataI=[np.array(adcdataI[v]).reshape(self.n_rep.get(),np.sum(np.sum(ch[v],dtype=int))) for v in range(8)]
-					adcdataI=[np.mean(adcdataI[v],axis=0) for v in range(8)]
+		if decimation is None:
+			amp = [np.array(a) for a in amp]
+			power = [np.array(p) for p in power]
 
-					adcdataI=np.array([np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))]) for v in range(8)])
+		return amp, power
 
-					I,Q = adcdataI,adcdataQ
 
-				else:
 
-					log.error('Data curruption: rfSoC did not send all data points({}/'.format(points_rec)+str(points_expected)+').')
+	def get_populations(self, discriminators=None, keep_shots=False):
+		'''
+		 Single shot readout of the n_rep repetitions of the uploaded program
+		 in IQ mode, each shot being classified (rfSoC_dsp.ThresholdDiscriminator
+		 or GaussianMixtureDiscriminator, one per channel in discriminators,
+		 self.discriminators by default) as soon as its repetition is
+		 decoded. Only counts are kept (see rfSoC_dsp.ShotCounter, kept in
+		 shot_counter with the shots if keep_shots).
+
+		 Returns the populations of each state per channel and pulse
+		 ({channel: (n_pulses, n_states)}) and the counts of the joint
+		 outcomes, one axis per (channel, pulse) of shot_counter.outcomes.
+		'''
 
-					# adcdataI=[np.mean(adcdataI[v],axis=0) for v in range(8)]
+		if discriminators is None:
+			discriminators = self.discriminators
 
-					# adcdataI=np.array([np.split(adcdataI[v],[sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))]) for v in range(8)])
+		if self.acquisition_mode() != 'IQ':
 
-					I,Q = adcdataI,adcdataQ
-					print(I,Q)
+			raise ValueError('rfSoC: shots are discriminated in IQ mode, set acquisition_mode to IQ.')
 
-		else:
+		for ch in discriminators:
+			if not self.ADC_ch_active[ch-1]:
+				raise ValueError('rfSoC: no readout on ADC{} in the uploaded program.'.format(ch))
 
-			log.error('rfSoC: Instrument mode not recognized.')
+		counter = rfd.ShotCounter(discriminators, self.n_pulses(min(discriminators)), keep_shots)
+		self.shot_counter = counter
 
-		return I,Q
+		self.reset_output_data()
 
+		rfa.acquire_IQ_stream(self, self.n_rep(), self.length_vec, self.ch_vec, self.ADC_ch_active,
+							  counter.update, counter.reset, packet_pause=0.01, progress=self._IQ_progress())
 
+		return counter.populations(), counter.joint_counts
 
-	def dump_raw_readout_pulse(self):
+
+
+	def get_covariance(self, channels=(1,2), order=2):
 		'''
-		 This function dumps raw data to drive to avoid RAM clogging.
+		 Moments of the IQ shots (I, Q of each of channels) of each pulse
+		 accumulated while the data is decoded (see
+		 rfSoC_dsp.CovarianceAccumulator), so that n_rep is not limited by
+		 the memory. With chunk_acquisition, the repetitions are acquired in
+		 chunks as in get_readout_pulse_chunked and an error only restarts
+		 the current chunk.
+
+		 Returns the accumulator: covariance(), covariance_error(), mean(),
+		 and cumulant(3 or 4) up to order.
 		'''
-		self.reset_output_data()
-		mode = self.acquisition_mode()
+
+		if self.acquisition_mode() != 'IQ':
+
+			raise ValueError('rfSoC: covariances are computed in IQ mode, set acquisition_mode to IQ.')
+
+		for ch in channels:
+			if not self.ADC_ch_active[ch-1]:
+				raise ValueError('rfSoC: no readout on ADC{} in the uploaded program.'.format(ch))
+
 		n_rep = self.n_rep()
-		length_vec = self.length_vec
-		ch_vec = self.ch_vec
-		N_adc_events = len(ch_vec)
-		n_pulses = len(length_vec[0])
-		location = self.raw_dump_location
+		moments = rfd.CovarianceAccumulator(channels, self.n_pulses(channels[0]), order)
 
-		ch_active = self.ADC_ch_active
-		
-		if mode == 'IQ':
-			'''
-				Get data
-			'''
+		if self.chunk_acquisition and n_rep > self.first_chunk_rep:
 
-			count_meas = 0
-			empty_packet_count = 0
-			run_num = 0
+			return self.get_readout_pulse_chunked(merge=moments)
 
-			self.write("SEQ:START")
-			time.sleep(0.1)
+		self.reset_output_data()
 
-			getting_valid_dataset = True
+		rfa.acquire_IQ_stream(self, n_rep, self.length_vec, self.ch_vec, self.ADC_ch_active,
+							  moments.update, moments.reset, packet_pause=0.01)
 
-			if self.display_IQ_progress:
+		return moments
 
-				self.display_IQ_progress_bar = IntProgress(min=0, max=self.n_rep.get()) # instantiate the bar
-				display(self.display_IQ_progress_bar) # display the bar
-
-			while getting_valid_dataset:
-
-				while (count_meas//(16*N_adc_events))<self.n_rep.get():
 
-					a = datetime.datetime.now()
 
-					r = self.ask('OUTPUT:DATA?')
+	def n_pulses(self, ch=1):
+		'''
+		 Number of readout pulses of ADC{ch} per repetition.
+		'''
 
-					b = datetime.datetime.now()
-					# print('\nget data: ',b-a)
+		return len(self.length_vec[ch-1])
 
-					if r == 'ERR':
 
-						log.error('rfSoC: Instrument returned ERR!')
+	def shot_reps(self):
+		'''
+		 Repetitions of the shots of ADC{ch}.I_shots and Q_shots: all the
+		 n_rep() repetitions, or those of the block being written by
+		 write_shots.
+		'''
 
-						# reset measurement
-						count_meas = 0
-						empty_packet_count = 0
-						run_num = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
+		if self._shot_reps is None:
+			return np.arange(self.n_rep())
 
-						continue
+		return self._shot_reps
 
-					elif len(r)>1:
 
-						a = datetime.datetime.now()
-						empty_packet_count = 0
-						r_size = len(r)
-						pk.dump(r, open(location+"/raw_"+str(run_num)+".pkl","wb"))
-						count_meas += r_size
-						if self.display_IQ_progress:
-							self.display_IQ_progress_bar.value = count_meas//(16*N_adc_events)
-						run_num += 1
-						b = datetime.datetime.now()
-						# print('end storing: ',b-a)
+	def register_shots(self, meas, channels=(1,), setpoints=(), paramtype='numeric'):
+		'''
+		 Register the I and Q shots of channels in the QCoDeS Measurement meas,
+		 on the setpoints (swept parameters) then ADC{ch}.pulse_index and
+		 ADC{ch}.rep_index, for write_shots. Each add_result of write_shots
+		 holds a block of (n_pulses(ch), chunk_size) shots, the last block of
+		 a point being shorter: with paramtype 'numeric' the dataset has one
+		 row per shot, with 'array' one row per block (qcodes only reads them
+		 back as one array if chunk_size divides n_rep). The setpoints are
+		 registered in meas first.
+		'''
 
-						time.sleep(0.01)
+		for ch in channels:
+			adc = self.submodules['ADC{}'.format(ch)]
+			for shots in (adc.I_shots, adc.Q_shots):
+				meas.register_parameter(shots, setpoints=setpoints, paramtype=paramtype)
 
 
-					elif r == [3338] or r == [2573]: # new empty packet?
+	def write_shots(self, datasaver, channels=(1,), chunk_size=10000, setpoint_values=()):
+		'''
+		 IQ acquisition of the n_rep() repetitions of the uploaded program
+		 written to the datasaver while it streams, chunk_size repetitions
+		 per add_result (see rfSoC_acquisition.ShotChunker), so that the
+		 memory used does not grow with n_rep and the database writes overlap
+		 the transfer. setpoint_values are the (parameter, value) of the
+		 swept parameters, as registered with register_shots. A restart of
+		 the acquisition does not write the same repetitions twice.
+		'''
+
+		if self.acquisition_mode() != 'IQ':
+
+			raise ValueError('rfSoC: shots are written in IQ mode, set acquisition_mode to IQ.')
+
+		for ch in channels:
+			if not self.ADC_ch_active[ch-1]:
+				raise ValueError('rfSoC: no readout on ADC{} in the uploaded program.'.format(ch))
 
-						# log.warning('Received empty packet.')
-						empty_packet_count += 1
-						time.sleep(0.1)
+		adcs = {ch: self.submodules['ADC{}'.format(ch)] for ch in channels}
 
-					if empty_packet_count>20:
+		# qcodes gets the pulse and repetition setpoints of each channel
+		# from ADC{ch}.pulse_index and rep_index, which follow the block
+		def on_chunk(first_rep, I, Q):
+			self._shot_reps = first_rep + np.arange(np.shape(I[channels[0]-1])[-1])
+			for ch, adc in adcs.items():
+				datasaver.add_result(*setpoint_values, (adc.I_shots, I[ch-1]), (adc.Q_shots, Q[ch-1]))
+
+		chunker = rfa.ShotChunker(chunk_size, on_chunk)
+
+		try:
+
+			self.reset_output_data()
 
-						log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.n_rep.get())+').')
-						
-						# reset measurement
-						count_meas = 0
-						empty_packet_count = 0
-						run_num = 0
-						self.write("SEQ:STOP")
-						time.sleep(2)
-						while True:
-							junk = self.ask('OUTPUT:DATA?')
-							# print(junk)
-							time.sleep(0.1)
-							if junk == [3338] or junk == [2573]:
-								break
-						junk = []
-						self.write("SEQ:START")
-						time.sleep(0.1)
+			rfa.acquire_IQ_stream(self, self.n_rep(), self.length_vec, self.ch_vec, self.ADC_ch_active,
+								  chunker.update, chunker.clear, packet_pause=0.01, progress=self._IQ_progress())
+			chunker.flush()
+
+		finally:
+
+			self._shot_reps = None
+
+		return chunker.n_out
+
+
+
+	def store_shots(self, store, point=0, datasaver=None):
+		'''
+		 IQ acquisition of the n_rep() repetitions of the uploaded program
+		 appended to the rfSoC_store.ShotStore store (or its location) under
+		 the sweep point index point while it streams, so that the shots are
+		 compressed on disk instead of kept in memory. With a datasaver, the
+		 dataset only keeps the location of the store (metadata
+		 rfSoC_shot_store). Returns the store: a store opened here from its
+		 location is closed (it can still be read), a store passed in is only
+		 flushed and stays open for the caller to close.
+
+		 The shots are appended: running the same point twice in the same
+		 store gives twice the repetitions under that point.
+		'''
 
-						continue
+		if self.acquisition_mode() != 'IQ':
 
-				if count_meas//(16*N_adc_events) == self.n_rep.get():
+			raise ValueError('rfSoC: shots are stored in IQ mode, set acquisition_mode to IQ.')
 
-					getting_valid_dataset = False
+		opened = isinstance(store, str)
+		if opened:
+			store = rfs.ShotStore(store)
 
-				else:
+		chunker = rfa.ShotChunker(store.chunk_reps, lambda first_rep, I, Q: store.append(I, Q, point))
 
-					log.error('Data curruption: rfSoC did not send all data points({}/'.format(count_meas//(16*N_adc_events))+str(self.n_rep.get())+').')
+		try:
+
+			self.reset_output_data()
+
+			rfa.acquire_IQ_stream(self, self.n_rep(), self.length_vec, self.ch_vec, self.ADC_ch_active,
+								  chunker.update, chunker.clear, packet_pause=0.01, progress=self._IQ_progress())
+			chunker.flush()
+
+		finally:
+
+			if opened:
+				store.close()
+			else:
+				store.flush()
+
+		if datasaver is not None:
+			datasaver.dataset.add_metadata('rfSoC_shot_store', os.path.abspath(store.location))
+
+		return store
+
+
+	def stream_continuous(self, channels, chunk_size, points=4096, max_chunks=16, policy='drop_oldest'):
+		'''
+		 Continuous acquisition on the ADC channels, streamed in chunks of
+		 chunk_size points per channel without stopping the sequence:
+
+			with rfsoc.stream_continuous([1,2], 2**16) as stream:
+				for ch, I, Q in stream:
+					...
+
+		 At most max_chunks chunks are kept while the consumer is busy, see
+		 rfSoC_acquisition.ContinuousStream for the backpressure policy.
+		 The uploaded program is written back when the stream is closed.
+		'''
+
+		self.reset_output_data()
+
+		return rfa.ContinuousStream(self, chunk_size, max_chunks, policy,
+									sequence_str=rfc.continuous_sequence(channels, points),
+									restore_str=self.sequence_str if isinstance(self.sequence_str, str) else None)
+
+
+	def _IQ_progress(self):
+		'''
+		Progress bar of the IQ acquisition, returns the function updating it.
+		'''
+
+		if not self.display_IQ_progress:
+			return None
+
+		self.display_IQ_progress_bar = IntProgress(min=0, max=self.n_rep.get()) # instantiate the bar
+		display(self.display_IQ_progress_bar) # display the bar
+
+		def progress(n_shots):
+			self.display_IQ_progress_bar.value = n_shots
+
+		return progress
+
+
+	def dump_raw_readout_pulse(self):
+		'''
+		 This function dumps raw data to drive to avoid RAM clogging.
+		'''
+		self.reset_output_data()
+		mode = self.acquisition_mode()
+		run_num = 0
+
+		if mode == 'IQ':
 
-					# reset measurement
-					data_unsorted = []
-					count_meas = 0
-					empty_packet_count = 0
-					self.write("SEQ:STOP")
-					time.sleep(2)
-					while True:
-						junk = self.ask('OUTPUT:DATA?')
-						# print(junk)
-						time.sleep(0.1)
-						if junk == [3338] or junk == [2573]:
-							break
-					junk = []
-					self.write("SEQ:START")
-					time.sleep(0.1)
-
-			self.write("SEQ:STOP")
+			run_num = rfa.receive_shots(self, self.n_rep(), len(self.ch_vec), rfa.PacketDumper(self.raw_dump_location),
+										packet_pause=0.01, progress=self._IQ_progress())
 
 		return run_num
 
@@ -1537,6 +1456,7 @@ class RFSoC(VisaInstrument):
 		b = datetime.datetime.now()
 		del_t = (b-a).seconds
 		speed = round(10*block_n/del_t,2)
+		self.link_throughput = speed*1e6
 		event_rate = round(1000*speed/32,2)
 		pulse_length = round(1000/event_rate,2)
 		print('Transfer speed: '+str(speed)+' MBps')
@@ -1556,20 +1476,7 @@ class RFSoC(VisaInstrument):
 				str: The instrument's response.
 			"""
 			with DelayedKeyboardInterrupt():
-				keep_trying = True
-				count = 0
-				while keep_trying:
-					count += 1
-					self.visa_log.debug(f"Querying: {cmd}")
-					try:
-						response = self.visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False)
-						self.visa_log.debug(f"Response: {response}")
-					except:
-						response = 'ERR'
-					if response != 'ERR' and response != [3338]:
-						keep_trying = False
-					if count>10:
-						keep_trying = False
+				response = rfa.query_binary(self.visa_handle, cmd, self.visa_log)
 
 			return response
 
@@ -0,0 +1,1242 @@
+# Acquisition core shared by the rfSoC drivers (rfSoC.RFSoC and
+# driver_rfsoc.RFSoC).
+# Reads the OUTPUT:DATA? packets sent by the instrument into a preallocated
+# buffer, restarts the sequence when the instrument returns an error or stops
+# sending data, and decodes the accumulated (IQ) and raw ADC data.
+# It only needs the write and ask methods of the instrument.
+
+
+
+
+
+import time
+import struct
+import queue
+import threading
+import pickle as pk
+import json
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+# packets sent by OUTPUT:DATA? when there is no data to read
+EMPTY_PACKETS = ([3338], [2573])
+
+# 16 bits words of an accumulated (IQ) ADC event: 8 words of header, 4
+# words for I and 4 words for Q
+IQ_EVENT_WORDS = 16
+HEADER_WORDS = 8
+
+# conversion of the ADC values into volts
+ADC_SCALE = 0.3838e-3
+
+
+
+def is_empty(packet):
+
+	return packet == EMPTY_PACKETS[0] or packet == EMPTY_PACKETS[1]
+
+
+def query_binary(visa_handle, cmd, visa_log=None, retries=10):
+	'''
+	Binary query of the instrument, repeated while it answers with an error
+	or an empty packet (at most retries times). Returns the list of 16 bits
+	words or 'ERR'.
+	'''
+
+	for count in range(retries+1):
+
+		if visa_log is not None:
+			visa_log.debug(f"Querying: {cmd}")
+
+		try:
+			response = visa_handle.query_binary_values(cmd, datatype="h", is_big_endian=False)
+			if visa_log is not None:
+				visa_log.debug(f"Response: {response}")
+		except:
+			response = 'ERR'
+
+		if response != 'ERR' and response != EMPTY_PACKETS[0]:
+			break
+
+	return response
+
+
+def recover(instrument):
+	'''
+	Stop the sequence, drop the data still in the instrument and start the
+	sequence again.
+	'''
+
+	instrument.write("SEQ:STOP")
+	time.sleep(2)
+
+	while True:
+		junk = instrument.ask('OUTPUT:DATA?')
+		time.sleep(0.1)
+		if is_empty(junk):
+			break
+
+	instrument.write("SEQ:START")
+	time.sleep(0.1)
+
+
+
+def restart(instrument, sink, stats=None):
+	'''
+	Drop the data received so far and restart the sequence (see recover),
+	counting the restarts in stats['restarts'] if a dict is given.
+	'''
+
+	sink.clear()
+	recover(instrument)
+
+	if stats is not None:
+		stats['restarts'] = stats.get('restarts', 0) + 1
+
+
+
+class PacketBuffer:
+	'''
+	Growing int16 buffer receiving the packets of one acquisition, allocated
+	once for the expected number of words.
+	'''
+
+	def __init__(self, size=0):
+
+		self._data = np.empty(max(int(size), 1024), dtype=np.int16)
+		self.n_words = 0
+		self.n_packets = 0
+
+
+	def append(self, packet):
+
+		n = len(packet)
+
+		if self.n_words + n > len(self._data):
+			data = np.empty(max(2*len(self._data), self.n_words + n), dtype=np.int16)
+			data[:self.n_words] = self._data[:self.n_words]
+			self._data = data
+
+		self._data[self.n_words:self.n_words+n] = packet
+		self.n_words += n
+		self.n_packets += 1
+
+
+	def clear(self):
+
+		self.n_words = 0
+		self.n_packets = 0
+
+
+	@property
+	def data(self):
+
+		return self._data[:self.n_words]
+
+
+
+class PacketDumper:
+	'''
+	Packet sink writing each packet to location/raw_<packet number>.pkl
+	instead of keeping it in memory.
+	'''
+
+	def __init__(self, location):
+
+		self.location = location
+		self.n_words = 0
+		self.n_packets = 0
+
+
+	def append(self, packet):
+
+		with open(self.location+"/raw_"+str(self.n_packets)+".pkl", "wb") as f:
+			pk.dump(packet, f)
+
+		self.n_words += len(packet)
+		self.n_packets += 1
+
+
+	def clear(self):
+
+		self.n_words = 0
+		self.n_packets = 0
+
+
+
+class CaptureRecorder:
+	'''
+	Instrument wrapper recording the answers to OUTPUT:DATA? (packets or
+	'ERR') during an acquisition, e.g. acquire_IQ(CaptureRecorder(rfsoc),
+	...), saved as json with save. Captures are replayed by CaptureReplay.
+	'''
+
+	def __init__(self, instrument):
+
+		self.instrument = instrument
+		self.packets = []
+
+
+	def write(self, cmd):
+
+		self.instrument.write(cmd)
+
+
+	def ask(self, cmd):
+
+		r = self.instrument.ask(cmd)
+
+		if cmd == 'OUTPUT:DATA?':
+			self.packets.append(r if r == 'ERR' else [int(w) for w in r])
+
+		return r
+
+
+	def save(self, path, **meta):
+		'''
+		Write the capture to path, with the acquisition settings in meta
+		(n_rep, length_vec, ...).
+		'''
+
+		with open(path, 'w') as f:
+			json.dump(dict(meta, packets=self.packets), f)
+
+
+
+class CaptureReplay:
+	'''
+	Instrument answering OUTPUT:DATA? with the packets of a capture (see
+	CaptureRecorder), then with empty packets. The commands written are
+	kept in writes.
+	'''
+
+	def __init__(self, packets):
+
+		self.packets = list(packets)
+		self.writes = []
+
+
+	@classmethod
+	def load(cls, path):
+		'''
+		Replay of the capture saved in path, and its meta data.
+		'''
+
+		with open(path) as f:
+			capture = json.load(f)
+
+		return cls(capture.pop('packets')), capture
+
+
+	def write(self, cmd):
+
+		self.writes.append(cmd)
+
+
+	def ask(self, cmd):
+
+		return self.packets.pop(0) if len(self.packets)>0 else EMPTY_PACKETS[0]
+
+
+
+def receive_shots(instrument, n_rep, N_adc_events, sink, empty_limit=20, empty_pause=0.1,
+				  packet_pause=0., progress=None, while_running=None, stats=None):
+	'''
+	Run the sequence until the n_rep repetitions of the N_adc_events
+	accumulated events are received in sink (PacketBuffer, PacketDumper or
+	ShotDecodingSink).
+
+	The acquisition starts over (see recover) when the instrument returns
+	an error, sends more than empty_limit empty packets in a row or more
+	data than expected. progress is called with the number of repetitions
+	received after each packet. while_running is called once the sequence
+	has started, for work overlapping the acquisition. Restarts are
+	counted in the stats dict if given.
+	'''
+
+	words_per_rep = IQ_EVENT_WORDS*N_adc_events
+	empty_packet_count = 0
+	sink.clear()
+
+	instrument.write("SEQ:START")
+	time.sleep(0.1)
+
+	if while_running is not None:
+		while_running()
+
+	while True:
+
+		while sink.n_words//words_per_rep < n_rep:
+
+			r = instrument.ask('OUTPUT:DATA?')
+
+			if r == 'ERR':
+
+				log.error('rfSoC: Instrument returned ERR!')
+
+				empty_packet_count = 0
+				restart(instrument, sink, stats)
+
+				continue
+
+			elif len(r)>1:
+
+				empty_packet_count = 0
+				sink.append(r)
+
+				if progress is not None:
+					progress(sink.n_words//words_per_rep)
+
+				if packet_pause:
+					time.sleep(packet_pause)
+
+			elif is_empty(r):
+
+				empty_packet_count += 1
+				time.sleep(empty_pause)
+
+			if empty_packet_count>empty_limit:
+
+				log.error('Data curruption: rfSoC did not send all data points({}/{}).'.format(sink.n_words//words_per_rep, n_rep))
+
+				empty_packet_count = 0
+				restart(instrument, sink, stats)
+
+		if sink.n_words == n_rep*words_per_rep:
+
+			break
+
+		log.error('Data curruption: rfSoC did not send all data points({}/{}).'.format(sink.n_words//words_per_rep, n_rep))
+
+		empty_packet_count = 0
+		restart(instrument, sink, stats)
+
+	instrument.write("SEQ:STOP")
+
+	return sink.n_packets
+
+
+def receive_until_idle(instrument, sink, empty_limit=10, empty_pause=0.1, while_running=None, stats=None):
+	'''
+	Run the sequence and receive packets in sink until the instrument sent
+	more than empty_limit empty packets. Used in RAW mode, where the amount
+	of data depends on the headers. while_running and stats as in
+	receive_shots.
+	'''
+
+	empty_packet_count = 0
+	sink.clear()
+
+	instrument.write("SEQ:START")
+	time.sleep(0.1)
+
+	if while_running is not None:
+		while_running()
+
+	while empty_packet_count<=empty_limit:
+
+		r = instrument.ask('OUTPUT:DATA?')
+
+		if r == 'ERR':
+
+			log.error('rfSoC: Instrument returned ERR!')
+
+			empty_packet_count = 0
+			restart(instrument, sink, stats)
+
+		elif len(r)>1:
+
+			sink.append(r)
+
+		elif is_empty(r):
+
+			empty_packet_count += 1
+			time.sleep(empty_pause)
+
+	instrument.write("SEQ:STOP")
+
+	return sink.n_packets
+
+
+
+def decode_IQ(data, n_rep, n_pulses, ch_active):
+	'''
+	Decode accumulated events (header row then I/Q row of 8 words each).
+	n_pulses is the number of events of each channel per repetition (a
+	list of 8, or one number for all channels).
+
+	Returns the lists I and Q of the 8 ADC channels, each of shape
+	(n_pulses[ch], n_rep*ch_active[ch]) in volts.
+	'''
+
+	n_pulses = np.broadcast_to(n_pulses, 8)
+
+	rows = np.asarray(data, dtype=np.int16).reshape(-1, HEADER_WORDS)
+	header = rows[0::2]
+	payload = np.ascontiguousarray(rows[1::2])
+
+	# channel number in the first byte of the header
+	ch_num = header[:,0].astype(np.int64) % 256
+
+	# number of accumulated points in the 3rd to 6th bytes of the header
+	num_points = np.ascontiguousarray(header[:,1:3]).view(np.int32)[:,0].astype(np.int64)
+
+	# four 16 bits words make one 64 bits integer
+	I_all_data = payload[:,0:4].copy().view(np.int64)[:,0]*ADC_SCALE/(16*num_points)
+	Q_all_data = payload[:,4:8].copy().view(np.int64)[:,0]*ADC_SCALE/(16*num_points)
+
+	I = []
+	Q = []
+	for ch in range(8):
+		selected = ch_num == ch+1
+		I.append(I_all_data[selected].reshape(n_rep*int(ch_active[ch]), n_pulses[ch]).T)
+		Q.append(Q_all_data[selected].reshape(n_rep*int(ch_active[ch]), n_pulses[ch]).T)
+
+	return I, Q
+
+
+def split_RAW(data, complete_only=False):
+	'''
+	Walk through the headers of raw mode data and return the lists of the
+	point arrays received on each of the 8 channels for I and Q (raw
+	samples, accumulated I/Q points or continuous mode points), and the
+	number of words read. With complete_only, an event whose points are
+	not all in data is left for the next call (see StreamDecoder).
+	'''
+
+	data = np.asarray(data, dtype=np.int16)
+	raw = data.tobytes()
+
+	adcdataI = [[] for v in range(8)]
+	adcdataQ = [[] for v in range(8)]
+
+	i = 0
+	while i + HEADER_WORDS <= len(data): # at least one header left
+
+		X = raw[2*i:2*i+2*HEADER_WORDS]
+		V = X[0]-1 # channel (1 to 8)
+		DSPTYPE = X[1]
+		#N does not have the same meaning depending on DSTYPE
+		N = struct.unpack('I', X[2:6])[0]
+		#number of acquisition points in continuous mode
+		NpCont = X[7]*256 + X[6]
+
+		iStart = i + HEADER_WORDS
+
+		# if not in continuous acq mode
+		if (DSPTYPE & 0x2)!=2:
+			#in the accumulation mode, only 1 I and Q point even w mixer OFF
+			Np = N if (DSPTYPE & 0x1)==0 else 8
+
+		# continuous acquisition mode with accumulation
+		elif (DSPTYPE & 0x3)==0x3:
+			Np = NpCont
+
+		else:
+			log.error('rfSoC: unknown DSP type {} in data header.'.format(DSPTYPE))
+			i = len(data)
+			break
+
+		if complete_only and iStart + Np > len(data):
+			break
+
+		if (DSPTYPE & 0x2)!=2:
+
+			# raw adcdata for each Np points block
+			if (DSPTYPE & 0x1)==0:
+				adcdataI[V].append(np.right_shift(data[iStart:iStart+Np], 4)*ADC_SCALE)
+
+			else:
+				#I divided by N and 2 bcse signed 63 bits aligned to the left
+				#and by 4 to fix amplitude
+				I_point, Q_point = struct.unpack('qq', raw[2*iStart:2*iStart+16])
+				adcdataI[V].append(np.array([I_point*ADC_SCALE/(N*2*4)]))
+				adcdataQ[V].append(np.array([Q_point*ADC_SCALE/(N*2*4)]))
+
+		# mixer OFF : only I, already averaged in the PS part
+		elif (DSPTYPE & 0x20)==0x0:
+			adcdataI[V].append(np.right_shift(data[iStart:iStart+Np], 4)*ADC_SCALE)
+
+		# mixer ON : I and Q interleaved
+		else:
+			adcdataI[V].append(np.right_shift(data[iStart:iStart+Np:2], 4)*ADC_SCALE)
+			adcdataQ[V].append(np.right_shift(data[iStart+1:iStart+Np:2], 4)*ADC_SCALE)
+
+		i = iStart + Np # index of the new data block, new header
+
+	return adcdataI, adcdataQ, min(i, len(data))
+
+
+def decode_RAW(data):
+	'''
+	Points received on each of the 8 channels in raw mode data, as the lists
+	adcdataI and adcdataQ (see split_RAW).
+	'''
+
+	adcdataI, adcdataQ, n_words = split_RAW(data)
+
+	adcdataI = [np.concatenate(points) if len(points)>0 else [] for points in adcdataI]
+	adcdataQ = [np.concatenate(points) if len(points)>0 else [] for points in adcdataQ]
+
+	return adcdataI, adcdataQ
+
+
+def average_RAW(adcdataI, n_rep, length_vec):
+	'''
+	Average raw traces over the n_rep repetitions and split them into the
+	pulses of each channel.
+	'''
+
+	adcdataI = [np.mean(np.array(adcdataI[v]).reshape(n_rep, np.sum(length_vec[v], dtype=int)), axis=0) for v in range(8)]
+	splits = [np.split(adcdataI[v], [sum(length_vec[v][0:i+1]) for i in range(len(length_vec[v]))]) for v in range(8)]
+
+	if len(set(tuple(len(pulse) for pulse in splits[v]) for v in range(8))) == 1:
+		return np.array(splits)
+
+	# pulses of different lengths: one list of pulses per channel
+	ragged = np.empty(8, dtype=object)
+	for v in range(8):
+		ragged[v] = splits[v]
+
+	return ragged
+
+
+def acquire_IQ(instrument, n_rep, length_vec, ch_vec, ch_active, **kwargs):
+	'''
+	Accumulated (IQ) acquisition of n_rep repetitions of the sequence,
+	keyword arguments are passed to receive_shots.
+	'''
+
+	N_adc_events = len(ch_vec)
+	n_pulses = [len(lengths) for lengths in length_vec]
+
+	buffer = PacketBuffer(n_rep*IQ_EVENT_WORDS*N_adc_events)
+	receive_shots(instrument, n_rep, N_adc_events, buffer, **kwargs)
+
+	return decode_IQ(buffer.data, n_rep, n_pulses, ch_active)
+
+
+def acquire_IQ_stream(instrument, n_rep, length_vec, ch_vec, ch_active, on_shots, on_clear=None, **kwargs):
+	'''
+	Accumulated (IQ) acquisition of n_rep repetitions of the sequence
+	decoded while the packets arrive (see ShotDecodingSink), keyword
+	arguments are passed to receive_shots.
+	'''
+
+	N_adc_events = len(ch_vec)
+	n_pulses = [len(lengths) for lengths in length_vec]
+
+	sink = ShotDecodingSink(N_adc_events, n_pulses, ch_active, on_shots, on_clear)
+	receive_shots(instrument, n_rep, N_adc_events, sink, **kwargs)
+
+	return sink.n_rep
+
+
+
+def acquire_RAW(instrument, n_rep, length_vec, **kwargs):
+	'''
+	Raw acquisition of n_rep repetitions of the sequence, repeated until all
+	the expected points are received. Returns the traces averaged over the
+	repetitions (see average_RAW) and the Q points. Keyword arguments are
+	passed to receive_until_idle.
+	'''
+
+	points_expected = sum(int(n_rep*np.sum(length_vec[v], dtype=int)) for v in range(8))
+	buffer = PacketBuffer(points_expected)
+
+	while True:
+
+		receive_until_idle(instrument, buffer, **kwargs)
+		adcdataI, adcdataQ = decode_RAW(buffer.data)
+
+		# work overlapping the acquisition is done only once
+		kwargs['while_running'] = None
+
+		points_rec = sum(len(adcdataI[v]) for v in range(8))
+
+		if points_rec == points_expected:
+
+			return average_RAW(adcdataI, n_rep, length_vec), adcdataQ
+
+		log.error('Data curruption: rfSoC did not send all data points({}/{}).'.format(points_rec, points_expected))
+
+		if kwargs.get('stats') is not None:
+			kwargs['stats']['restarts'] = kwargs['stats'].get('restarts', 0) + 1
+
+
+
+
+def acquire_RAW_stream(instrument, n_rep, length_vec, on_event, on_clear=None, **kwargs):
+	'''
+	Raw acquisition of n_rep repetitions of the sequence decoded while the
+	packets arrive, each event being passed to on_event (see DecodingSink),
+	repeated (after on_clear) until all the expected points are received.
+	Keyword arguments are passed to receive_until_idle.
+	'''
+
+	points_expected = sum(int(n_rep*np.sum(length_vec[v], dtype=int)) for v in range(8))
+	sink = DecodingSink(on_event, on_clear)
+
+	while True:
+
+		receive_until_idle(instrument, sink, **kwargs)
+		kwargs['while_running'] = None
+
+		if sink.n_points == points_expected:
+
+			return sink.n_points
+
+		log.error('Data curruption: rfSoC did not send all data points({}/{}).'.format(sink.n_points, points_expected))
+
+		if kwargs.get('stats') is not None:
+			kwargs['stats']['restarts'] = kwargs['stats'].get('restarts', 0) + 1
+
+
+
+class ChunkPlanner:
+	'''
+	Splits a long acquisition of n_rep repetitions into chunks, each run
+	with its own SEQ:START. The chunk size grows (at most doubling) towards
+	target_time seconds per chunk at the observed repetition rate, and is
+	halved after a chunk that needed restarts, so that an error costs
+	little acquisition time.
+	'''
+
+	def __init__(self, n_rep, first_chunk=1000, target_time=10., min_chunk=1, max_chunk=None):
+
+		self.n_rep = int(n_rep)
+		self.chunk = max(int(first_chunk), min_chunk)
+		self.target_time = target_time
+		self.min_chunk = min_chunk
+		self.max_chunk = max_chunk
+		self.n_done = 0
+		self.n_chunks = 0
+		self.restarts = 0
+		self.rep_rate = None
+
+
+	@property
+	def done(self):
+
+		return self.n_done >= self.n_rep
+
+
+	def next_chunk(self):
+
+		chunk = self.chunk if self.max_chunk is None else min(self.chunk, self.max_chunk)
+
+		return min(chunk, self.n_rep - self.n_done)
+
+
+	def update(self, n_rep, duration, restarts=0):
+		'''
+		Record a chunk of n_rep repetitions acquired in duration seconds
+		with restarts restarts, and choose the size of the next one.
+		'''
+
+		self.n_done += n_rep
+		self.n_chunks += 1
+		self.restarts += restarts
+
+		if restarts > 0:
+
+			self.chunk = max(self.min_chunk, self.chunk//2)
+			return
+
+		if duration > 0:
+
+			self.rep_rate = n_rep/duration
+			self.chunk = int(np.clip(self.rep_rate*self.target_time, self.min_chunk, 2*self.chunk))
+
+
+
+class ShotMerger:
+	'''
+	Concatenates the IQ shots of the chunks into the arrays a single
+	acquisition of n_rep repetitions returns (see decode_IQ).
+	'''
+
+	def __init__(self, n_rep):
+
+		self.n_rep = n_rep
+		self.n_done = 0
+		self.I = None
+		self.Q = None
+
+
+	def update(self, I, Q, n_rep):
+
+		if self.I is None:
+			self.I = [np.empty((len(I[ch]), self.n_rep*(I[ch].shape[1]//n_rep))) for ch in range(8)]
+			self.Q = [np.empty((len(Q[ch]), self.n_rep*(Q[ch].shape[1]//n_rep))) for ch in range(8)]
+
+		for ch in range(8):
+			per_rep = I[ch].shape[1]//n_rep
+			self.I[ch][:,self.n_done*per_rep:(self.n_done+n_rep)*per_rep] = I[ch]
+			self.Q[ch][:,self.n_done*per_rep:(self.n_done+n_rep)*per_rep] = Q[ch]
+
+		self.n_done += n_rep
+
+
+	def result(self):
+
+		return self.I, self.Q
+
+
+
+class StatisticsMerger:
+	'''
+	Running mean and variance of the IQ shots of each channel and pulse,
+	merged chunk by chunk without keeping the shots.
+	'''
+
+	def __init__(self, n_rep=None):
+
+		self.n = 0
+		self.mean = None
+		self.M2 = None
+
+
+	def update(self, I, Q, n_rep):
+
+		# one (2, n_pulses) array of I and Q moments per channel
+		shots = [np.stack((I[ch], Q[ch])) for ch in range(8)]
+		n_new = max(shots[ch].shape[2] for ch in range(8))
+		if n_new == 0:
+			return
+
+		mean_new = [shots[ch].mean(axis=2) if shots[ch].shape[2]>0 else np.zeros(shots[ch].shape[:2]) for ch in range(8)]
+		M2_new = [((shots[ch]-mean_new[ch][...,None])**2).sum(axis=2) for ch in range(8)]
+
+		if self.mean is None:
+
+			self.n, self.mean, self.M2 = n_new, mean_new, M2_new
+			return
+
+		n = self.n + n_new
+		for ch in range(8):
+			delta = mean_new[ch] - self.mean[ch]
+			self.mean[ch] = self.mean[ch] + delta*n_new/n
+			self.M2[ch] = self.M2[ch] + M2_new[ch] + delta**2*self.n*n_new/n
+		self.n = n
+
+
+	def result(self):
+		'''
+		Number of shots per channel and pulse, mean and standard deviation
+		of I and Q of each channel (arrays of n_pulses values).
+		'''
+
+		return dict(n=self.n,
+					I_mean=[self.mean[ch][0] for ch in range(8)],
+					Q_mean=[self.mean[ch][1] for ch in range(8)],
+					I_std=[np.sqrt(self.M2[ch][0]/max(self.n-1,1)) for ch in range(8)],
+					Q_std=[np.sqrt(self.M2[ch][1]/max(self.n-1,1)) for ch in range(8)])
+
+
+
+class HistogramMerger:
+	'''
+	IQ histograms of each channel and pulse, accumulated chunk by chunk.
+	Without range the bins cover the shots of the first chunk with a 50%
+	margin, later shots outside the range are not counted.
+	'''
+
+	def __init__(self, n_rep=None, bins=100, range=None):
+
+		self.bins = bins
+		self.range = range
+		self.counts = None
+		self.edges = None
+
+
+	def update(self, I, Q, n_rep):
+
+		if self.counts is None:
+
+			self.edges = []
+			for ch in range(8):
+				if self.range is not None:
+					(I_min, I_max), (Q_min, Q_max) = self.range
+				elif I[ch].size > 0:
+					I_min, I_max, Q_min, Q_max = I[ch].min(), I[ch].max(), Q[ch].min(), Q[ch].max()
+					I_min, I_max = I_min-(I_max-I_min)/2, I_max+(I_max-I_min)/2
+					Q_min, Q_max = Q_min-(Q_max-Q_min)/2, Q_max+(Q_max-Q_min)/2
+				else:
+					I_min, I_max, Q_min, Q_max = -1., 1., -1., 1.
+				self.edges.append((np.linspace(I_min, I_max, self.bins+1), np.linspace(Q_min, Q_max, self.bins+1)))
+			self.counts = [np.zeros((len(I[ch]), self.bins, self.bins), dtype=np.int64) for ch in range(8)]
+
+		for ch in range(8):
+			for pulse in range(len(I[ch])):
+				self.counts[ch][pulse] += np.histogram2d(I[ch][pulse], Q[ch][pulse], bins=self.edges[ch])[0].astype(np.int64)
+
+
+	def result(self):
+		'''
+		Counts of each channel ((n_pulses, bins, bins) arrays, I along the
+		first axis) and the (I, Q) bin edges of each channel.
+		'''
+
+		return dict(counts=self.counts, edges=self.edges)
+
+
+
+class TraceAverageMerger:
+	'''
+	Average of the averaged RAW traces of the chunks (see acquire_RAW),
+	weighted by their number of repetitions. The Q points are concatenated.
+	'''
+
+	def __init__(self, n_rep=None):
+
+		self.n = 0
+		self.sum = None
+		self.Q = [[] for v in range(8)]
+
+
+	def update(self, I, Q, n_rep):
+
+		if self.sum is None:
+			self.sum = [[np.array(pulse, dtype=float)*n_rep for pulse in I[v]] for v in range(8)]
+		else:
+			for v in range(8):
+				for k, pulse in enumerate(I[v]):
+					self.sum[v][k] += np.asarray(pulse)*n_rep
+
+		for v in range(8):
+			if len(Q[v]) > 0:
+				self.Q[v] = np.concatenate((self.Q[v], Q[v]))
+
+		self.n += n_rep
+
+
+	def result(self):
+
+		return [[pulse/self.n for pulse in self.sum[v]] for v in range(8)], self.Q
+
+
+
+MERGERS = {'shots': ShotMerger,
+		   'statistics': StatisticsMerger,
+		   'histogram': HistogramMerger,
+		   'average': TraceAverageMerger}
+
+
+def make_merger(merge, n_rep, **kwargs):
+	'''
+	Merger of the chunks of a chunked acquisition: 'shots', 'statistics',
+	'histogram' (IQ mode) or 'average' (RAW mode).
+	'''
+
+	if merge not in MERGERS:
+		raise ValueError('Unknown merge mode {}, use one of {}.'.format(merge, ', '.join(MERGERS)))
+
+	return MERGERS[merge](n_rep, **kwargs)
+
+
+
+
+class StreamDecoder:
+	'''
+	Incremental version of decode_RAW for a continuous stream of packets:
+	the words of an event split over two packets are kept until its end
+	arrives. feed returns the (I, Q) point arrays of each channel decoded
+	from the new packet (Q is None without Q points).
+	'''
+
+	def __init__(self):
+
+		self.leftover = np.zeros(0, dtype=np.int16)
+
+
+	def feed(self, packet):
+
+		points = {}
+		for ch, (I, Q) in self.feed_events(packet).items():
+			points[ch] = (np.concatenate(I), np.concatenate(Q) if len(Q)>0 else None)
+
+		return points
+
+
+	def feed_events(self, packet):
+		'''
+		Same as feed with the points of each event kept apart:
+		{channel: (list of I arrays, list of Q arrays)}.
+		'''
+
+		data = np.concatenate((self.leftover, np.asarray(packet, dtype=np.int16)))
+		adcdataI, adcdataQ, n_words = split_RAW(data, complete_only=True)
+		self.leftover = data[n_words:]
+
+		return {v+1: (adcdataI[v], adcdataQ[v]) for v in range(8) if len(adcdataI[v])>0}
+
+
+
+class DecodingSink:
+	'''
+	Packet sink decoding raw mode packets as they arrive (StreamDecoder)
+	and passing the points of each event to on_event(channel, I, Q), Q
+	being None without Q points, instead of keeping the packets. on_clear
+	is called when the acquisition restarts.
+	'''
+
+	def __init__(self, on_event, on_clear=None):
+
+		self.on_event = on_event
+		self.on_clear = on_clear
+		self.clear()
+
+
+	def append(self, packet):
+
+		self.n_words += len(packet)
+		self.n_packets += 1
+
+		for ch, (I, Q) in self.decoder.feed_events(packet).items():
+			for k in range(len(I)):
+				self.n_points += len(I[k])
+				self.on_event(ch, I[k], Q[k] if k < len(Q) else None)
+
+
+	def clear(self):
+
+		self.n_words = 0
+		self.n_packets = 0
+		self.n_points = 0
+		self.decoder = StreamDecoder()
+
+		if self.on_clear is not None:
+			self.on_clear()
+
+
+
+class ShotDecodingSink:
+	'''
+	Packet sink decoding accumulated (IQ) packets as they arrive: the
+	complete repetitions received are decoded (decode_IQ) and passed to
+	on_shots(I, Q), I and Q being the lists of the shots of the 8 channels
+	of shape (n_pulses[ch], n_rep_block*ch_active[ch]). The words of an
+	incomplete repetition are kept for the next packet. on_clear is called
+	when the acquisition restarts.
+	'''
+
+	def __init__(self, N_adc_events, n_pulses, ch_active, on_shots, on_clear=None):
+
+		self.words_per_rep = IQ_EVENT_WORDS*N_adc_events
+		self.n_pulses = n_pulses
+		self.ch_active = ch_active
+		self.on_shots = on_shots
+		self.on_clear = on_clear
+		self.clear()
+
+
+	def append(self, packet):
+
+		self.n_words += len(packet)
+		self.n_packets += 1
+
+		data = np.concatenate((self.leftover, np.asarray(packet, dtype=np.int16)))
+		n_block = len(data)//self.words_per_rep
+		self.leftover = data[n_block*self.words_per_rep:]
+
+		if n_block > 0:
+
+			self.n_rep += n_block
+			I, Q = decode_IQ(data[:n_block*self.words_per_rep], n_block, self.n_pulses, self.ch_active)
+			self.on_shots(I, Q)
+
+
+	def clear(self):
+
+		self.n_words = 0
+		self.n_packets = 0
+		self.n_rep = 0
+		self.leftover = np.zeros(0, dtype=np.int16)
+
+		if self.on_clear is not None:
+			self.on_clear()
+
+
+
+class ShotChunker:
+	'''
+	Regroups the shots passed to update (on_shots of a ShotDecodingSink)
+	into chunks of chunk_size repetitions passed to on_chunk(first_rep, I,
+	Q), I and Q being lists of 8 arrays of shape (n_pulses, n). flush
+	passes the last, shorter, chunk. When the acquisition restarts (clear)
+	the repetitions already passed are skipped, so that each repetition is
+	passed once.
+	'''
+
+	def __init__(self, chunk_size, on_chunk):
+
+		self.chunk_size = int(chunk_size)
+		self.on_chunk = on_chunk
+		self.n_out = 0
+		self.clear()
+
+
+	def update(self, I, Q):
+
+		n_block = max(np.shape(I[v])[-1] if len(I[v])>0 else 0 for v in range(8))
+		skip = min(max(self.n_out - self.n_seen, 0), n_block)
+		self.n_seen += n_block
+
+		if skip < n_block:
+			self.I.append([np.asarray(I[v])[..., skip:] for v in range(8)])
+			self.Q.append([np.asarray(Q[v])[..., skip:] for v in range(8)])
+			self.n_buffered += n_block - skip
+
+		while self.n_buffered >= self.chunk_size:
+			self._emit(self.chunk_size)
+
+
+	def flush(self):
+
+		if self.n_buffered > 0:
+			self._emit(self.n_buffered)
+
+
+	def clear(self):
+
+		self.n_seen = 0
+		self.n_buffered = 0
+		self.I = []
+		self.Q = []
+
+
+	def _emit(self, n):
+
+		I = [np.concatenate([block[v] for block in self.I], axis=-1) for v in range(8)]
+		Q = [np.concatenate([block[v] for block in self.Q], axis=-1) for v in range(8)]
+
+		self.on_chunk(self.n_out, [i[..., :n] for i in I], [q[..., :n] for q in Q])
+
+		self.I = [[i[..., n:] for i in I]]
+		self.Q = [[q[..., n:] for q in Q]]
+		self.n_buffered -= n
+		self.n_out += n
+
+
+
+class PulseAssembler:
+	'''
+	Regroups the raw points of each channel passed to add (e.g. by a
+	DecodingSink) into the pulses of length_vec, whatever the event
+	boundaries, and passes each complete trace to on_pulse(channel, pulse
+	index, trace). At most one pulse per channel is kept.
+	'''
+
+	def __init__(self, length_vec, on_pulse):
+
+		self.lengths = [[int(length) for length in length_vec[v] if length > 0] for v in range(8)]
+		self.on_pulse = on_pulse
+		self.clear()
+
+
+	def add(self, ch, I):
+
+		lengths = self.lengths[ch-1]
+		if len(lengths) == 0:
+			return
+
+		self.buffers[ch-1].append(np.asarray(I))
+		self.n_buffered[ch-1] += len(I)
+
+		while self.n_buffered[ch-1] >= lengths[self.pulse[ch-1]]:
+
+			points = np.concatenate(self.buffers[ch-1])
+			length = lengths[self.pulse[ch-1]]
+			self.on_pulse(ch, self.pulse[ch-1], points[:length])
+
+			self.buffers[ch-1] = [points[length:]]
+			self.n_buffered[ch-1] -= length
+			self.pulse[ch-1] = (self.pulse[ch-1] + 1) % len(lengths)
+
+
+	def clear(self):
+
+		self.buffers = [[] for v in range(8)]
+		self.n_buffered = [0]*8
+		self.pulse = [0]*8
+
+
+
+class ContinuousStream:
+	'''
+	Context manager streaming a continuous acquisition (see
+	RFSoC.stream_continuous): a reader thread polls OUTPUT:DATA?, decodes
+	the packets (StreamDecoder) and cuts the points of each channel into
+	chunks of chunk_size points. Iterating over the stream yields
+	(channel, I, Q) chunks, Q being None with the mixer off.
+
+	At most max_chunks chunks wait for the consumer. When the consumer is
+	slower than the acquisition, policy decides what happens to a new chunk:
+	'block' stops reading until there is room (the data then piles up in
+	the instrument), 'drop_oldest' discards the oldest waiting chunk and
+	'drop_newest' discards the new one. Dropped chunks are counted in
+	dropped.
+
+	sequence_str is written before SEQ:START and restore_str (the program
+	to go back to) after SEQ:STOP.
+	'''
+
+	POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+	def __init__(self, instrument, chunk_size, max_chunks=16, policy='drop_oldest', empty_pause=0.01,
+				 sequence_str=None, restore_str=None):
+
+		if policy not in self.POLICIES:
+			raise ValueError('Unknown backpressure policy {}, use one of {}.'.format(policy, ', '.join(self.POLICIES)))
+
+		self.instrument = instrument
+		self.chunk_size = int(chunk_size)
+		self.policy = policy
+		self.empty_pause = empty_pause
+		self.sequence_str = sequence_str
+		self.restore_str = restore_str
+		self.chunks = queue.Queue(maxsize=max_chunks)
+		self.dropped = 0
+		self.received_words = 0
+		self.error = None
+		self._pending = {}
+		self._stop = threading.Event()
+		self._thread = None
+
+
+	def __enter__(self):
+
+		self._stop.clear()
+
+		if self.sequence_str is not None:
+			self.instrument.write(self.sequence_str)
+
+		self.instrument.write("SEQ:START")
+		self._thread = threading.Thread(target=self._read, daemon=True)
+		self._thread.start()
+
+		return self
+
+
+	def __exit__(self, *exc):
+
+		self.close()
+
+
+	def close(self):
+
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+		self.instrument.write("SEQ:STOP")
+
+		if self.restore_str is not None:
+			self.instrument.write(self.restore_str)
+
+
+	def __iter__(self):
+
+		while True:
+
+			try:
+				chunk = self.chunks.get(timeout=0.1)
+			except queue.Empty:
+				if self.error is not None:
+					raise self.error
+				if self._thread is None or not self._thread.is_alive():
+					return
+				continue
+
+			yield chunk
+
+
+	def _read(self):
+
+		decoder = StreamDecoder()
+
+		try:
+
+			while not self._stop.is_set():
+
+				r = self.instrument.ask('OUTPUT:DATA?')
+
+				if r == 'ERR':
+
+					log.error('rfSoC: Instrument returned ERR!')
+					# the points of the run are dropped so that a chunk
+					# never mixes two runs
+					decoder = StreamDecoder()
+					self._pending = {}
+					recover(self.instrument)
+
+				elif len(r)>1:
+
+					self.received_words += len(r)
+					for ch, (I, Q) in decoder.feed(r).items():
+						self._collect(ch, I, Q)
+
+				else:
+
+					time.sleep(self.empty_pause)
+
+		except Exception as error:
+
+			self.error = error
+
+
+	def _collect(self, ch, I, Q):
+
+		I_pending, Q_pending = self._pending.get(ch, (np.zeros(0), None if Q is None else np.zeros(0)))
+		I_pending = np.concatenate((I_pending, I))
+		if Q is not None:
+			Q_pending = np.concatenate((Q_pending, Q))
+
+		while len(I_pending) >= self.chunk_size:
+
+			chunk = (ch, I_pending[:self.chunk_size], None if Q is None else Q_pending[:self.chunk_size])
+			I_pending = I_pending[self.chunk_size:]
+			if Q is not None:
+				Q_pending = Q_pending[self.chunk_size:]
+
+			self._put(chunk)
+
+		self._pending[ch] = (I_pending, Q_pending)
+
+
+	def _put(self, chunk):
+
+		if self.policy == 'block':
+
+			while not self._stop.is_set():
+				try:
+					self.chunks.put(chunk, timeout=0.1)
+					return
+				except queue.Full:
+					continue
+
+		elif self.policy == 'drop_newest':
+
+			try:
+				self.chunks.put_nowait(chunk)
+			except queue.Full:
+				self.dropped += 1
+
+		else:
+
+			while True:
+				try:
+					self.chunks.put_nowait(chunk)
+					return
+				except queue.Full:
+					try:
+						self.chunks.get_nowait()
+						self.dropped += 1
+					except queue.Empty:
+						pass
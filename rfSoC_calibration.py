@@ -0,0 +1,361 @@
+# Model based calibration of the rfSoC analog front end.
+# Optimizers with an ask/tell interface: ask returns the next settings to
+# measure, tell gives back the measured powers (linear units). The known
+# dependence of the measured power on the settings is fitted by linear least
+# squares after each point, and the next point is the optimum of the model,
+# within a trust region around the best point measured so far. They do not
+# talk to the instruments, see rfSoC_support for the measurement loops.
+
+
+
+
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+def fit_linear(features, y, relative=False):
+	'''
+	Least squares coefficients of y ~ features @ coefficients, on the
+	relative errors with relative (powers measured with a relative noise).
+	'''
+
+	features = np.asarray(features, dtype=float)
+	y = np.asarray(y, dtype=float)
+
+	if relative:
+		features = features/np.abs(y)[:,None]
+		y = np.sign(y)
+
+	return np.linalg.lstsq(features, y, rcond=None)[0]
+
+
+def wrap_phase(phase):
+	'''
+	Phase in degrees wrapped to [-180, 180).
+	'''
+
+	return (phase + 180) % 360 - 180
+
+
+
+def fit_interference(amplitude, phase, power):
+	'''
+	Power |z0 + k amplitude exp(i phase)|^2 + noise of two interfering
+	tones (phase in degrees, amplitude linear) is A + B amplitude^2 +
+	amplitude (C cos(phase) + D sin(phase)): least squares (A, B, C, D).
+	'''
+
+	amplitude = np.asarray(amplitude, dtype=float)
+	phase = np.radians(phase)
+
+	return fit_linear(np.column_stack((np.ones(len(amplitude)), amplitude**2, amplitude*np.cos(phase), amplitude*np.sin(phase))),
+					  power, relative=True)
+
+
+def interference_optimum(model):
+	'''
+	Amplitude and phase (degrees) minimizing the fitted interference, None
+	if the model has no minimum.
+	'''
+
+	A, B, C, D = model
+	if not B > 0:
+		return None
+
+	return np.hypot(C, D)/(2*B), np.degrees(np.arctan2(-D, -C))
+
+
+
+class IQBalanceOptimizer:
+	'''
+	IQ balance of a single sideband upconversion: phase (degrees) of the Q
+	tone, amplitude ratio Q/I and DC offsets of I and Q.
+
+	The image sideband power is |1 - amp_ratio r exp(i(phase - phase0))|^2
+	up to a factor and a noise floor (see fit_interference); the LO leakage
+	power is a
+	paraboloid in the DC offsets. Both are fitted from a design of five
+	points around the initial settings, then the optimum of the models is
+	measured until budget measurements are done.
+	'''
+
+	def __init__(self, phase=90., amp_ratio=1., dc_offset_I=0., dc_offset_Q=0., phase_step=120.,
+				 amp_step=0.15, dc_step=2., budget=8, optimize_dc=True):
+
+		self.budget = budget
+		self.optimize_dc = optimize_dc
+		self.points = []
+		self.image = []
+		self.leakage = []
+
+		self.radius = {'phase': phase_step/2, 'amp_ratio': amp_step, 'dc': dc_step}
+		self.model_image = None
+		self.model_leakage = None
+
+		# three phases at the initial ratio and two ratios at the initial phase,
+		# DC offsets on a cross around the initial ones
+		design = [(0, 1, 0, 0), (phase_step, 1, dc_step, 0), (-phase_step, 1, -dc_step, 0),
+				  (0, 1-amp_step, 0, dc_step), (0, 1+amp_step, 0, -dc_step)]
+		self._design = [dict(phase=wrap_phase(phase+dp), amp_ratio=amp_ratio*da,
+							 dc_offset_I=dc_offset_I+di*optimize_dc, dc_offset_Q=dc_offset_Q+dq*optimize_dc)
+						for dp, da, di, dq in design]
+
+
+	@property
+	def done(self):
+
+		return len(self.points) >= self.budget
+
+
+	def ask(self):
+
+		if self.done:
+			return None
+
+		if len(self.points) < len(self._design):
+			return dict(self._design[len(self.points)])
+
+		best = self.best_measured()
+		optimum = self.optimum()
+
+		# at most radius from the best point measured
+		step = wrap_phase(optimum['phase'] - best['phase'])
+		point = dict(phase=wrap_phase(best['phase'] + np.clip(step, -self.radius['phase'], self.radius['phase'])),
+					 amp_ratio=best['amp_ratio'] + np.clip(optimum['amp_ratio']-best['amp_ratio'], -self.radius['amp_ratio'], self.radius['amp_ratio']))
+
+		for q in ['dc_offset_I', 'dc_offset_Q']:
+			point[q] = best[q] + np.clip(optimum[q]-best[q], -self.radius['dc'], self.radius['dc'])
+
+		return point
+
+
+	def tell(self, point, image_power, leakage_power=np.nan):
+
+		best_image = min(self.image) if len(self.image)>0 else np.inf
+		best_leakage = np.nanmin(self.leakage) if np.any(np.isfinite(self.leakage)) else np.inf
+
+		self.points.append(dict(point))
+		self.image.append(image_power)
+		self.leakage.append(leakage_power)
+
+		if len(self.points) > len(self._design):
+
+			# no improvement: the models are not trusted as far
+			if image_power >= best_image:
+				self.radius['phase'] /= 2
+				self.radius['amp_ratio'] /= 2
+			if self.optimize_dc and not leakage_power < best_leakage:
+				self.radius['dc'] /= 2
+
+		if len(self.points) >= len(self._design):
+			self.fit()
+
+
+	def fit(self):
+
+		# the image is the interference of the I tone with the Q tone
+		self.model_image = fit_interference([p['amp_ratio'] for p in self.points], [p['phase'] for p in self.points], self.image)
+
+		if self.optimize_dc and np.all(np.isfinite(self.leakage)):
+			dI = np.array([p['dc_offset_I'] for p in self.points])
+			dQ = np.array([p['dc_offset_Q'] for p in self.points])
+			self.model_leakage = fit_linear(np.column_stack((np.ones(len(dI)), dI**2, dQ**2, dI, dQ)), self.leakage, relative=True)
+
+
+	def best_measured(self):
+
+		best = dict(self.points[int(np.argmin(self.image))])
+
+		if self.optimize_dc and np.any(np.isfinite(self.leakage)):
+			best_dc = self.points[int(np.nanargmin(self.leakage))]
+			best['dc_offset_I'] = best_dc['dc_offset_I']
+			best['dc_offset_Q'] = best_dc['dc_offset_Q']
+
+		return best
+
+
+	def optimum(self):
+		'''
+		Settings minimizing the fitted models, the best measured ones where
+		a model has no minimum.
+		'''
+
+		best = self.best_measured()
+		optimum = dict(best)
+
+		if self.model_image is not None and interference_optimum(self.model_image) is not None:
+			optimum['amp_ratio'], optimum['phase'] = interference_optimum(self.model_image)
+
+		if self.model_leakage is not None:
+			K, a, b, u, v = self.model_leakage
+			if a > 0 and b > 0:
+				optimum['dc_offset_I'] = -u/(2*a)
+				optimum['dc_offset_Q'] = -v/(2*b)
+
+		return optimum
+
+
+	def run(self, measure):
+		'''
+		Run the optimization with measure(point) returning the image and
+		leakage powers (linear) of the settings point, returns the optimum.
+		'''
+
+		while not self.done:
+			point = self.ask()
+			self.tell(point, *measure(point))
+
+		return self.optimum()
+
+
+
+class CancellationOptimizer:
+	'''
+	Cancellation of a tone by a second one of adjustable amplitude and phase
+	(degrees): the residual power is fitted by fit_interference and its
+	minimum measured, within a trust region around the best point, until
+	budget measurements or until the optimum and its neighbours at the
+	resolution of the settings are measured.
+
+	The amplitude setting is converted to the linear amplitude of the
+	model by to_linear and back by from_linear (e.g. attenuation in dB),
+	settings are kept in amplitude_range and rounded to amplitude_quantum
+	and phase_quantum (e.g. 0.05 dB, 1 degree steps).
+	'''
+
+	def __init__(self, phase=180., amplitude=0.5, amplitude_range=(0, 1), phase_step=120., amplitude_step=0.2,
+				 to_linear=None, from_linear=None, amplitude_quantum=None, phase_quantum=None, budget=12):
+
+		self.amplitude_range = amplitude_range
+		self.to_linear = to_linear if to_linear is not None else (lambda x: x)
+		self.from_linear = from_linear if from_linear is not None else (lambda x: x)
+		self.amplitude_quantum = amplitude_quantum
+		self.phase_quantum = phase_quantum
+		self.budget = budget
+
+		self.points = []
+		self.power = []
+		self.model = None
+		self.converged = False
+		self.radius = {'phase': phase_step/2, 'amplitude': amplitude_step}
+		self._min_radius = {'phase': phase_quantum or 0.1,
+							'amplitude': amplitude_quantum or 1e-3*abs(amplitude_range[1]-amplitude_range[0])}
+
+		design = [(0, 0), (phase_step, 0), (-phase_step, 0), (0, -amplitude_step), (0, amplitude_step)]
+		self._design = [self.quantize(dict(phase=phase+dp, amplitude=amplitude+da)) for dp, da in design]
+
+
+	def quantize(self, point):
+
+		amplitude = np.clip(point['amplitude'], *self.amplitude_range)
+		if self.amplitude_quantum:
+			amplitude = np.clip(np.round(amplitude/self.amplitude_quantum)*self.amplitude_quantum, *self.amplitude_range)
+
+		phase = point['phase'] % 360
+		if self.phase_quantum:
+			phase = (np.round(phase/self.phase_quantum)*self.phase_quantum) % 360
+
+		return dict(phase=float(phase), amplitude=float(amplitude))
+
+
+	@property
+	def done(self):
+
+		return self.converged or len(self.points) >= self.budget
+
+
+	def ask(self):
+
+		if self.done:
+			return None
+
+		if len(self.points) < len(self._design):
+			return dict(self._design[len(self.points)])
+
+		best = self.best_measured()
+		optimum = self.optimum()
+
+		if optimum is None or optimum in self.points:
+
+			# no minimum in the model, or already measured: the points around
+			# tell a residual offset from the noise floor
+			center = best if optimum is None else optimum
+			while True:
+				for dp, da in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+					point = self.quantize(dict(phase=center['phase'] + dp*self.radius['phase'],
+											   amplitude=center['amplitude'] + da*self.radius['amplitude']))
+					if point not in self.points:
+						return point
+
+				if self.radius['phase'] <= self._min_radius['phase'] and self.radius['amplitude'] <= self._min_radius['amplitude']:
+					self.converged = True
+					return None
+
+				self.radius = {q: max(self.radius[q]/2, self._min_radius[q]) for q in self.radius}
+
+		step = wrap_phase(optimum['phase'] - best['phase'])
+		point = self.quantize(dict(phase=best['phase'] + np.clip(step, -self.radius['phase'], self.radius['phase']),
+								   amplitude=best['amplitude'] + np.clip(optimum['amplitude']-best['amplitude'],
+																		 -self.radius['amplitude'], self.radius['amplitude'])))
+
+		return optimum if point in self.points else point
+
+
+	def tell(self, point, power):
+
+		best = min(self.power) if len(self.power)>0 else np.inf
+
+		self.points.append(dict(point))
+		self.power.append(power)
+
+		if len(self.points) > len(self._design) and not power < best:
+			self.radius = {q: max(self.radius[q]/2, self._min_radius[q]) for q in self.radius}
+
+		if len(self.points) >= len(self._design):
+			self.model = fit_interference([self.to_linear(p['amplitude']) for p in self.points],
+										  [p['phase'] for p in self.points], self.power)
+
+
+	def best_measured(self):
+
+		return dict(self.points[int(np.argmin(self.power))])
+
+
+	def optimum(self):
+		'''
+		Quantized settings minimizing the fitted model in amplitude_range,
+		None if it has no minimum.
+		'''
+
+		optimum = interference_optimum(self.model) if self.model is not None else None
+		if optimum is None:
+			return None
+
+		amplitude, phase = optimum
+		linear_range = sorted(self.to_linear(x) for x in self.amplitude_range)
+		amplitude = np.clip(amplitude, *linear_range)
+
+		amplitude = self.from_linear(amplitude) if amplitude > 0 else min(self.amplitude_range, key=self.to_linear)
+
+		return self.quantize(dict(phase=phase, amplitude=amplitude))
+
+
+	def run(self, measure):
+		'''
+		Run the optimization with measure(point) returning the residual power
+		(linear) of the settings point, returns the optimum.
+		'''
+
+		while True:
+			point = self.ask()
+			if point is None:
+				break
+			self.tell(point, measure(point))
+
+		optimum = self.optimum()
+
+		return optimum if optimum is not None else self.best_measured()
@@ -0,0 +1,1060 @@
+# Compilation of rfSoC pulse tables into sequencer programs and DAC memory.
+# Pure functions of the pulse table and of the instrument settings: nothing
+# here talks to the instrument, so programs can be compiled offline or in
+# worker processes and only uploaded by the driver (rfSoC.RFSoC).
+
+
+
+
+
+import numpy as np
+import pandas as pd
+import os
+import glob
+import hashlib
+import pickle as pk
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import rfSoC_emulator as rfe
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+# DAC control bits of the sequencer trigger word (3 bits per DAC channel)
+DAC_START = 0b011
+DAC_STOP = 0b001
+
+# acquisition mode nibble (command 4106) of an ADC in continuous mode
+ACQ_CONTINUOUS = 0x3
+
+
+def trigger_word(ADC_state, ch_num=None, DAC_bits=0):
+	'''
+	Sequencer trigger word (opcode 4096) from the ADC state bitmask (bit ch-1
+	for ADC ch) and the control bits of the DAC channel ch_num. ADC bits sit in
+	bits 24 to 31, DAC ch bits in bits 3*(ch-1) to 3*(ch-1)+2.
+	'''
+	word = ADC_state << 24
+	if ch_num is not None:
+		word |= DAC_bits << (3*(ch_num-1))
+	return word
+
+
+class SequenceBuilder:
+	'''
+	Sequencer program as a preallocated array of (opcode, argument) pairs.
+	The SCPI text is only produced once the program is complete.
+	'''
+
+	def __init__(self, n_max):
+
+		# int64 and not int32: the ADC8 bit of the trigger word is bit 31
+		self.program = np.zeros((n_max,2), dtype=np.int64)
+		self.n_cmd = 0
+
+	def add(self, opcode, arg):
+
+		if self.n_cmd == len(self.program):
+			self.program = np.concatenate((self.program, np.zeros_like(self.program)))
+
+		self.program[self.n_cmd] = (opcode, arg)
+		self.n_cmd += 1
+
+	def get_program(self):
+
+		return self.program[:self.n_cmd]
+
+	def to_SCPI(self):
+
+		return ','.join(self.get_program().ravel().astype(str))
+
+
+class DACMemoryAllocator:
+	'''
+	Row allocation in the DAC memory of the 8 channels. A block identical
+	to an earlier block of the same channel reuses its address instead of
+	taking new rows. block_gap rows are left after each new block (the idle
+	row SequenceGeneration_v2 writes after every pulse).
+	'''
+
+	def __init__(self, capacity=16383, dedup=True, block_gap=0):
+
+		self.capacity = np.full(8, capacity, dtype=int)
+		self.dedup = dedup
+		self.block_gap = block_gap
+		self.rows = np.zeros(8, dtype=int)
+		self.requested = np.zeros(8, dtype=int)
+		self.blocks = [[],[],[],[],[],[],[],[]]
+		self._data = [[],[],[],[],[],[],[],[]]
+		self._addresses = [{},{},{},{},{},{},{},{}]
+
+	def allocate(self, ch, data, label=None):
+		'''
+		Address of the block data (flat rows of 11 values) in the memory of
+		DAC ch, raises ValueError with the memory budget if it does not fit.
+		'''
+
+		data = np.asarray(data).astype(int)
+		n_rows = len(data)//11
+
+		key = hashlib.sha1(data.tobytes()).hexdigest()
+		if self.dedup and key in self._addresses[ch-1]:
+
+			addr = self._addresses[ch-1][key]
+			self.blocks[ch-1].append((label, addr, n_rows, True))
+			self.requested[ch-1] += n_rows
+			return addr
+
+		if self.rows[ch-1] + n_rows + self.block_gap > self.capacity[ch-1]:
+
+			raise ValueError('DAC memory overflow on CH{}: {} needs {} rows, {} of {} rows already used.\n'.format(ch,label,n_rows,self.rows[ch-1],self.capacity[ch-1])
+							 + self.budget())
+
+		addr = int(self.rows[ch-1])
+		self._addresses[ch-1][key] = addr
+		self._data[ch-1].append(data)
+		self.blocks[ch-1].append((label, addr, n_rows, False))
+		self.rows[ch-1] += n_rows + self.block_gap
+		self.requested[ch-1] += n_rows
+
+		return addr
+
+	def reserve_end(self, ch, n_rows):
+		'''
+		Keep the last n_rows rows of DAC ch out of the allocation (CW pulses),
+		returns the address of the first of them.
+		'''
+
+		self.capacity[ch-1] -= n_rows
+
+		return int(self.capacity[ch-1])
+
+	def channel_data(self, ch):
+
+		return np.concatenate(self._data[ch-1]) if len(self._data[ch-1]) > 0 else np.array([], dtype=int)
+
+	def utilisation(self):
+		'''
+		{ch: (rows used, available rows, rows saved by reusing blocks)} of
+		the channels holding blocks.
+		'''
+
+		return {ch+1: (int(self.rows[ch]), int(self.capacity[ch]), int(self.requested[ch]+len(self._data[ch])*self.block_gap-self.rows[ch]))
+				for ch in range(8) if len(self.blocks[ch]) > 0}
+
+	def budget(self):
+		'''
+		Memory use of each channel and the blocks it holds, for error messages.
+		'''
+
+		lines = []
+		for ch, (rows, capacity, saved) in self.utilisation().items():
+
+			lines.append('CH{}: {}/{} rows ({:.0%}), {} rows reused: '.format(ch,rows,capacity,rows/capacity,saved)
+						 + ', '.join('{} @{} ({} rows{})'.format(label,addr,n_rows,', reused' if reused else '') for label, addr, n_rows, reused in self.blocks[ch-1]))
+
+		return '\n'.join(lines)
+
+
+class ProgramCache:
+	'''
+	Least recently used cache of compiled programs indexed by the hash of
+	their inputs, optionally persisted to disk (one pickle per program).
+	'''
+
+	def __init__(self, max_size=64, location=None, max_disk_size=1024):
+
+		self.max_size = max_size
+		self.location = location
+		self.max_disk_size = max_disk_size
+		self._programs = OrderedDict()
+
+	def get(self, key):
+
+		if key in self._programs:
+
+			self._programs.move_to_end(key)
+			return self._programs[key]
+
+		if self.location is not None and os.path.isfile(self._path(key)):
+
+			with open(self._path(key), 'rb') as f:
+				program = pk.load(f)
+			self._store(key, program)
+			return program
+
+		return None
+
+	def put(self, key, program):
+
+		self._store(key, program)
+
+		if self.location is not None:
+
+			os.makedirs(self.location, exist_ok=True)
+			with open(self._path(key), 'wb') as f:
+				pk.dump(program, f)
+
+			files = sorted(glob.glob(os.path.join(self.location, '*.pkl')), key=os.path.getmtime)
+			for file in files[:max(0, len(files)-self.max_disk_size)]:
+				os.remove(file)
+
+	def clear(self):
+
+		self._programs.clear()
+
+	def _store(self, key, program):
+
+		self._programs[key] = program
+		self._programs.move_to_end(key)
+		while len(self._programs) > self.max_size:
+			self._programs.popitem(last=False)
+
+	def _path(self, key):
+
+		return os.path.join(self.location, key + '.pkl')
+
+	def __len__(self):
+
+		return len(self._programs)
+
+
+class RFSoCProgram(namedtuple('RFSoCProgram', ['sequence_str', 'DAC_data', 'DAC_blocks',
+											   'length_vec', 'ch_vec', 'ADC_ch_active',
+											   'duration', 'timeline', 'color_dict', 'plan',
+											   'DAC_usage'])):
+	'''
+	Compiled rfSoC program, ready for RFSoC.upload_program.
+
+	sequence_str: SEQ command (None in a diff program if unchanged)
+	DAC_data: {channel: flat DAC memory rows} of the channels to write
+	DAC_blocks: {pulse label: (channel, row address, number of rows)},
+	identical pulses of a channel share their rows
+	length_vec, ch_vec, ADC_ch_active: ADC event layout used for readout
+	duration: duration of one repetition in us (without the sync wait)
+	timeline, color_dict: table of the events for display
+	plan: repetition period and data rate, see rfSoC_emulator.plan_repetition
+	DAC_usage: {channel: (rows used, available rows, rows saved by reuse)}
+	'''
+	__slots__ = ()
+
+
+
+def program_hash(pulses, settings):
+	'''
+	Hash of everything compile_program depends on: the content of the
+	pulse table and the settings (n_rep, acquisition mode, freq_sync, DAC
+	calibration, ...).
+	'''
+
+	def hashable(val):
+
+		if isinstance(val, dict):
+			return tuple((key, hashable(val[key])) for key in sorted(val))
+		if isinstance(val, (list, tuple)):
+			return tuple(hashable(v) for v in val)
+		if isinstance(val, np.ndarray):
+			return (val.dtype.str, val.shape, val.tobytes())
+		return repr(val)
+
+	state = (hashable(pulses.to_dict('list')), hashable(settings))
+
+	return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
+
+def compress_rows(wavepoints, max_repetition=16383):
+	'''
+	Run-length encoding of flat DAC memory rows: consecutive identical rows
+	(samples and triggers) become one row with its repetition field set to
+	the number of extra plays, at most max_repetition per row.
+	'''
+
+	rows = wavepoints.reshape(-1,11)
+	if len(rows) < 2:
+		return wavepoints
+
+	# rows are compared as they will be written to the DAC
+	new_run = np.any(np.diff(rows.astype(int), axis=0) != 0, axis=1)
+	starts = np.flatnonzero(np.concatenate(([True], new_run)))
+	lengths = np.diff(np.append(starts, len(rows))) * (rows[starts,10].astype(int)+1)
+
+	# runs longer than the repetition field are split
+	n_chunks = -(-lengths//(max_repetition+1))
+	run = np.repeat(np.arange(len(starts)), n_chunks)
+	chunk = np.arange(len(run)) - np.repeat(np.cumsum(n_chunks)-n_chunks, n_chunks)
+	counts = np.minimum(lengths[run] - chunk*(max_repetition+1), max_repetition+1)
+
+	compressed = rows[starts[run]].copy()
+	compressed[:,10] = counts - 1
+
+	return compressed.reshape(-1)
+
+
+def pulse_gen_SCPI(mode,param,duration,ch,settings,compress=False):
+	'''
+	DAC memory rows (8 samples, 2 triggers, repetition) of one pulse as a
+	flat array. Parameters given as arrays of N values (a sweep axis)
+	return an (N, rows*11) array with one waveform per value. With
+	compress, repeated rows of a single waveform are run-length encoded
+	(see compress_rows).
+	'''
+
+	period = 1./settings['sampling_rate']
+	time_vec = np.arange(period,duration*1e-6+period/2,period)
+
+	# broadcast swept parameters along the time axis
+	param = {key: np.asarray(val)[...,None] for key, val in param.items()}
+	
+	if mode == 'sin+sin':
+		
+		wavepoints1 = (2**13)*settings['DAC_amplitude_calib'][ch-1]*param['amp1']*np.sin(-param['phase_offset1'] + 2*np.pi*param['freq1']*1e6*time_vec)
+		wavepoints2 = (2**13)*settings['DAC_amplitude_calib'][ch-1]*param['amp2']*np.sin(-param['phase_offset2'] + 2*np.pi*param['freq2']*1e6*time_vec)
+		
+		wavepoints = (2**13)*settings['DAC_amplitude_calib'][ch-1]*param['dc_offset'] + wavepoints1 + wavepoints2
+		
+	elif mode == 'sin':
+		
+		wavepoints = (2**13)*settings['DAC_amplitude_calib'][ch-1]*param['dc_offset'] + (2**13)*settings['DAC_amplitude_calib'][ch-1]*param['amp']*np.sin(-param['phase_offset'] + 2*np.pi*param['freq']*1e6*time_vec)
+		
+	else:
+		
+		log.error('Wrong waveform mode: ',mode)
+	
+	
+	
+	sweep_shape = wavepoints.shape[:-1]
+
+	# adding zeros to make length multiple of 8
+	wavepoints = np.concatenate((wavepoints,np.zeros(sweep_shape+(len(time_vec)%8,))),axis=-1)
+
+	trig_rep_len = int(wavepoints.shape[-1]/8)
+	# adding trigger vectors and repetation (0 for once)
+	wavepoints = np.concatenate((wavepoints.reshape(sweep_shape+(trig_rep_len,8)), np.zeros(sweep_shape+(trig_rep_len,3))),axis=-1)
+
+	# convert to 1D array (one per sweep point)
+	wavepoints = wavepoints.reshape(sweep_shape+(trig_rep_len*11,))
+
+	if compress and sweep_shape == ():
+		wavepoints = compress_rows(wavepoints)
+
+	return wavepoints
+
+
+def compile_program(pulses, settings, cache=None, debug=False):
+	'''
+	Compile a pulse table into an RFSoCProgram.
+
+	settings is a dict with n_rep, acquisition_mode ('RAW' or 'IQ'),
+	freq_sync (Hz), sampling_rate (Hz), FPGA_clock (Hz), DAC_amplitude_calib
+	(one factor per channel) and DAC_memory_rows, see RFSoC.compile_settings.
+	Optional link_throughput (bytes/s), output_FIFO_size (bytes) and ADC
+	decimation (one factor per channel) size the dead time at the end of
+	each repetition. DAC_dedup=False gives every pulse its own DAC rows,
+	DAC_compression=False stores repeated DAC rows one by one and the
+	pulses listed in DAC_fixed_labels always keep one row per 8 samples.
+	If a ProgramCache is given, an identical earlier compilation is reused.
+	'''
+
+	if cache is not None:
+
+		program_key = program_hash(pulses, settings)
+		program = cache.get(program_key)
+
+		if program is not None:
+
+			log.info('Sequence found in program cache'+'  \n')
+			return program
+
+	log.info('Started sequence processing'+'  \n')
+
+	n_rep = settings['n_rep']
+	pulses_raw_df = pulses
+
+	if len(set(pulses_raw_df['label'])) < len(pulses_raw_df['label']):
+
+		log.error('Duplicate Labels: Labels need to be unique for consistent identification of pulse hierarchy.')
+
+	pulses_raw_df = pulses_raw_df.set_index('label')
+
+	if debug:
+
+		print(pulses_raw_df)
+
+	resolve_hierarchy = True
+	while resolve_hierarchy:
+
+		for index, row in pulses_raw_df.iterrows():
+
+			if row['parent'] != None:
+
+				if pulses_raw_df.loc[row['parent']]['parent'] == None:
+
+					pulses_raw_df.loc[index,'start'] = pulses_raw_df.loc[index,'start'] +  pulses_raw_df.loc[row['parent']]['start'] + pulses_raw_df.loc[row['parent']]['length']
+					pulses_raw_df.loc[index,'parent'] = None
+		
+		resolve_hierarchy = False
+		for val in pulses_raw_df['parent']:
+			if val != None:
+				resolve_hierarchy = True
+
+	if debug:
+
+		print('Hierarchy resolution...')
+		print(pulses_raw_df)
+
+	pulse_rows = []
+	time_ADC = [0,0,0,0,0,0,0,0]
+	time_DAC = [0,0,0,0,0,0,0,0]
+	length_vec = [[],[],[],[],[],[],[],[]]
+	ch_vec = []
+	wait_color_count = int("D3D3D3", 16)
+	DAC_color_count = int("306cc7", 16)
+	ADC_color_count = int("db500b", 16)
+	color_dict = {}
+	termination_time = 0
+
+	tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'ADC']
+	for index, row in tmp_df.iterrows():
+		
+		if row['start'] > time_ADC[int(row['channel'])-1]:
+			
+			label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
+			start = time_ADC[int(row['channel'])-1]
+			stop = row['start']
+			time = row['start'] - time_ADC[int(row['channel'])-1]
+			module = row['module']
+			Channel = 'ADC ch' + str(int(row['channel']))
+			mode = 'wait'
+			color = wait_color_count
+			wait_color_count += 1
+			color_dict[str(color)] = '#{0:06X}'.format(color)
+			param = row['param']
+			ch_num = row['channel']
+			
+			pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+		
+		label = index
+		start = row['start']
+		stop = row['start'] + row['length']
+		time = row['length']
+		module = row['module']
+		Channel = 'ADC ch' + str(int(row['channel']))
+		mode = row['mode']
+		color = ADC_color_count
+		ADC_color_count += 1
+		color_dict[str(color)] = '#{0:06X}'.format(color)
+		param = row['param']
+		ch_num = row['channel']
+
+		pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+
+		length_vec[int(row['channel'])-1].append(int(time*1e-6*settings['sampling_rate']))
+		ch_vec.append(int(row['channel'])-1)
+		
+		time_ADC[int(row['channel'])-1] = stop
+		
+		if stop>termination_time:
+			
+			termination_time = stop
+		
+	tmp_df = pulses_raw_df.loc[pulses_raw_df['module'] == 'DAC']
+	for index, row in tmp_df.iterrows():
+		
+		if row['start'] > time_DAC[int(row['channel'])-1]:
+			
+			label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
+			start = time_DAC[int(row['channel'])-1]
+			stop = row['start']
+			time = row['start'] - time_DAC[int(row['channel'])-1]
+			module = row['module']
+			Channel = 'DAC ch' + str(int(row['channel']))
+			mode = 'wait'
+			color = wait_color_count
+			wait_color_count += 1
+			color_dict[str(color)] = '#{0:06X}'.format(color)
+			param = row['param']
+			ch_num = row['channel']
+			
+			pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+		
+		label = index
+		start = row['start']
+		stop = row['start'] + row['length']
+		time = row['length']
+		module = row['module']
+		Channel = 'DAC ch' + str(int(row['channel']))
+		mode = row['mode']
+		color = DAC_color_count
+		DAC_color_count += 1
+		color_dict[str(color)] = '#{0:06X}'.format(color)
+		param = row['param']
+		ch_num = row['channel']
+
+		pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+		
+		time_DAC[int(row['channel'])-1] = stop
+		
+		if stop>termination_time:
+			
+			termination_time = stop
+
+	for ch in range(1,9):
+		
+		if termination_time>time_ADC[ch-1] and time_ADC[ch-1]>0:
+			
+			label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
+			start = time_ADC[ch-1]
+			stop = termination_time
+			time = stop - start
+			module = 'ADC'
+			Channel = 'ADC ch' + str(ch)
+			mode = 'wait'
+			color = wait_color_count
+			wait_color_count += 1
+			color_dict[str(color)] = '#{0:06X}'.format(color)
+			param = row['param']
+			ch_num = ch
+			
+			pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+			
+	for ch in range(1,9):
+		
+		if termination_time>time_DAC[ch-1] and time_DAC[ch-1]>0:
+			
+			label = 'wait' + str(wait_color_count-int("D3D3D3", 16)+1)
+			start = time_DAC[ch-1]
+			stop = termination_time
+			time = stop - start
+			module = 'DAC'
+			Channel = 'DAC ch' + str(ch)
+			mode = 'wait'
+			color = wait_color_count
+			wait_color_count += 1
+			color_dict[str(color)] = '#{0:06X}'.format(color)
+			param = row['param']
+			ch_num = ch
+			
+			pulse_rows.append(dict(label=label, start=start, stop=stop, time=time, module=module , Channel=Channel, mode=mode, color=str(color), param=param, ch_num=ch_num))
+
+	pulses_df = pd.DataFrame(pulse_rows)
+
+	event_time_list = list(dict.fromkeys(pulses_df['start']))
+	event_time_list.sort()
+
+	termination_time = np.max(pulses_df['stop'])
+
+	if debug:
+
+		print(pulses_df)
+		print(pulses_df.sort_values('start'))
+
+		print('Events detected at: ',event_time_list)
+
+		print('Termination of sequence detected at : ',termination_time)
+
+	event_time_prev = 0
+	DAC_memory = DACMemoryAllocator(settings['DAC_memory_rows']-1, settings.get('DAC_dedup', True))
+	DAC_blocks = {}
+	ADC_state = 0
+	ADC_ch_active = np.array([0,0,0,0,0,0,0,0])
+	ADC_events = []
+	n_clock_cycles = 0
+	n_clock_cycles_global = 0
+
+	# one wait per event, at most two commands per pulse and the termination
+	sequence = SequenceBuilder(len(event_time_list) + 2*len(pulses_df) + 2)
+
+	for event_time, tmp_df in pulses_df.groupby('start', sort=True):
+		
+		# adding wait till this event
+		if event_time>0:
+			
+			sequence.add(1,int((event_time-event_time_prev)*250)-1)
+			n_clock_cycles_global = n_clock_cycles_global + int((event_time-event_time_prev)*250)
+
+			if debug:
+
+				print('adding wait till this event')
+				print(1,int((event_time-event_time_prev)*250)-1)
+			
+		n_clock_cycles = 0
+		event_time_prev = event_time
+		tmp_df = tmp_df.sort_values(by='module', ascending=False, kind='stable')
+		
+		
+		for row in tmp_df.to_dict('records'):
+			
+			if debug:
+
+				print(event_time,row['mode'], row['label'])
+
+			ch_num = int(row['ch_num'])
+
+			if row['module'] == 'DAC':
+					
+				if row['mode'] != 'wait':
+					
+					# generate sequence and add to corresponding channel
+					compress = settings.get('DAC_compression', True) and row['label'] not in settings.get('DAC_fixed_labels', [])
+					SCPI_command = pulse_gen_SCPI(row['mode'],row['param'],row['time'],ch_num,settings,compress)
+					
+					# adding pulse to waveform, or pointing to an identical one
+					pulse_addr = DAC_memory.allocate(ch_num, SCPI_command, row['label'])
+					DAC_blocks[row['label']] = (ch_num, pulse_addr, len(SCPI_command)//11)
+					
+					# adding sequencer command to point to address of this pulse
+					n_clock_cycles += 1
+					sequence.add(4096+ch_num,pulse_addr)
+
+					if debug:
+
+						print('adding sequencer command to point to address of this pulse')
+						print(4096+ch_num,pulse_addr)
+					
+					# adding sequencer command to start output
+					n_clock_cycles += 1
+					trig_word = trigger_word(ADC_state,ch_num,DAC_START)
+					sequence.add(4096,trig_word)
+
+					if debug:
+
+						print('adding sequencer command to start output')
+						print(4096,trig_word)
+					
+				elif row['mode'] == 'wait':
+					
+					# adding sequencer command to stop output
+					n_clock_cycles += 1
+					trig_word = trigger_word(ADC_state,ch_num,DAC_STOP)
+					sequence.add(4096,trig_word)
+
+					if debug:
+
+						print('adding sequencer command to stop output')
+						print(4096,trig_word)
+					
+				else:
+					
+					log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
+					
+			if row['module'] == 'ADC':
+				
+				if row['mode'] != 'wait':
+					
+					# adding sequencer command to set acq points
+					n_clock_cycles += 1
+					n_points = int(row['time']*1e-6*settings['sampling_rate'])
+					sequence.add(4106+ch_num,n_points)
+
+					if debug:
+
+						print('adding sequencer command to set acq points')
+						print(4106+ch_num,int(row['time']*1e-6*settings['sampling_rate']))
+					
+					# adding sequencer command to start acq
+					n_clock_cycles += 1
+					ADC_state |= 1 << (ch_num-1)
+					ADC_ch_active[ch_num-1] = 1
+					trig_word = trigger_word(ADC_state)
+					sequence.add(4096,trig_word)
+					ADC_events.append((n_clock_cycles_global + n_clock_cycles + int(np.ceil(n_points/8)), ch_num, n_points))
+
+					if debug:
+
+						print('adding sequencer command to start acq')
+						print(4096,trig_word)
+					
+				elif row['mode'] == 'wait':
+					
+					# adding sequencer command to stop acq
+					n_clock_cycles += 1
+					ADC_state &= ~(1 << (ch_num-1))
+					trig_word = trigger_word(ADC_state)
+					sequence.add(4096,trig_word)
+
+					if debug:
+
+						print('adding sequencer command to stop acq')
+						print(4096,trig_word)
+					
+				else:
+					
+					log.error('Wrong pulse mode: ',event_time,row['mode'], row['label'])
+					
+		n_clock_cycles_global += n_clock_cycles
+			
+	#terminate the sequence
+	sequence.add(1,int((termination_time-event_time_prev)*250)-1)
+	n_clock_cycles_global = n_clock_cycles_global + int((termination_time-event_time_prev)*250)
+	sequence.add(4096,0)
+	n_clock_cycles_global += 1
+
+	log.info('DAC memory use: ' + ', '.join('CH{} {}/{} rows ({} reused)'.format(ch,*usage) for ch, usage in DAC_memory.utilisation().items()))
+
+	if settings['acquisition_mode'] == 'RAW':
+		acq_mode = 0
+	elif settings['acquisition_mode'] == 'IQ':
+		acq_mode = 286331153
+	else:
+		log.error('Invalid acquisition mode\n')
+		
+	# shortest dead time keeping the sync with freq_sync and the data flow
+	plan = rfe.plan_repetition(n_clock_cycles_global, ADC_events, acq_mode,
+							   period_sync=int(settings['FPGA_clock']/settings['freq_sync']),
+							   link_throughput=settings.get('link_throughput'),
+							   FIFO_size=settings.get('output_FIFO_size'),
+							   decimation=settings.get('decimation'),
+							   FPGA_clock=settings['FPGA_clock'])
+	wait_sync = plan['wait_arg']
+
+	log.info('Repetition period {:.3f} us ({:.1f} kHz, limited by {}), data rate {:.2f} MB/s'.format(plan['period_cycles']*1e6/settings['FPGA_clock'],plan['rep_rate']*1e-3,plan['limited_by'],plan['data_rate']*1e-6))
+
+	global_sequence_str = 'SEQ 0,1,9,4106,' + str(acq_mode) + ',257,' + str(int(n_rep-1)) + ',' + sequence.to_SCPI() + ',1,' + str(wait_sync) + ',513,0,0,0'
+
+	if debug:
+
+		print('Sequence programmer command: ',global_sequence_str)
+
+	DAC_data = {}
+	for ch in DAC_memory.utilisation():
+
+		DAC_data[ch] = DAC_memory.channel_data(ch)
+		DAC_data[ch].setflags(write=False)
+
+	program = RFSoCProgram(sequence_str=global_sequence_str,
+						   DAC_data=DAC_data,
+						   DAC_blocks=DAC_blocks,
+						   length_vec=length_vec,
+						   ch_vec=ch_vec,
+						   ADC_ch_active=ADC_ch_active,
+						   duration=termination_time,
+						   timeline=pulses_df[['label','start','stop','time','Channel','color']],
+						   color_dict=color_dict,
+						   plan=plan,
+						   DAC_usage=DAC_memory.utilisation())
+
+	if cache is not None:
+		cache.put(program_key, program)
+
+	return program
+
+
+
+def compile_sweep(pulses, sweep, settings, diff=False, cache=None):
+	'''
+	Compile all the points of a sweep of pulse parameters at once.
+
+	sweep is a dict {(label, key): values} where key is a 'param' entry
+	of the pulse (amp, freq, phase_offset, dc_offset, ...) or its 'start'
+	or 'length'. All the value arrays are swept together and must have
+	the same length. When only 'param' entries are swept, the sequence is
+	compiled once and the swept waveforms are computed as 2D arrays over
+	the sweep axis; timing sweeps fall back to one compilation per point.
+
+	Returns the list of programs. With diff=True every program after the
+	first only holds what changed with respect to the previous point.
+	'''
+
+	sweep = {axis: np.asarray(values) for axis, values in sweep.items()}
+	n_points = set(len(values) for values in sweep.values())
+	if len(n_points) != 1:
+		raise ValueError('All sweep axes must have the same number of points.')
+	n_points = n_points.pop()
+
+	if any(key in ['start','length'] for label, key in sweep):
+
+		programs = []
+		for k in range(n_points):
+
+			pulses_k = pulses.copy()
+			for (label, key), values in sweep.items():
+
+				idx = pulses_k.index[pulses_k['label'] == label][0]
+				if key in ['start','length']:
+					pulses_k.at[idx,key] = values[k]
+				else:
+					pulses_k.at[idx,'param'] = dict(pulses_k.at[idx,'param'], **{key: values[k]})
+
+			programs.append(compile_program(pulses_k, settings, cache))
+
+	else:
+
+		# swept waveforms are written in place of the base ones: same layout
+		swept_labels = sorted(set(label for label, key in sweep))
+		settings = dict(settings, DAC_fixed_labels=swept_labels)
+		base_program = compile_program(pulses, settings, cache)
+
+		# a swept pulse sharing its rows with any other pulse, swept or not,
+		# needs its own copy
+		blocks = [block[:2] for block in base_program.DAC_blocks.values()]
+		if any(blocks.count(base_program.DAC_blocks[label][:2]) > 1 for label in swept_labels if label in base_program.DAC_blocks):
+			base_program = compile_program(pulses, dict(settings, DAC_dedup=False), cache)
+
+		# swept waveforms of every pulse, one row per sweep point
+		sweep_waveforms = {}
+		for label in set(label for label, key in sweep):
+
+			row = pulses.loc[pulses['label'] == label].iloc[0]
+			if row['module'] != 'DAC':
+				raise ValueError('Only DAC pulse parameters can be swept, not ' + str(label) + '.')
+
+			param = dict(row['param'])
+			for (sweep_label, key), values in sweep.items():
+				if sweep_label == label:
+					param[key] = values
+
+			waveforms = pulse_gen_SCPI(row['mode'],param,row['length'],int(row['channel']),settings)
+			sweep_waveforms[label] = np.broadcast_to(waveforms, (n_points,waveforms.shape[-1])).astype(int)
+
+		programs = []
+		for k in range(n_points):
+
+			DAC_data = dict(base_program.DAC_data)
+			for label, waveforms in sweep_waveforms.items():
+
+				ch, addr, n_rows = base_program.DAC_blocks[label]
+				if DAC_data[ch] is base_program.DAC_data[ch]:
+					DAC_data[ch] = DAC_data[ch].copy()
+				DAC_data[ch][addr*11:(addr+n_rows)*11] = waveforms[k]
+
+			for data in DAC_data.values():
+				data.setflags(write=False)
+
+			programs.append(base_program._replace(DAC_data=DAC_data))
+
+	if diff:
+
+		for k in range(n_points-1, 0, -1):
+
+			previous = programs[k-1]
+			programs[k] = programs[k]._replace(
+				sequence_str=None if programs[k].sequence_str == previous.sequence_str else programs[k].sequence_str,
+				DAC_data={ch: data for ch, data in programs[k].DAC_data.items()
+						  if ch not in previous.DAC_data or not np.array_equal(data, previous.DAC_data[ch])})
+
+	return programs
+
+
+
+def compile_batched_sweep(pulses, sweep, settings, max_batch=None, gap=0, cache=None):
+	'''
+	Pack several points of a sweep (same format as compile_sweep) into a
+	single sequence. The pulse table is repeated once per point, each copy
+	shifted by the sequence duration rounded up to a period of freq_sync
+	(plus gap, in us), so that every point gets its own DAC memory
+	addresses and its own ADC events within one repetition.
+
+	The number of points per batch is limited by the DAC memory of the
+	busiest channel (and by max_batch if given); the sweep is split into
+	as many batches as needed. Returns a list of batches, each a dict
+	with the program to upload, the indices of its sweep points and the
+	number of ADC events per point and channel, for demux_batch.
+	'''
+
+	sweep = {axis: np.asarray(values) for axis, values in sweep.items()}
+	n_points = set(len(values) for values in sweep.values())
+	if len(n_points) != 1:
+		raise ValueError('All sweep axes must have the same number of points.')
+	n_points = n_points.pop()
+
+	# DAC memory budget and duration of one sweep point: the swept pulses
+	# at their latest and longest, uncompressed (the base point may
+	# compress much better than the others) and each in its own rows
+	swept_labels = sorted(set(label for label, key in sweep))
+	budget_pulses = pulses.copy()
+	for (label, key), values in sweep.items():
+		if key in ['start','length']:
+			budget_pulses.loc[budget_pulses['label'] == label, key] = np.max(values)
+	budget_program = compile_program(budget_pulses, dict(settings, DAC_fixed_labels=swept_labels), cache)
+
+	rows_per_point = np.zeros(8, dtype=int)
+	for ch, addr, n_rows in set(block for label, block in budget_program.DAC_blocks.items() if label not in swept_labels):
+		rows_per_point[ch-1] += n_rows
+	for label in swept_labels:
+		if label in budget_program.DAC_blocks:
+			ch, addr, n_rows = budget_program.DAC_blocks[label]
+			rows_per_point[ch-1] += n_rows
+
+	if np.max(rows_per_point) == 0:
+		points_per_batch = n_points
+	else:
+		points_per_batch = (settings['DAC_memory_rows']-1)//np.max(rows_per_point)
+
+	if points_per_batch == 0:
+		raise ValueError('DAC memory overflow: one sweep point needs ' + ', '.join('CH{}: {} rows'.format(ch+1,rows_per_point[ch]) for ch in range(8) if rows_per_point[ch]>0)
+						 + ' for {} available rows per channel.'.format(settings['DAC_memory_rows']-1))
+
+	if max_batch is not None:
+		points_per_batch = min(points_per_batch, max_batch)
+
+	period_sync = 1e6/settings['freq_sync']
+	block_duration = np.ceil(budget_program.duration/period_sync)*period_sync + gap
+	n_ADC_events = [len(budget_program.length_vec[ch]) for ch in range(8)]
+
+	batches = []
+	for first in range(0, n_points, points_per_batch):
+
+		points = list(range(first, min(first+points_per_batch, n_points)))
+
+		pulse_rows = []
+		for k, point in enumerate(points):
+
+			for row in pulses.to_dict('records'):
+
+				for (label, key), values in sweep.items():
+					if row['label'] == label:
+						if key in ['start','length']:
+							row[key] = values[point]
+						else:
+							row['param'] = dict(row['param'], **{key: values[point]})
+
+				# each point in its own block, after the swept start is applied
+				row['label'] = '{}#{}'.format(row['label'],k)
+				if row['parent'] != None:
+					row['parent'] = '{}#{}'.format(row['parent'],k)
+				else:
+					row['start'] = row['start'] + k*block_duration
+
+				pulse_rows.append(row)
+
+		batches.append(dict(program=compile_program(pd.DataFrame(pulse_rows), settings, cache),
+							points=points,
+							n_ADC_events=n_ADC_events))
+
+	log.info('Sweep of {} points packed in {} batches'.format(n_points,len(batches)) + '\n')
+
+	return batches
+
+
+
+def demux_batch(I, Q, batch):
+	'''
+	Split the readout of a batched program (see compile_batched_sweep)
+	into one (I, Q) pair per sweep point, with the same per-channel layout
+	as RFSoC.get_readout_pulse.
+	'''
+
+	data = []
+	for k in range(len(batch['points'])):
+
+		I_k, Q_k = [], []
+		for ch in range(8):
+
+			n = batch['n_ADC_events'][ch]
+			I_k.append(I[ch][k*n:(k+1)*n] if len(I[ch])>0 else I[ch])
+			Q_k.append(Q[ch][k*n:(k+1)*n] if len(Q[ch])>0 else Q[ch])
+
+		data.append((I_k,Q_k))
+
+	return data
+
+
+
+def sequence_DAC_channels(sequence_str):
+	'''
+	DAC channels whose memory address is set by a SEQ command.
+	'''
+
+	start, commands = rfe.parse_sequence(sequence_str)
+	opcodes = commands[:,0]
+
+	return sorted(set(int(op-rfe.OP_DAC_ADDR) for op in opcodes[(opcodes>rfe.OP_DAC_ADDR) & (opcodes<=rfe.OP_DAC_ADDR+8)]))
+
+
+def relocate_sequence(sequence_str, offset):
+	'''
+	Shift the DAC addresses (4096+ch commands) of a SEQ command by offset
+	rows, for DAC data written offset rows further in memory.
+	'''
+
+	start, commands = rfe.parse_sequence(sequence_str)
+	opcodes = commands[:,0]
+
+	commands = commands.copy()
+	commands[(opcodes>rfe.OP_DAC_ADDR) & (opcodes<=rfe.OP_DAC_ADDR+8), 1] += offset
+
+	return 'SEQ ' + ','.join(str(val) for val in [start] + list(commands.ravel()))
+
+
+def continuous_sequence(channels, points):
+	'''
+	SEQ command starting a continuous acquisition (DSP type 0x3) on the ADC
+	channels, which then runs until SEQ:STOP: the program ends on an
+	endless wait loop. points is the number of acquisition points of each
+	channel.
+	'''
+
+	sequence = SequenceBuilder(len(channels) + 5)
+	sequence.add(rfe.OP_WAIT, 9)
+	sequence.add(rfe.OP_ADC_POINTS, sum(ACQ_CONTINUOUS << 4*(ch-1) for ch in channels))
+
+	ADC_state = 0
+	for ch in channels:
+		sequence.add(rfe.OP_ADC_POINTS+ch, int(points))
+		ADC_state |= 1 << (ch-1)
+
+	sequence.add(rfe.OP_TRIGGER, trigger_word(ADC_state))
+	sequence.add(rfe.OP_WAIT, 249)
+	sequence.add(rfe.OP_JUMP, sequence.n_cmd-1)
+
+	return 'SEQ 0,' + sequence.to_SCPI()
+
+
+def set_repetitions(sequence_str, n_rep):
+	'''
+	SEQ command repeating its loop n_rep times, for running the same
+	program with a different number of repetitions without recompiling.
+	'''
+
+	start, commands = rfe.parse_sequence(sequence_str)
+
+	loops = np.nonzero(commands[:,0] == rfe.OP_LOOP)[0]
+	if len(loops) == 0:
+		raise ValueError('No loop command in sequence {}...'.format(sequence_str[:40]))
+
+	commands = commands.copy()
+	commands[loops[0], 1] = int(n_rep) - 1
+
+	return 'SEQ ' + ','.join(str(val) for val in [start] + list(commands.ravel()))
+
+
+def relocate_program(program, offset):
+	'''
+	Copy of a program whose DAC data is meant to be written offset rows
+	further in memory (see RFSoC.DAC_ping_pong).
+	'''
+
+	if offset == 0:
+		return program
+
+	sequence_str = program.sequence_str
+	if sequence_str is not None:
+		sequence_str = relocate_sequence(sequence_str, offset)
+
+	return program._replace(sequence_str=sequence_str,
+							DAC_blocks={label: (ch, addr+offset, n_rows) for label, (ch, addr, n_rows) in program.DAC_blocks.items()})
+
+
+
+def precompile_programs(pulse_tables, settings, max_workers=None, wait=True):
+	'''
+	Compile a list of pulse tables in a pool of worker processes.
+
+	Returns the programs in the same order, or with wait=False the list of
+	futures right away, so that the next points of a sweep compile while
+	the instrument is busy acquiring. On Windows the calling script must be
+	protected by if __name__ == '__main__'.
+	'''
+
+	executor = ProcessPoolExecutor(max_workers=max_workers)
+	futures = [executor.submit(compile_program, pulses, settings) for pulses in pulse_tables]
+	executor.shutdown(wait=wait)
+
+	if wait:
+		return [future.result() for future in futures]
+
+	return futures
@@ -0,0 +1,566 @@
+# Streaming signal processing of rfSoC ADC data.
+# Estimators updated block by block as the data is decoded (see
+# rfSoC_acquisition.DecodingSink and ContinuousStream), so that long
+# averages run in constant memory. numpy only, nothing here talks to the
+# instrument.
+
+
+
+
+
+import itertools
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+# periodic windows (as used for spectral estimation)
+WINDOWS = {'hann': lambda n: 0.5 - 0.5*np.cos(2*np.pi*n),
+		   'hamming': lambda n: 0.54 - 0.46*np.cos(2*np.pi*n),
+		   'blackman': lambda n: 0.42 - 0.5*np.cos(2*np.pi*n) + 0.08*np.cos(4*np.pi*n),
+		   'boxcar': lambda n: np.ones_like(n)}
+
+
+def get_window(window, length):
+	'''
+	Window of length points from its name (see WINDOWS) or as given.
+	'''
+
+	if isinstance(window, str):
+
+		if window not in WINDOWS:
+			raise ValueError('Unknown window {}, use one of {}.'.format(window, ', '.join(WINDOWS)))
+
+		return WINDOWS[window](np.arange(length)/length)
+
+	window = np.asarray(window, dtype=float)
+	if len(window) != length:
+		raise ValueError('Window of {} points for segments of {} points.'.format(len(window), length))
+
+	return window
+
+
+
+class WelchPSD:
+	'''
+	One-sided power spectral density (V^2/Hz) of a signal sampled at fs,
+	averaged over windowed segments of segment_length points overlapping by
+	the fraction overlap (Welch's method), accumulated block by block.
+
+	update(trace) adds the segments of a trace. With contiguous=True the
+	trace continues the previous one (continuous acquisition) and segments
+	span both, otherwise (RAW pulses) the end of the previous trace is
+	dropped. The mean of each segment is removed if detrend.
+	'''
+
+	def __init__(self, segment_length=4096, window='hann', overlap=0.5, fs=2e9, detrend=True, batch=256):
+
+		self.segment_length = int(segment_length)
+		self.window = get_window(window, self.segment_length)
+		self.step = max(1, int(round(self.segment_length*(1-overlap))))
+		self.fs = fs
+		self.detrend = detrend
+		self.batch = batch
+		self.reset()
+
+
+	def reset(self):
+
+		self.n_segments = 0
+		self._sum = np.zeros(self.segment_length//2 + 1)
+		self._tail = np.zeros(0)
+
+
+	@property
+	def frequencies(self):
+
+		return np.fft.rfftfreq(self.segment_length, 1/self.fs)
+
+
+	def update(self, trace, contiguous=False):
+
+		x = np.asarray(trace, dtype=float)
+		if contiguous:
+			x = np.concatenate((self._tail, x))
+
+		n_seg = 0
+		if len(x) >= self.segment_length:
+
+			n_seg = 1 + (len(x)-self.segment_length)//self.step
+			segments = np.lib.stride_tricks.sliding_window_view(x, self.segment_length)[::self.step][:n_seg]
+
+			for first in range(0, n_seg, self.batch):
+
+				block = segments[first:first+self.batch]
+				if self.detrend:
+					block = block - block.mean(axis=1, keepdims=True)
+
+				self._sum += (np.abs(np.fft.rfft(block*self.window, axis=1))**2).sum(axis=0)
+
+			self.n_segments += n_seg
+
+		self._tail = x[n_seg*self.step:] if contiguous else np.zeros(0)
+
+
+	def psd(self):
+
+		if self.n_segments == 0:
+			return np.full(len(self._sum), np.nan)
+
+		psd = self._sum/(self.n_segments*self.fs*np.sum(self.window**2))
+
+		# one-sided: negative frequencies folded on the positive ones
+		psd[1:] *= 2
+		if self.segment_length % 2 == 0:
+			psd[-1] /= 2
+
+		return psd
+
+
+
+def lowpass_taps(n_taps, cutoff, fs, window='hamming'):
+	'''
+	Linear phase low pass FIR of n_taps coefficients (windowed sinc) with
+	cutoff frequency cutoff, normalized to unit gain at DC.
+	'''
+
+	if window not in WINDOWS:
+		raise ValueError('Unknown window {}, use one of {}.'.format(window, ', '.join(WINDOWS)))
+
+	n = np.arange(n_taps) - (n_taps-1)/2
+	taps = np.sinc(2*cutoff/fs*n)*WINDOWS[window](np.arange(n_taps)/max(n_taps-1, 1))
+
+	return taps/np.sum(taps)
+
+
+
+class DDCBank:
+	'''
+	Software digital down conversion of a real trace sampled at fs at all
+	the frequencies freqs (Hz) at once: the trace is multiplied by a bank of
+	numerically controlled oscillators exp(-2i pi f t), t = 0 at the first
+	point, then either integrated over the whole trace (decimation=None) or
+	low pass filtered by taps (integrate and dump by default) and decimated.
+
+	demodulate returns the complex amplitudes A exp(i phi) of the tones
+	A cos(2 pi f t + phi), shape (n_tones,) or (n_tones, n_out) with
+	decimation, so that |z|^2/(2*50) is the power of the tone in W. The
+	oscillators are computed once per trace length.
+	'''
+
+	def __init__(self, freqs, fs=2e9, decimation=None, taps=None):
+
+		self.freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+		self.fs = fs
+		self.decimation = decimation
+
+		if decimation is not None and taps is None:
+			taps = np.ones(decimation)/decimation
+
+		self.taps = None if taps is None else np.asarray(taps, dtype=float)
+		self._nco = {}
+
+
+	@property
+	def n_tones(self):
+
+		return len(self.freqs)
+
+
+	def nco(self, length):
+
+		if length not in self._nco:
+			self._nco[length] = np.exp(-2j*np.pi*np.outer(self.freqs, np.arange(length)/self.fs))
+
+		return self._nco[length]
+
+
+	def demodulate(self, trace):
+
+		x = np.asarray(trace, dtype=float)
+
+		if self.decimation is None:
+
+			return 2*(self.nco(len(x)) @ x)/max(len(x), 1)
+
+		if len(x) < len(self.taps):
+
+			return np.zeros((self.n_tones, 0), dtype=complex)
+
+		mixed = self.nco(len(x))*x
+		windows = np.lib.stride_tricks.sliding_window_view(mixed, len(self.taps), axis=1)[:, ::self.decimation]
+
+		return 2*(windows @ self.taps[::-1])
+
+
+
+
+class ThresholdDiscriminator:
+	'''
+	Two state discrimination of the shots I + iQ by a threshold on their
+	projection along the axis exp(i angle): state 1 above, 0 below.
+	'''
+
+	n_states = 2
+
+	def __init__(self, angle=0., threshold=0.):
+
+		self.angle = angle
+		self.threshold = threshold
+
+
+	@classmethod
+	def fit(cls, shots):
+		'''
+		Axis through the means of the calibration shots (I + iQ) of the
+		states 0 and 1, threshold between them weighted by their spreads.
+		'''
+
+		z0, z1 = (np.asarray(z, dtype=complex) for z in shots)
+		angle = np.angle(np.mean(z1) - np.mean(z0))
+
+		p0 = np.real(z0*np.exp(-1j*angle))
+		p1 = np.real(z1*np.exp(-1j*angle))
+		s0, s1 = np.std(p0), np.std(p1)
+		threshold = (np.mean(p0)*s1 + np.mean(p1)*s0)/(s0 + s1) if s0 + s1 > 0 else (np.mean(p0) + np.mean(p1))/2
+
+		return cls(angle, threshold)
+
+
+	def classify(self, I, Q):
+
+		projection = np.asarray(I)*np.cos(self.angle) + np.asarray(Q)*np.sin(self.angle)
+
+		return (projection > self.threshold).astype(np.int8)
+
+
+
+def _log_gaussian(x, mean, cov):
+
+	d = x - mean
+	inv = np.linalg.inv(cov)
+
+	return -0.5*np.einsum('ni,ij,nj->n', d, inv, d) - 0.5*np.log(np.linalg.det(cov)) - np.log(2*np.pi)
+
+
+
+class GaussianMixtureDiscriminator:
+	'''
+	Discrimination of the shots (I, Q) between n_states two dimensional
+	gaussian blobs of given means (n_states, 2), covariances (n_states, 2, 2)
+	and weights: each shot goes to the most probable state.
+	'''
+
+	def __init__(self, means, covariances, weights=None):
+
+		self.means = np.asarray(means, dtype=float)
+		self.covariances = np.asarray(covariances, dtype=float)
+		self.weights = np.full(len(self.means), 1/len(self.means)) if weights is None else np.asarray(weights, dtype=float)
+
+
+	@property
+	def n_states(self):
+
+		return len(self.means)
+
+
+	@classmethod
+	def fit(cls, shots):
+		'''
+		One blob per state from the calibration shots (I + iQ) of each
+		prepared state, in state order.
+		'''
+
+		points = [np.column_stack((np.real(z), np.imag(z))) for z in shots]
+
+		return cls([np.mean(x, axis=0) for x in points], [np.cov(x.T) for x in points])
+
+
+	@classmethod
+	def fit_mixture(cls, shots, n_states=2, n_iter=200, tol=1e-8):
+		'''
+		Blobs found by expectation-maximization in unlabelled calibration
+		shots (I + iQ), numbered along the main axis of the shots.
+		'''
+
+		x = np.column_stack((np.real(shots), np.imag(shots)))
+
+		# start from slices of the shots along their main axis
+		axis = np.linalg.eigh(np.cov(x.T))[1][:,-1]
+		order = np.argsort(x @ axis)
+		groups = np.array_split(order, n_states)
+		means = np.array([np.mean(x[g], axis=0) for g in groups])
+		covariances = np.array([np.cov(x[g].T) + 1e-12*np.eye(2) for g in groups])
+		weights = np.full(n_states, 1/n_states)
+
+		log_likelihood = -np.inf
+		for iteration in range(n_iter):
+
+			log_p = np.column_stack([np.log(weights[k]) + _log_gaussian(x, means[k], covariances[k]) for k in range(n_states)])
+			log_norm = np.logaddexp.reduce(log_p, axis=1)
+			resp = np.exp(log_p - log_norm[:,None])
+
+			n_k = resp.sum(axis=0)
+			weights = n_k/len(x)
+			means = (resp.T @ x)/n_k[:,None]
+			for k in range(n_states):
+				d = x - means[k]
+				covariances[k] = (resp[:,k,None]*d).T @ d/n_k[k] + 1e-12*np.eye(2)
+
+			if np.mean(log_norm) - log_likelihood < tol:
+				break
+			log_likelihood = np.mean(log_norm)
+
+		order = np.argsort(means @ axis)
+
+		return cls(means[order], covariances[order], weights[order])
+
+
+	def classify(self, I, Q):
+
+		x = np.column_stack((np.ravel(I), np.ravel(Q)))
+		log_p = np.column_stack([np.log(self.weights[k]) + _log_gaussian(x, self.means[k], self.covariances[k]) for k in range(self.n_states)])
+
+		return np.argmax(log_p, axis=1).astype(np.int8).reshape(np.shape(I))
+
+
+
+class ShotCounter:
+	'''
+	Single shot readout reduced to counts: the shots of each pulse of the
+	channels of discriminators ({channel: discriminator}) are classified
+	block by block (see rfSoC_acquisition.ShotDecodingSink) and only the
+	counts of each state per pulse (counts[ch], shape (n_pulses, n_states))
+	and of the joint outcomes of all the pulses of all these channels
+	(joint_counts, one axis per entry of outcomes) are kept, and the shots
+	themselves with keep_shots.
+	'''
+
+	def __init__(self, discriminators, n_pulses, keep_shots=False, max_joint=2**20):
+
+		self.discriminators = discriminators
+		self.n_pulses = n_pulses
+		self.keep_shots = keep_shots
+
+		self.outcomes = [(ch, pulse) for ch in sorted(discriminators) for pulse in range(n_pulses)]
+		self.joint_shape = tuple(discriminators[ch].n_states for ch, pulse in self.outcomes)
+
+		if np.prod(self.joint_shape, dtype=float) > max_joint:
+			raise ValueError('{} joint outcomes, more than max_joint={}.'.format(int(np.prod(self.joint_shape, dtype=float)), max_joint))
+
+		self.reset()
+
+
+	def reset(self):
+
+		self.n_shots = 0
+		self.counts = {ch: np.zeros((self.n_pulses, disc.n_states), dtype=np.int64) for ch, disc in self.discriminators.items()}
+		self.joint_counts = np.zeros(self.joint_shape, dtype=np.int64)
+		self._shots = {ch: ([], []) for ch in self.discriminators}
+
+
+	def update(self, I, Q):
+
+		states = []
+		for ch, disc in sorted(self.discriminators.items()):
+
+			ch_states = disc.classify(I[ch-1], Q[ch-1])
+			for pulse in range(self.n_pulses):
+				self.counts[ch][pulse] += np.bincount(ch_states[pulse], minlength=disc.n_states)
+			states.extend(ch_states)
+
+			if self.keep_shots:
+				self._shots[ch][0].append(I[ch-1])
+				self._shots[ch][1].append(Q[ch-1])
+
+		# index of the joint outcome, first outcome most significant
+		index = np.zeros(len(states[0]), dtype=np.int64)
+		for s, n in zip(states, self.joint_shape):
+			index = index*n + s
+
+		self.joint_counts += np.bincount(index, minlength=self.joint_counts.size).reshape(self.joint_shape)
+		self.n_shots += len(index)
+
+
+	def populations(self):
+
+		return {ch: counts/max(self.n_shots, 1) for ch, counts in self.counts.items()}
+
+
+	def shots(self):
+		'''
+		I and Q shots of each channel, shape (n_pulses, n_shots), if kept.
+		'''
+
+		return {ch: (np.concatenate(I, axis=1), np.concatenate(Q, axis=1)) for ch, (I, Q) in self._shots.items() if len(I)>0}
+
+
+
+def _central_moment(raw, order):
+	'''
+	Central moment tensor of the given order from the raw moments
+	raw[k] = E[y^(x)k] (raw[1] is the mean), by binomial expansion.
+	'''
+
+	mean = raw[1]
+	letters = 'abcd'[:order]
+	moment = 0
+
+	for k in range(order+1):
+		for subset in itertools.combinations(range(order), k):
+			rest = [a for a in range(order) if a not in subset]
+			operands = [mean]*k + ([raw[len(rest)]] if len(rest) > 0 else [])
+			indices = [letters[a] for a in subset] + ([''.join(letters[a] for a in rest)] if len(rest) > 0 else [])
+			moment = moment + (-1)**k*np.einsum('...{}->...{}'.format(',...'.join(indices), letters), *operands)
+
+	return moment
+
+
+
+class CovarianceAccumulator:
+	'''
+	Moments of the shots (I1, Q1, I2, Q2, ...) of the channels, per pulse,
+	accumulated block by block (see rfSoC_acquisition.ShotDecodingSink) as
+	sums of products up to the given order (2 to 4) of the shots minus a
+	reference taken from the first block, so that long acquisitions (e.g.
+	two mode squeezing over 10^8 shots) run in constant memory without
+	losing precision. Accumulators with the same reference add (merge).
+
+	covariance() and covariance_error() are per pulse (n_pulses, d, d), d
+	= 2*len(channels); the error is estimated from the fourth moments with
+	order=4, for gaussian shots otherwise. central_moment(k) and
+	cumulant(k) give the third and fourth order tensors for
+	non-gaussianity tests.
+	'''
+
+	def __init__(self, channels, n_pulses, order=2):
+
+		if order not in (2, 3, 4):
+			raise ValueError('Moments of order 2 to 4, not {}.'.format(order))
+
+		self.channels = list(channels)
+		self.n_pulses = n_pulses
+		self.order = order
+		self.dim = 2*len(self.channels)
+		self.labels = [iq+str(ch) for ch in self.channels for iq in 'IQ']
+		self.reference = None
+		self.reset()
+
+
+	def reset(self):
+		'''
+		Drop the sums, the reference is kept.
+		'''
+
+		self.n_shots = 0
+		self.sums = {k: 0. for k in range(1, self.order+1)}
+
+
+	def empty_like(self):
+		'''
+		New accumulator with the same reference, to be merged into this one.
+		'''
+
+		other = CovarianceAccumulator(self.channels, self.n_pulses, self.order)
+		other.reference = self.reference
+
+		return other
+
+
+	def merge(self, other):
+
+		if other.n_shots == 0:
+			return
+
+		if self.n_shots == 0:
+			self.reference = other.reference
+
+		elif not np.array_equal(self.reference, other.reference):
+			raise ValueError('Accumulators with different references.')
+
+		for k in self.sums:
+			self.sums[k] = self.sums[k] + other.sums[k]
+		self.n_shots += other.n_shots
+
+
+	def update(self, I, Q, n_rep=None):
+
+		# shots of each pulse as (n_pulses, n_shots, d)
+		x = np.stack([part[ch-1] for ch in self.channels for part in (I, Q)], axis=-1)
+
+		if self.reference is None:
+			self.reference = x.mean(axis=1)
+
+		y = x - self.reference[:,None,:]
+		y2 = np.einsum('pni,pnj->pnij', y, y)
+
+		self.sums[1] = self.sums[1] + y.sum(axis=1)
+		self.sums[2] = self.sums[2] + y2.sum(axis=1)
+		if self.order >= 3:
+			self.sums[3] = self.sums[3] + np.einsum('pnij,pnk->pijk', y2, y, optimize=True)
+		if self.order >= 4:
+			self.sums[4] = self.sums[4] + np.einsum('pnij,pnkl->pijkl', y2, y2, optimize=True)
+
+		self.n_shots += x.shape[1]
+
+
+	def result(self):
+		'''
+		The accumulator itself, as merger of a chunked acquisition (see
+		RFSoC.get_readout_pulse_chunked).
+		'''
+
+		return self
+
+
+	def _raw(self):
+
+		return {k: self.sums[k]/self.n_shots for k in self.sums}
+
+
+	def mean(self):
+
+		return self.reference + self.sums[1]/self.n_shots
+
+
+	def central_moment(self, order):
+
+		if order > self.order:
+			raise ValueError('Moments accumulated up to order {}.'.format(self.order))
+
+		return _central_moment(self._raw(), order)
+
+
+	def covariance(self):
+
+		return self.central_moment(2)*self.n_shots/max(self.n_shots-1, 1)
+
+
+	def covariance_error(self):
+
+		mu2 = self.central_moment(2)
+		diag = np.einsum('pii->pi', mu2)
+
+		if self.order >= 4:
+			# variance of the products (x_i - m_i)(x_j - m_j)
+			var = np.einsum('pijij->pij', self.central_moment(4)) - mu2**2
+		else:
+			var = diag[:,:,None]*diag[:,None,:] + mu2**2
+
+		return np.sqrt(np.maximum(var, 0)/self.n_shots)
+
+
+	def cumulant(self, order):
+		'''
+		Third or fourth order cumulant tensor, zero for gaussian shots.
+		'''
+
+		mu = self.central_moment(order)
+		if order == 3:
+			return mu
+
+		mu2 = self.central_moment(2)
+		return (mu - np.einsum('pij,pkl->pijkl', mu2, mu2) - np.einsum('pik,pjl->pijkl', mu2, mu2)
+				- np.einsum('pil,pjk->pijkl', mu2, mu2))
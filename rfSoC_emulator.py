@@ -0,0 +1,377 @@
+# Software emulator of the rfSoC sequencer.
+# Runs the SEQ programs produced by rfSoC_compiler (rfSoC.RFSoC) or by
+# SequenceGeneration_v2 and reports their clock-cycle timeline, the DAC and
+# ADC activity of each channel and the amount of data sent per repetition,
+# without the instrument. plan_repetition uses the same data model to size
+# the dead time at the end of each repetition.
+
+
+
+
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+# sequencer opcodes
+OP_WAIT = 1				# wait argument+1 clock cycles
+OP_JUMP = 3				# jump to the command of index argument (endless loops)
+OP_LOOP = 257			# repeat the following commands argument+1 times
+OP_END = 513			# end of the loop body, jump back to its beginning
+OP_TRIGGER = 4096		# trigger word: DAC control bits and ADC states
+OP_DAC_ADDR = 4096		# 4096+ch: DAC ch plays from row address argument
+OP_ADC_POINTS = 4106	# 4106+ch: ADC ch acquires argument points, 4106: acquisition mode of all ADCs
+
+# header of each ADC data packet: 8 words of 16 bits
+HEADER_BYTES = 16
+# payload of an accumulated (IQ) event: 64 bits for I and 64 bits for Q
+IQ_BYTES = 16
+
+
+
+def event_bytes(points, accumulate, decimation=1):
+	'''
+	Bytes sent by one ADC acquisition of points samples (at 2 GS/s), in
+	accumulation (IQ) mode or as raw 16 bits samples after decimation.
+	'''
+
+	if accumulate:
+		return HEADER_BYTES + IQ_BYTES
+	else:
+		return HEADER_BYTES + 2*int(points//decimation)
+
+
+def plan_repetition(body_cycles, ADC_events, acq_mode, period_sync=1, link_throughput=None,
+					FIFO_size=None, decimation=None, FPGA_clock=250e6, jump_cycles=2, min_cycles=0):
+	'''
+	Shortest repetition period of a loop body of body_cycles clock cycles.
+
+	The period is a multiple of period_sync (cycles of freq_sync) so that
+	the sequence stays phase locked, leaves room for the final wait (at
+	least one cycle), the end command and the jump, lasts at least
+	min_cycles (e.g. the duration of the pulses, longer than the sequencer
+	commands of the body when a DAC plays from memory), and if link_throughput
+	(bytes/s, see RFSoC.transfer_speed) is given, lets the link send the
+	data of one repetition. ADC_events are (stop cycle, ch, points) of the
+	acquisitions in the body and acq_mode is the 4106 acquisition mode word.
+	With FIFO_size (bytes) the output FIFO, filled at the end of each
+	acquisition and emptied at link_throughput, is checked for overflow.
+
+	Returns a dict with the period in cycles, the argument of the final wait
+	command, the repetition rate (Hz), the bytes per repetition, the data
+	rate (bytes/s), the peak FIFO occupancy (bytes) and what limits the
+	period ('sequence', 'link' or 'FIFO').
+	'''
+
+	if decimation is None:
+		decimation = [1,1,1,1,1,1,1,1]
+
+	events = sorted((stop, event_bytes(points, (acq_mode >> 4*(ch-1)) & 0xF, decimation[ch-1])) for stop, ch, points in ADC_events)
+	bytes_per_rep = sum(n_bytes for stop, n_bytes in events)
+
+	# final wait of at least one cycle, end command and jump
+	cycles = max(body_cycles + 2 + jump_cycles, int(np.ceil(min_cycles)))
+	limited_by = 'sequence'
+
+	if link_throughput is not None:
+
+		link_cycles = int(np.ceil(bytes_per_rep*FPGA_clock/link_throughput))
+		if link_cycles > cycles:
+			cycles = link_cycles
+			limited_by = 'link'
+
+	period = int(np.ceil(cycles/period_sync))*period_sync
+
+	FIFO_peak = bytes_per_rep
+	if link_throughput is not None:
+
+		drain = link_throughput/FPGA_clock
+		while True:
+
+			# two repetitions to reach the occupancy carried from one to the next
+			occupancy = 0.
+			for rep in range(2):
+
+				FIFO_peak = 0.
+				t_prev = 0
+				for stop, n_bytes in events:
+					occupancy = max(occupancy - drain*(stop-t_prev), 0.) + n_bytes
+					FIFO_peak = max(FIFO_peak, occupancy)
+					t_prev = stop
+				occupancy = max(occupancy - drain*(period-t_prev), 0.)
+
+			if FIFO_size is None or FIFO_peak <= FIFO_size or occupancy == 0:
+				break
+
+			# empty the FIFO before the next repetition
+			period += period_sync
+			limited_by = 'FIFO'
+
+	if FIFO_size is not None and FIFO_peak > FIFO_size:
+
+		raise ValueError('Output FIFO overflow: {:.0f} bytes queued within one repetition for a {} bytes FIFO ({} bytes per repetition).'.format(FIFO_peak,FIFO_size,bytes_per_rep))
+
+	return dict(period_cycles=period,
+				wait_arg=period-body_cycles-2-jump_cycles,
+				rep_rate=FPGA_clock/period,
+				bytes_per_rep=bytes_per_rep,
+				data_rate=bytes_per_rep*FPGA_clock/period,
+				FIFO_peak=FIFO_peak,
+				limited_by=limited_by)
+
+
+
+def parse_sequence(sequence_str):
+	'''
+	Split a 'SEQ addr,op,arg,op,arg,...' command into its start address and
+	an (n, 2) integer array of (opcode, argument) pairs.
+	'''
+
+	values = sequence_str.strip()
+	if values.startswith('SEQ'):
+		values = values[3:]
+
+	values = np.array(values.split(','), dtype=np.int64)
+	n_cmd = (len(values)-1)//2
+
+	return int(values[0]), values[1:1+2*n_cmd].reshape(n_cmd,2)
+
+
+
+def DAC_samples(data, n_cycles):
+	'''
+	Samples played by a DAC during n_cycles clock cycles (one row each)
+	from a block of flat memory rows (8 samples, 2 triggers and the
+	repetition field), looping over the block as for a CW pulse.
+	'''
+
+	rows = np.asarray(data, dtype=np.int64).reshape(-1, 11)
+	played = np.repeat(rows[:,:8], rows[:,10]+1, axis=0)
+
+	return np.resize(played, (n_cycles, 8)).reshape(-1)
+
+
+
+class SequencerEmulator:
+	'''
+	Cycle-accurate model of the rfSoC sequencer.
+
+	Every command takes one clock cycle except waits (argument+1 cycles)
+	and the end of the loop, which takes 1+jump_cycles cycles to jump back.
+	A DAC channel starts playing from its current row address when its
+	control bits are 011 in a trigger word and stops on 001 (000 leaves it
+	unchanged). An ADC acquisition starts on the rising edge of the channel
+	bit and lasts its number of points at 8 samples per clock cycle.
+	'''
+
+	def __init__(self, FPGA_clock=250e6, jump_cycles=2, decimation=None, DAC_memory_rows=16384):
+
+		self.FPGA_clock = FPGA_clock
+		self.jump_cycles = jump_cycles
+		# decimation factor of each ADC channel (data volume in RAW mode)
+		self.decimation = decimation if decimation is not None else [1,1,1,1,1,1,1,1]
+		self.DAC_memory_rows = DAC_memory_rows
+
+
+	def run(self, sequence_str, DAC_rows=None):
+		'''
+		Emulate a SEQ command. DAC_rows optionally gives the number of rows
+		written in the memory of each DAC channel {ch: rows} to check the
+		addresses played by the sequence.
+
+		Returns a dict with the command timeline of one repetition (cycle,
+		opcode, argument), the DAC and ADC activity of each channel as
+		(start cycle, stop cycle, address or points) within a repetition,
+		the setup and repetition periods in cycles and seconds, the total
+		duration, the bytes of data sent per repetition and in total, the
+		resulting data rate in bytes/s, and a list of warnings.
+		'''
+
+		start_address, program = parse_sequence(sequence_str)
+		warnings = []
+
+		loop_index = np.where(program[:,0] == OP_LOOP)[0]
+		end_index = np.where(program[:,0] == OP_END)[0]
+
+		if len(loop_index) > 0:
+
+			loop_start = loop_index[0]
+			n_rep = int(program[loop_start,1]) + 1
+			loop_end = end_index[end_index > loop_start][0] if np.any(end_index > loop_start) else len(program)
+			if loop_end == len(program):
+				warnings.append('Loop without end command (513).')
+
+		else:
+
+			loop_start = -1
+			n_rep = 1
+			loop_end = end_index[0] if len(end_index) > 0 else len(program)
+
+		state = dict(DAC_addr=np.zeros(8, dtype=np.int64),
+					 DAC_playing=np.zeros(8, dtype=bool),
+					 DAC_start=np.zeros(8, dtype=np.int64),
+					 ADC_points=np.zeros(8, dtype=np.int64),
+					 ADC_state=0,
+					 ADC_busy_until=np.zeros(8, dtype=np.int64),
+					 acq_mode=0)
+
+		# setup commands before the loop
+		setup_cycles, _, _, _ = self._execute(program[:loop_start+1] if loop_start >= 0 else program[:0], state, 0, warnings, DAC_rows)
+
+		# two passes of the loop body: the second one is the steady state
+		body = program[loop_start+1:loop_end]
+		first = self._execute(body, state, 0, warnings, DAC_rows)
+		period_first = first[0] + 1 + self.jump_cycles if loop_start >= 0 else first[0]
+
+		if n_rep > 1:
+			# end command and jump back to the beginning of the loop
+			state['ADC_busy_until'] = np.maximum(state['ADC_busy_until']-1-self.jump_cycles, 0)
+			steady = self._execute(body, state, 0, [], DAC_rows)
+			period = steady[0] + 1 + self.jump_cycles
+		else:
+			steady = first
+			period = period_first
+
+		cycles, timeline, DAC_activity, ADC_activity = steady
+
+		bytes_first = self._data_bytes(first[3], state['acq_mode'])
+		bytes_per_rep = self._data_bytes(ADC_activity, state['acq_mode'])
+
+		if any(len(first[3].get(ch,[])) != len(ADC_activity.get(ch,[])) for ch in range(1,9)):
+			warnings.append('The first repetition does not trigger the same ADC events as the following ones.')
+
+		for ch, events in ADC_activity.items():
+			for start, stop, points in events:
+				if stop > period:
+					warnings.append('ADC{} acquisition ends {} cycles after the end of the repetition.'.format(ch,stop-period))
+
+		total_cycles = setup_cycles + period_first + (n_rep-1)*period
+		total_bytes = bytes_first + (n_rep-1)*bytes_per_rep
+
+		return dict(start_address=start_address,
+					timeline=timeline,
+					DAC_activity=DAC_activity,
+					ADC_activity=ADC_activity,
+					n_rep=n_rep,
+					setup_cycles=setup_cycles,
+					period_cycles=period,
+					period=period/self.FPGA_clock,
+					total_cycles=total_cycles,
+					total_time=total_cycles/self.FPGA_clock,
+					bytes_per_rep=bytes_per_rep,
+					total_bytes=total_bytes,
+					data_rate=bytes_per_rep*self.FPGA_clock/period,
+					warnings=warnings)
+
+
+	def run_program(self, program):
+		'''
+		Emulate a compiled rfSoC_compiler.RFSoCProgram, checking its DAC
+		addresses against the DAC memory it uploads.
+		'''
+
+		DAC_rows = {ch: len(data)//11 for ch, data in program.DAC_data.items()}
+
+		return self.run(program.sequence_str, DAC_rows)
+
+
+	def _execute(self, commands, state, cycle, warnings, DAC_rows):
+
+		timeline = []
+		DAC_activity = {}
+		ADC_activity = {}
+		cycle_start = cycle
+
+		for opcode, arg in commands:
+
+			opcode = int(opcode)
+			arg = int(arg)
+			timeline.append((cycle-cycle_start, opcode, arg))
+
+			if opcode == OP_WAIT:
+
+				if arg < 0:
+					warnings.append('Negative wait ({}) at cycle {}.'.format(arg,cycle-cycle_start))
+				cycle += max(arg,0) + 1
+				continue
+
+			if opcode == OP_TRIGGER:
+
+				for ch in range(1,9):
+
+					DAC_bits = (arg >> 3*(ch-1)) & 0b111
+					if DAC_bits & 0b001:
+
+						if state['DAC_playing'][ch-1]:
+							DAC_activity.setdefault(ch, []).append((state['DAC_start'][ch-1]-cycle_start, cycle-cycle_start, int(state['DAC_addr'][ch-1])))
+
+						state['DAC_playing'][ch-1] = bool(DAC_bits & 0b010)
+						state['DAC_start'][ch-1] = cycle
+
+						if state['DAC_playing'][ch-1] and DAC_rows is not None:
+							if ch not in DAC_rows or state['DAC_addr'][ch-1] >= DAC_rows[ch]:
+								warnings.append('DAC{} plays row {} beyond its written memory.'.format(ch,state['DAC_addr'][ch-1]))
+
+				ADC_state = (arg >> 24) & 0xFF
+				rising = ADC_state & ~state['ADC_state']
+				for ch in range(1,9):
+
+					if rising & (1 << (ch-1)):
+
+						points = int(state['ADC_points'][ch-1])
+						if points == 0:
+							warnings.append('ADC{} triggered without acquisition points.'.format(ch))
+						if state['ADC_busy_until'][ch-1] > cycle:
+							warnings.append('ADC{} retriggered {} cycles before the end of its acquisition.'.format(ch,state['ADC_busy_until'][ch-1]-cycle))
+
+						stop = cycle + int(np.ceil(points/8))
+						state['ADC_busy_until'][ch-1] = stop
+						ADC_activity.setdefault(ch, []).append((cycle-cycle_start, stop-cycle_start, points))
+
+				state['ADC_state'] = ADC_state
+
+			elif OP_DAC_ADDR < opcode < OP_ADC_POINTS:
+
+				ch = opcode - OP_DAC_ADDR
+				if ch <= 8:
+					if arg >= self.DAC_memory_rows:
+						warnings.append('DAC{} address {} out of the DAC memory.'.format(ch,arg))
+					state['DAC_addr'][ch-1] = arg
+
+			elif opcode == OP_ADC_POINTS:
+
+				state['acq_mode'] = arg
+
+			elif OP_ADC_POINTS < opcode <= OP_ADC_POINTS+8:
+
+				state['ADC_points'][opcode-OP_ADC_POINTS-1] = arg
+
+			cycle += 1
+
+		# DAC channels still playing at the end of the block
+		for ch in range(1,9):
+			if state['DAC_playing'][ch-1]:
+				DAC_activity.setdefault(ch, []).append((state['DAC_start'][ch-1]-cycle_start, cycle-cycle_start, int(state['DAC_addr'][ch-1])))
+				state['DAC_start'][ch-1] = cycle
+
+		# the following block starts at cycle 0 again
+		state['ADC_busy_until'] = np.maximum(state['ADC_busy_until']-cycle, 0)
+		state['DAC_start'] -= cycle
+
+		return cycle-cycle_start, timeline, DAC_activity, ADC_activity
+
+
+	def _data_bytes(self, ADC_activity, acq_mode):
+
+		n_bytes = 0
+		for ch, events in ADC_activity.items():
+
+			# one nibble per ADC: non zero for accumulation (IQ), 0 for RAW
+			accumulate = (acq_mode >> 4*(ch-1)) & 0xF
+			for start, stop, points in events:
+				n_bytes += event_bytes(points, accumulate, self.decimation[ch-1])
+
+		return n_bytes
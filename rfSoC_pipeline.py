@@ -0,0 +1,153 @@
+# Pipelined calibration sweeps.
+# Each point of a calibration (see rfSoC_support) sets external instruments
+# (Vaunix attenuator and phase shifter, microwave sources), runs a pulse
+# table on the rfSoC and reduces the data. CalibrationRunner overlaps these
+# steps instead of running them one after the other: the programs are
+# compiled ahead in a worker thread, in ping-pong mode the next program is
+# written to the idle half of the DAC memories while the current one
+# acquires (see RFSoC.stage_program), and the instruments of the next point
+# are set in worker threads as soon as the current acquisition has returned,
+# while its data is reduced and the next program is uploaded. A point is
+# only acquired once its instruments have settled.
+
+
+
+
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import rfSoC_compiler as rfc
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+def power_dBm(I, Q):
+	'''
+	RMS power in dBm of each channel and pulse of an acquisition, as the
+	ADC_power_dBm parameter of rfSoC.RFSoC.
+	'''
+
+	Pow = [[],[],[],[],[],[],[],[]]
+
+	for i in range(8):
+
+		Sq = [np.mean(I[i][j]**2) + np.mean(Q[i][j]**2) for j in range(len(I[i])) if len(I[i][j])>0]
+		Pow[i] = 10*np.log10(1e3*np.array(Sq)/(50*2))
+
+	return Pow
+
+
+
+class CalibrationRunner:
+	'''
+	Run the points of a calibration on rfsoc_device. A point is a dict with
+	settings, a list of (parameter, value) of external instruments (e.g.
+	(Vaunix_Att_device.attn, 12.5)), set in parallel, and pulses, the pulse
+	table to run (None keeps the uploaded program). The acquisition of a
+	point starts settle seconds after its last instrument is set (the
+	point's 'settle', settle_time by default). reduce turns the (I, Q) of
+	each acquisition into the result of the point (power_dBm by default).
+	'''
+
+	def __init__(self, rfsoc_device, reduce=power_dBm, settle_time=0.2, max_workers=4):
+
+		self.rfsoc_device = rfsoc_device
+		self.reduce = reduce
+		self.settle_time = settle_time
+		self.max_workers = max_workers
+
+
+	def run(self, points):
+		'''
+		Results of reduce for each point, in order. The instrument settings
+		of the compilation (n_rep, mixers, ...) must not change during the
+		run.
+		'''
+
+		device = self.rfsoc_device
+		points = list(points)
+		if len(points)==0:
+			return []
+
+		settings = device.compile_settings()
+		cache = device.active_program_cache()
+		ping_pong = device.DAC_ping_pong
+
+		compiler = ThreadPoolExecutor(max_workers=1)
+		setter = ThreadPoolExecutor(max_workers=self.max_workers)
+
+		# compiled one after the other in the background, in the order of the points
+		programs = [None if point.get('pulses') is None else
+					compiler.submit(rfc.compile_program, point['pulses'], settings, cache, device.debug_mode) for point in points]
+
+		results = []
+		data = None
+		staged = False
+
+		try:
+
+			for k, point in enumerate(points):
+
+				jobs = [setter.submit(self._set, parameter, value) for parameter, value in point.get('settings', [])]
+
+				if programs[k] is not None:
+
+					if staged:
+						device.swap_program()
+					else:
+						device.upload_program(programs[k].result())
+					device.pulses = point['pulses']
+
+				# previous point reduced while the instruments settle
+				if data is not None:
+					results.append(self.reduce(*data))
+
+				if len(jobs)>0:
+					set_time = max(job.result() for job in jobs)
+					wait = set_time + point.get('settle', self.settle_time) - time.perf_counter()
+					if wait > 0:
+						time.sleep(wait)
+
+				staged = ping_pong and k+1 < len(points) and programs[k+1] is not None
+				if staged:
+					next_program = programs[k+1]
+					while_running = lambda: device.stage_program(next_program.result())
+				else:
+					while_running = None
+
+				data = device.get_readout_pulse(while_running=while_running)
+
+				log.info('Calibration point {}/{}'.format(k+1,len(points)))
+
+			results.append(self.reduce(*data))
+
+		finally:
+
+			for program in programs:
+				if program is not None:
+					program.cancel()
+			compiler.shutdown(wait=True)
+			setter.shutdown(wait=True)
+
+		return results
+
+
+	def run_point(self, point):
+		'''
+		Result of a single point, e.g. for the points asked one by one by
+		an optimizer (see rfSoC_calibration).
+		'''
+
+		return self.run([point])[0]
+
+
+	@staticmethod
+	def _set(parameter, value):
+
+		parameter(value)
+
+		return time.perf_counter()
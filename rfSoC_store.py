@@ -0,0 +1,277 @@
+# Compressed on-disk store of decoded rfSoC shots.
+# Shot arrays (one per sweep point, channel, pulse and quadrature) are cut in
+# chunks of a fixed number of repetitions, each compressed losslessly (delta,
+# byte shuffle, deflate) and appended to one data file. A json index keeps
+# the position of each chunk so that a slice of repetitions only
+# decompresses the chunks it overlaps. Datasets keep the location of the
+# store instead of the shots (see rfSoC.RFSoC.store_shots).
+
+
+
+
+
+import os
+import json
+import zlib
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+
+
+
+DATA_FILE = 'shots.bin'
+INDEX_FILE = 'index.json'
+
+
+def encode_chunk(data, level=1):
+	'''
+	Lossless compression of a 1D array: difference of consecutive values
+	(integers) or xor of consecutive bit patterns (floats), bytes of same
+	significance grouped (shuffle), then deflate.
+	'''
+
+	data = np.ascontiguousarray(data)
+	width = data.dtype.itemsize
+	bits = data.view('u{}'.format(width))
+
+	delta = bits.copy()
+	if data.dtype.kind in 'iu':
+		delta[1:] = bits[1:] - bits[:-1]
+	else:
+		delta[1:] = bits[1:] ^ bits[:-1]
+
+	shuffled = delta.view(np.uint8).reshape(-1, width).T.copy()
+
+	return zlib.compress(shuffled.tobytes(), level)
+
+
+def decode_chunk(blob, dtype, length):
+
+	dtype = np.dtype(dtype)
+	width = dtype.itemsize
+
+	shuffled = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(width, length)
+	delta = shuffled.T.copy().view('u{}'.format(width))[:,0]
+
+	if dtype.kind in 'iu':
+		bits = np.cumsum(delta, dtype=delta.dtype)
+	else:
+		bits = np.bitwise_xor.accumulate(delta)
+
+	return bits.view(dtype)
+
+
+
+class ShotStore:
+	'''
+	Store of shot arrays in the directory location, written by chunks of
+	chunk_reps repetitions. append takes the decoded shots of a block of
+	repetitions (lists of 8 arrays (n_pulses, n) as returned by decode_IQ),
+	shots returns a lazy ShotArray of one (channel, pulse, quadrature) of a
+	sweep point. Use as a context manager, or call close, so that the last
+	chunks and the index are written.
+	'''
+
+	def __init__(self, location, chunk_reps=65536, level=1):
+
+		self.location = location
+		self.chunk_reps = int(chunk_reps)
+		self.level = level
+
+		os.makedirs(location, exist_ok=True)
+		self._data_path = os.path.join(location, DATA_FILE)
+		self._index_path = os.path.join(location, INDEX_FILE)
+
+		# {key: [[first_rep, n_rep, offset, n_bytes], ...]}, key 'point/channel/pulse/quadrature'
+		self.index = {}
+		self.dtypes = {}
+		if os.path.exists(self._index_path):
+			with open(self._index_path) as f:
+				saved = json.load(f)
+			self.index = saved['chunks']
+			self.dtypes = saved['dtypes']
+
+		self._pending = {}
+		self._file = None
+
+
+	def __enter__(self):
+
+		return self
+
+
+	def __exit__(self, *exc):
+
+		self.close()
+
+
+	@staticmethod
+	def key(point, ch, pulse, quadrature):
+
+		return '{}/{}/{}/{}'.format(point, ch, pulse, quadrature)
+
+
+	def keys(self):
+
+		return [tuple(int(k) if k.isdigit() else k for k in key.split('/')) for key in self.index]
+
+
+	def append(self, I, Q, point=0):
+
+		for v in range(8):
+			for quadrature, data in (('I', I[v]), ('Q', Q[v])):
+				for pulse in range(len(data)):
+					self.write(self.key(point, v+1, pulse, quadrature), np.asarray(data[pulse]))
+
+
+	def write(self, key, data):
+		'''
+		Append the shots data (1D) to the array key, full chunks are written.
+		'''
+
+		pending = self._pending.setdefault(key, [])
+		pending.append(data)
+
+		if key not in self.dtypes:
+			self.dtypes[key] = data.dtype.str
+
+		n_pending = sum(len(block) for block in pending)
+		if n_pending >= self.chunk_reps:
+
+			data = np.concatenate(pending)
+			n_full = (len(data)//self.chunk_reps)*self.chunk_reps
+			for first in range(0, n_full, self.chunk_reps):
+				self._write_chunk(key, data[first:first+self.chunk_reps])
+
+			self._pending[key] = [data[n_full:]]
+
+
+	def _write_chunk(self, key, data):
+
+		if self._file is None:
+			self._file = open(self._data_path, 'ab')
+
+		chunks = self.index.setdefault(key, [])
+		first_rep = chunks[-1][0] + chunks[-1][1] if len(chunks)>0 else 0
+
+		blob = encode_chunk(data.astype(self.dtypes[key], copy=False), self.level)
+		offset = self._file.seek(0, os.SEEK_END)
+		self._file.write(blob)
+
+		chunks.append([first_rep, len(data), offset, len(blob)])
+
+
+	def flush(self):
+		'''
+		Write the incomplete chunks and the index.
+		'''
+
+		for key, pending in self._pending.items():
+			data = np.concatenate(pending) if len(pending)>0 else []
+			if len(data)>0:
+				self._write_chunk(key, data)
+		self._pending = {}
+
+		if self._file is not None:
+			self._file.flush()
+
+		with open(self._index_path, 'w') as f:
+			json.dump({'chunks': self.index, 'dtypes': self.dtypes}, f)
+
+
+	def close(self):
+
+		self.flush()
+
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+
+	def shots(self, ch, pulse=0, quadrature='I', point=0):
+
+		key = self.key(point, ch, pulse, quadrature)
+		if key not in self.index:
+			raise KeyError('No shots {} in {}.'.format(key, self.location))
+
+		return ShotArray(self, key)
+
+
+	def read(self, key, start, stop):
+		'''
+		Repetitions start to stop of the array key, only the chunks they
+		overlap are read and decompressed.
+		'''
+
+		chunks = self.index[key]
+		parts = []
+
+		with open(self._data_path, 'rb') as f:
+			for first_rep, n_rep, offset, n_bytes in chunks:
+
+				if first_rep + n_rep <= start or first_rep >= stop:
+					continue
+
+				f.seek(offset)
+				data = decode_chunk(f.read(n_bytes), self.dtypes[key], n_rep)
+				parts.append(data[max(start-first_rep, 0):stop-first_rep])
+
+		if len(parts)==0:
+			return np.zeros(0, dtype=self.dtypes[key])
+
+		return np.concatenate(parts)
+
+
+
+class ShotArray:
+	'''
+	Lazy 1D view of the shots of a ShotStore: slicing reads only the
+	chunks needed.
+	'''
+
+	def __init__(self, store, key):
+
+		self.store = store
+		self.key = key
+
+
+	def __len__(self):
+
+		chunks = self.store.index[self.key]
+
+		return chunks[-1][0] + chunks[-1][1]
+
+
+	@property
+	def shape(self):
+
+		return (len(self),)
+
+
+	def __getitem__(self, item):
+
+		if isinstance(item, slice):
+
+			reps = range(*item.indices(len(self)))
+			if len(reps) == 0:
+				return np.zeros(0, dtype=self.store.dtypes[self.key])
+
+			first = min(reps[0], reps[-1])
+
+			return self.store.read(self.key, first, max(reps[0], reps[-1])+1)[np.asarray(reps) - first]
+
+		item = int(item)
+		if item < 0:
+			item += len(self)
+		if not 0 <= item < len(self):
+			raise IndexError('Repetition {} out of {}.'.format(item, len(self)))
+
+		return self.store.read(self.key, item, item+1)[0]
+
+
+	def __array__(self, dtype=None):
+
+		data = self[:]
+
+		return data if dtype is None else data.astype(dtype)
@@ -25,6 +25,9 @@ from notify import snotify
 from progress_barV2 import bar
 from general_functions import find_nearest
 
+import rfSoC_calibration as rfcal
+import rfSoC_pipeline as rfp
+
 import plotly.express as px
 import pandas as pd
 import numpy as np
@@ -36,32 +39,35 @@ import matplotlib.pyplot as plt
 
 
 
-def optimize_IQ_balance(rfsoc_device,nu,nu_det_offset,display_plots=False,pump_sig_ch=[1,2],amp=0.05,dc_offset_I=8,dc_offset_Q=6,active_mode='lower',acq_length = 10, adc_start = 1.0):
+def optimize_IQ_balance(rfsoc_device,nu,nu_det_offset,display_plots=False,pump_sig_ch=[1,2],amp=0.05,dc_offset_I=8,dc_offset_Q=6,active_mode='lower',acq_length = 10, adc_start = 1.0,
+						phase=90., amp_ratio=1., optimize_dc=False, budget=8, return_all=False):
+
+	# Image sideband (ADC2) and LO leakage (ADC1) powers fitted by their known
+	# dependence on phase, amplitude ratio and DC offsets, see
+	# rfSoC_calibration.IQBalanceOptimizer: budget acquisitions instead of a grid.
+	# The phase is returned, as with the grid; with optimize_dc ADC1 measures the
+	# LO leakage instead of the signal and the DC offsets found are only returned
+	# with return_all (with amp_ratio and the measurements).
 
 	mem_seq_display = rfsoc_device.display_sequence
 	rfsoc_device.display_sequence = False
 
-	phase_vec = np.arange(0,360,10)
-	data_down = np.array([])
-	data_up = np.array([])
 	num_repetitions = 10_000
 
 	[ch_1,ch_2] = pump_sig_ch
 
-	for phase_offset in phase_vec:
-			
+	def measure(point):
+
 		param_sin_I = {'amp':amp,
 					 'freq':nu,
-					 'dc_offset':dc_offset_I*1e-3,
+					 'dc_offset':point['dc_offset_I']*1e-3,
 					 'phase_offset':0}
 
-		param_sin_Q = {'amp':amp,
+		param_sin_Q = {'amp':amp*point['amp_ratio'],
 					 'freq':nu,
-					 'dc_offset':dc_offset_Q*1e-3,
-					 'phase_offset':np.pi*phase_offset/180} 
-		
-		
-		
+					 'dc_offset':point['dc_offset_Q']*1e-3,
+					 'phase_offset':np.pi*point['phase']/180}
+
 		pulse_sin = dict(label='signal+pump', 
 							  module='DAC', 
 							  channel=ch_1, 
@@ -98,10 +104,6 @@ def optimize_IQ_balance(rfsoc_device,nu,nu_det_offset,display_plots=False,pump_s
 							  param=None, 
 							  parent=None)
 
-		
-		
-		
-		
 		pulses = pd.DataFrame()
 		pulses = pulses.append(pulse_sin, ignore_index=True)
 		pulses = pulses.append(record_sin, ignore_index=True)
@@ -112,7 +114,10 @@ def optimize_IQ_balance(rfsoc_device,nu,nu_det_offset,display_plots=False,pump_s
 
 
 		rfsoc_device.acquisition_mode('IQ')
-		rfsoc_device.ADC1.fmixer(nu-nu_det_offset)#MHz
+		if optimize_dc:
+			rfsoc_device.ADC1.fmixer(nu_det_offset)#MHz, LO leakage
+		else:
+			rfsoc_device.ADC1.fmixer(nu-nu_det_offset)#MHz
 		rfsoc_device.ADC2.fmixer(nu+nu_det_offset)#MHz
 		rfsoc_device.freq_sync(1e6)
 		rfsoc_device.ADC1.status('ON')
@@ -122,163 +127,36 @@ def optimize_IQ_balance(rfsoc_device,nu,nu_det_offset,display_plots=False,pump_s
 
 
 		rfsoc_device.process_sequencing()
-		
-		data_raw = rfsoc_device.ADC_power_dBm()[:2]
-
-		data_down = np.append(data_down,data_raw[0])
-		data_up = np.append(data_up,data_raw[1])
-
-	if display_plots:
-
-		fig = plt.figure(figsize=(16,12))
-		ax3 = fig.add_subplot(221)
-		ax3.plot(phase_vec,data_down, label='ch1',  marker = '.', color = 'orange')
-		ax3.plot(phase_vec,data_up, label='ch2',  marker = '.', color = 'blue')
-		plt.legend()
-		plt.xlabel('Phase [degree]', fontsize = 14)
-		plt.ylabel('PSD (dBm)', fontsize = 14)
-		plt.grid()
-		plt.show()
-
-		# plt.figure(figsize=(14, 10), dpi= 80) #facecolor='w', edgecolor='k'
-		# x_label='Phase [degree]'
-		# y_label='PSD [dBm]'
-
-		# plt.rc('axes', labelsize=10)    # fontsize of the x and y labels
-		# plt.rc('xtick', labelsize=12)    # fontsize of the tick labels
-		# plt.rc('ytick', labelsize=12)    # fontsize of the tick labels
-		# plt.rc('grid', linestyle="--")
-		# plt.grid(True)
-
-		# plt.plot(phase_vec,data_down,label='data_ch1')
-		# plt.plot(phase_vec,data_up,label='data_ch2')
-
-		# plt.xlabel(x_label, size=14)
-		# plt.ylabel(y_label, size=14)
-
-		# plt.legend(fontsize = 12)
-		# plt.show()
-
-	optimal_phase_1 = phase_vec[find_nearest(data_up,np.min(data_up))]
-
-	phase_vec = np.arange(optimal_phase_1-5,optimal_phase_1+5,1)
-	data_down = np.array([])
-	data_up = np.array([])
-
-	for phase_offset in phase_vec:
-			
-		param_sin_I = {'amp':amp,
-					 'freq':nu,
-					 'dc_offset':dc_offset_I*1e-3,
-					 'phase_offset':0}
-
-		param_sin_Q = {'amp':amp,
-					 'freq':nu,
-					 'dc_offset':dc_offset_Q*1e-3,
-					 'phase_offset':np.pi*phase_offset/180} 
-		
-		
-		
-		pulse_sin = dict(label='signal+pump', 
-							  module='DAC', 
-							  channel=1, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+2, 
-							  param=param_sin_I, 
-							  parent=None)
-
-		record_sin = dict(label='record_both', 
-							  module='ADC', 
-							  channel=1, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
-		pulse_sin2 = dict(label='signal+pump2', 
-							  module='DAC', 
-							  channel=2, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+2, 
-							  param=param_sin_Q, 
-							  parent=None)
 
-		record_sin2 = dict(label='record_both2', 
-							  module='ADC', 
-							  channel=2, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
-		
-		
-		
-		
-		pulses = pd.DataFrame()
-		pulses = pulses.append(pulse_sin, ignore_index=True)
-		pulses = pulses.append(record_sin, ignore_index=True)
-		pulses = pulses.append(pulse_sin2, ignore_index=True)
-		pulses = pulses.append(record_sin2, ignore_index=True)
-
-		rfsoc_device.pulses = pulses
-
-
-		rfsoc_device.acquisition_mode('IQ')
-		rfsoc_device.ADC1.fmixer(nu-nu_det_offset)#MHz
-		rfsoc_device.ADC2.fmixer(nu+nu_det_offset)#MHz
-		rfsoc_device.freq_sync(1e6)
-		rfsoc_device.ADC1.status('ON')
-		rfsoc_device.ADC2.status('ON')
-		rfsoc_device.output_format('BIN')
-		rfsoc_device.n_rep(num_repetitions)
-
-
-		rfsoc_device.process_sequencing()
-		
 		data_raw = rfsoc_device.ADC_power_dBm()[:2]
 
-		data_down = np.append(data_down,data_raw[0])
-		data_up = np.append(data_up,data_raw[1])
+		# linear powers (mW) for the models
+		return 10**(data_raw[1][0]/10), 10**(data_raw[0][0]/10) if optimize_dc else np.nan
+
+	optimizer = rfcal.IQBalanceOptimizer(phase=phase, amp_ratio=amp_ratio, dc_offset_I=dc_offset_I, dc_offset_Q=dc_offset_Q,
+										 budget=budget, optimize_dc=optimize_dc)
+	optimum = optimizer.run(measure)
 
 	if display_plots:
 
 		fig = plt.figure(figsize=(16,12))
 		ax3 = fig.add_subplot(221)
-		ax3.plot(phase_vec,data_down, label='ch1',  marker = '.', color = 'orange')
-		ax3.plot(phase_vec,data_up, label='ch2',  marker = '.', color = 'blue')
+		ax3.plot(10*np.log10(optimizer.image), label='image (ch2)',  marker = '.', color = 'blue')
+		if optimize_dc:
+			ax3.plot(10*np.log10(optimizer.leakage), label='LO leakage (ch1)',  marker = '.', color = 'orange')
 		plt.legend()
-		plt.xlabel('Phase [degree]', fontsize = 14)
+		plt.xlabel('Acquisition', fontsize = 14)
 		plt.ylabel('PSD (dBm)', fontsize = 14)
 		plt.grid()
 		plt.show()
 
-		# plt.figure(figsize=(14, 10), dpi= 80) #facecolor='w', edgecolor='k'
-		# x_label='Phase [degree]'
-		# y_label='PSD [dBm]'
-
-		# plt.rc('axes', labelsize=10)    # fontsize of the x and y labels
-		# plt.rc('xtick', labelsize=12)    # fontsize of the tick labels
-		# plt.rc('ytick', labelsize=12)    # fontsize of the tick labels
-		# plt.rc('grid', linestyle="--")
-		# plt.grid(True)
-
-		# plt.plot(phase_vec,data_down,label='data_ch1')
-		# plt.plot(phase_vec,data_up,label='data_ch2')
-
-		# plt.xlabel(x_label, size=14)
-		# plt.ylabel(y_label, size=14)
+	rfsoc_device.display_sequence = mem_seq_display
 
-		# plt.legend(fontsize = 12)
-		# plt.show()
+	if return_all:
 
-	rfsoc_device.display_sequence = mem_seq_display
+		return optimum
 
-	return phase_vec[find_nearest(data_up,np.min(data_up))]
+	return optimum['phase']
 
 
 
@@ -325,6 +203,9 @@ class gain_signal_idler_cls:
 		self.optimal_amp_if_cancel = 0.5
 		self.optimal_phase = 92
 
+		# wait after setting the sources before acquiring (s)
+		self.settle_time = 0.2
+
 	def g(self):
 
 		ch_out_weak_I = self.ch_out_weak_I
@@ -605,21 +486,25 @@ class gain_signal_idler_cls:
 
 		adc_start = wait_time/2
 
+		# the sources of a point are set while the previous point is reduced
+		# and the program of the next one uploaded, see rfSoC_pipeline
+		points = []
+
 		for gain_mode in ['idl','sig']:
 
 			if gain_mode == 'idl':
 
 				nu_weak = nu_if
 				phase_offset_weak = phase_offset_idl
-				MW_source_gen_sig.frequency(nu_p*1e9 + nu_if*1e6 - delta*1e6)
-				MW_source_det.frequency(nu_p*1e9 + nu_if*1e6 - nu_det_offset_idl*1e6 - delta*1e6)
+				nu_gen_sig = nu_p*1e9 + nu_if*1e6 - delta*1e6
+				nu_det = nu_p*1e9 + nu_if*1e6 - nu_det_offset_idl*1e6 - delta*1e6
 
 			else:
 
 				nu_weak = nu_if
 				phase_offset_weak = phase_offset_sig
-				MW_source_gen_sig.frequency(nu_p*1e9 + nu_if*1e6 + delta*1e6)
-				MW_source_det.frequency(nu_p*1e9 + nu_if*1e6 - nu_det_offset_sig*1e6 + delta*1e6)
+				nu_gen_sig = nu_p*1e9 + nu_if*1e6 + delta*1e6
+				nu_det = nu_p*1e9 + nu_if*1e6 - nu_det_offset_sig*1e6 + delta*1e6
 
 			param_sin_I_pump = {'amp':amp_if,
 							 'freq':nu_if,
@@ -805,28 +690,22 @@ class gain_signal_idler_cls:
 			pulses = pulses.append(record_weak, ignore_index=True)
 			pulses = pulses.append(record_weak2, ignore_index=True)
 
-			rfsoc_device.pulses = pulses
-
-			rfsoc_device.acquisition_mode('IQ')
-			rfsoc_device.ADC1.decfact(1)
-			rfsoc_device.ADC2.decfact(1)
-			rfsoc_device.freq_sync(1e6)
-			rfsoc_device.ADC1.fmixer(nu_if - nu_det_offset_sig)
-			rfsoc_device.ADC2.fmixer(nu_if - nu_det_offset_idl)
-			rfsoc_device.ADC1.status('ON')
-			rfsoc_device.ADC2.status('ON')
-			rfsoc_device.output_format('BIN')
-			rfsoc_device.n_rep(num_rep)
-			rfsoc_device.process_sequencing()
-
-			if gain_mode == 'idl':
+			points.append(dict(settings=[(MW_source_gen_sig.frequency, nu_gen_sig), (MW_source_det.frequency, nu_det)],
+							   pulses=pulses))
 
-				data_idl = np.array(rfsoc_device.ADC_power_dBm()[0:2])
-
-			else:
+		rfsoc_device.acquisition_mode('IQ')
+		rfsoc_device.ADC1.decfact(1)
+		rfsoc_device.ADC2.decfact(1)
+		rfsoc_device.freq_sync(1e6)
+		rfsoc_device.ADC1.fmixer(nu_if - nu_det_offset_sig)
+		rfsoc_device.ADC2.fmixer(nu_if - nu_det_offset_idl)
+		rfsoc_device.ADC1.status('ON')
+		rfsoc_device.ADC2.status('ON')
+		rfsoc_device.output_format('BIN')
+		rfsoc_device.n_rep(num_rep)
 
-				data_sig = np.array(rfsoc_device.ADC_power_dBm()[0:2])
-				
+		runner = rfp.CalibrationRunner(rfsoc_device, settle_time=self.settle_time)
+		data_idl, data_sig = [np.array(power[0:2]) for power in runner.run(points)]
 							
 		gain_sig = data_sig[0,0]-data_sig[0,1]
 		gain_idl = data_idl[1,0]-data_idl[1,1]
@@ -874,6 +753,12 @@ class pump_cancellation_cls:
 		self.amp_if_cancel_window_narrowing = 40
 		self.amp_if_cancel_points = 21
 
+		# acquisitions of the model based optimizers (get_optimal_attn_phase, get_pump_cancel_rfsoc)
+		self.budget = 12
+
+		# wait after setting the attenuator or phase shifter before acquiring (s)
+		self.settle_time = 0.2
+
 		self.phase_offset_if = 0    # degrees
 		self.angle_amp_if = 45 # degrees
 		self.dc_offset_I_pump = 8
@@ -1035,103 +920,45 @@ class pump_cancellation_cls:
 
 		rfsoc_device.process_sequencing()
 
-		for iter_n in range(iter_depth):
+		# residual pump power fitted by the interference of the pump with the
+		# cancellation tone, see rfSoC_calibration.CancellationOptimizer
+		optimizer = rfcal.CancellationOptimizer(phase=np.mean(phase_range), amplitude=np.mean(attn_range), amplitude_range=(0,50),
+												phase_step=120., amplitude_step=(attn_range[1]-attn_range[0])/5,
+												to_linear=lambda attn: 10**(-attn/20), from_linear=lambda a: -20*np.log10(a),
+												amplitude_quantum=0.05, phase_quantum=1., budget=self.budget)
+		runner = rfp.CalibrationRunner(rfsoc_device, settle_time=self.settle_time)
+		pow_vec_0 = np.array([])
+		pow_vec_1 = np.array([])
 
-			# optimize phase 
+		def measure(point):
 
-			phase_vec_org = np.linspace(phase_range[0],phase_range[1],phase_points)
-			phase_vec = self.process_phase(phase_vec_org)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for phase in phase_vec:
+			nonlocal pow_vec_0, pow_vec_1
 
-				Vaunix_FS_device.phase_shift(phase)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
-
-				# IQ_data = []
-				# data_out_I,data_out_Q = rfsoc_device.IQINT_AVG()
-				# data_out1 = np.zeros((2, 8, 2))
-				# data_out1[0][0] = data_out_I[0]
-				# data_out1[1][0] = data_out_Q[0]
-				# IQ_data.append(list(data_out1))
-				# IQ_data = np.array(IQ_data)
-				# I_ch1_on = IQ_data[:, 0, 0, 0]
-				# I_ch2_on = IQ_data[:, 0, 1, 0]
-				# Q_ch1_on = IQ_data[:, 1, 0, 0]
-				# Q_ch2_on = IQ_data[:, 1, 1, 0]
-				# Mag_ch2_on = (I_ch2_on**2 + Q_ch2_on**2)/50 ## W
-				# Mag_ch2_on_dBm = 10 * np.log10(Mag_ch2_on*1e3) 
-				# Mag_ch1_on = (I_ch1_on**2 + Q_ch1_on**2)/50 ## W
-				# Mag_ch1_on_dBm = 10 * np.log10(Mag_ch1_on*1e3) 
-				# pow_vec_0 = np.append(pow_vec_0,Mag_ch1_on_dBm)
-				# pow_vec_1 = np.append(pow_vec_1,Mag_ch2_on_dBm)
+			# phase shifter and attenuator set in parallel
+			pow_tmp = runner.run_point(dict(settings=[(Vaunix_FS_device.phase_shift, point['phase']), (Vaunix_Att_device.attn, point['amplitude'])]))
+			pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
+			pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
 
-			if display_plots:
+			return 10**(pow_tmp[0][0]/10)
 
-				fig = plt.figure(figsize=(16,12))
-				ax3 = fig.add_subplot(221)
-				ax3.plot(phase_vec_org,pow_vec_0, label='ch1',  marker = '.', color = 'orange')
-				ax3.plot(phase_vec_org,pow_vec_1, label='ch2',  marker = '.', color = 'blue')
-				plt.legend()
-				plt.xlabel('Phase [degree]', fontsize = 14)
-				plt.ylabel('Power (dBm)', fontsize = 14)
-				plt.grid()
-				plt.show()
+		optimum = optimizer.run(measure)
+		phase_min = optimum['phase']
+		attn_min = optimum['amplitude']
 
-			phase_min = phase_vec[np.argmin(pow_vec_0)]
-			Vaunix_FS_device.phase_shift(phase_min)
-			phase_sweep_mag = (phase_range[1]-phase_range[0])*phase_window_narrowing/100
-			if phase_sweep_mag<phase_points:
-				phase_sweep_mag = phase_points
-			phase_range = (phase_min-0.5*phase_sweep_mag,phase_min+0.5*phase_sweep_mag)
-
-			# optimize attn 
-
-			attn_vec = np.linspace(attn_range[0],attn_range[1],attn_points)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for attn in attn_vec:
-				if attn < 0.0:
-					attn = 0.0
-					print('attn cannot be < 0, set to be = 0')
-				Vaunix_Att_device.attn(attn)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
-
-			if display_plots:
-
-				fig = plt.figure(figsize=(16,12))
-				ax3 = fig.add_subplot(221)
-				ax3.plot(attn_vec,pow_vec_0, label='ch1',  marker = '.', color = 'orange')
-				ax3.plot(attn_vec,pow_vec_1, label='ch2',  marker = '.', color = 'blue')
-				plt.legend()
-				plt.xlabel('Attenuation [dB]', fontsize = 14)
-				plt.ylabel('Power (dBm)', fontsize = 14)
-				plt.grid()
-				plt.show()
-
-			attn_min = int(attn_vec[np.argmin(pow_vec_0)])
-			if attn_min < 0:
-				attn_min = 0
-				print('attn_min cannot be < 0, set to be = 0')
+		Vaunix_FS_device.phase_shift(phase_min)
+		Vaunix_Att_device.attn(attn_min)
 
+		if display_plots:
 
-			Vaunix_Att_device.attn(attn_min)
-			attn_sweep_mag = (attn_range[1]-attn_range[0])*attn_window_narrowing/100
-			if attn_sweep_mag<attn_points*0.1:
-				attn_sweep_mag = attn_points*0.1
-			if (attn_min+0.5*attn_sweep_mag) > 50:
-				attn_range = (attn_min-0.5*attn_sweep_mag,50)
-			elif (attn_min-0.5*attn_sweep_mag)<0:
-				attn_range = (0,attn_min+0.5*attn_sweep_mag)
-			else:
-				attn_range = (attn_min-0.5*attn_sweep_mag,attn_min+0.5*attn_sweep_mag)
-			
-		pow_min = pow_vec_0[np.argmin(pow_vec_0)]
-
+			fig = plt.figure(figsize=(16,12))
+			ax3 = fig.add_subplot(221)
+			ax3.plot(pow_vec_0, label='ch1',  marker = '.', color = 'orange')
+			ax3.plot(pow_vec_1, label='ch2',  marker = '.', color = 'blue')
+			plt.legend()
+			plt.xlabel('Acquisition', fontsize = 14)
+			plt.ylabel('Power (dBm)', fontsize = 14)
+			plt.grid()
+			plt.show()
 
 		rfsoc_device.display_sequence = mem_display_sequence
 		rfsoc_device.display_IQ_progress = mem_display_IQ_progress
@@ -1284,38 +1111,19 @@ class pump_cancellation_cls:
 
 		rfsoc_device.process_sequencing()
 
+		# each scan is run by a CalibrationRunner: the next phase or
+		# attenuation is set while the previous point is reduced
+		runner = rfp.CalibrationRunner(rfsoc_device, settle_time=self.settle_time)
+
 		for iter_n in range(iter_depth):
 
 			# optimize phase 
 
 			phase_vec_org = np.linspace(phase_range[0],phase_range[1],phase_points)
 			phase_vec = self.process_phase(phase_vec_org)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for phase in phase_vec:
-
-				Vaunix_FS_device.phase_shift(phase)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
-
-				# IQ_data = []
-				# data_out_I,data_out_Q = rfsoc_device.IQINT_AVG()
-				# data_out1 = np.zeros((2, 8, 2))
-				# data_out1[0][0] = data_out_I[0]
-				# data_out1[1][0] = data_out_Q[0]
-				# IQ_data.append(list(data_out1))
-				# IQ_data = np.array(IQ_data)
-				# I_ch1_on = IQ_data[:, 0, 0, 0]
-				# I_ch2_on = IQ_data[:, 0, 1, 0]
-				# Q_ch1_on = IQ_data[:, 1, 0, 0]
-				# Q_ch2_on = IQ_data[:, 1, 1, 0]
-				# Mag_ch2_on = (I_ch2_on**2 + Q_ch2_on**2)/50 ## W
-				# Mag_ch2_on_dBm = 10 * np.log10(Mag_ch2_on*1e3) 
-				# Mag_ch1_on = (I_ch1_on**2 + Q_ch1_on**2)/50 ## W
-				# Mag_ch1_on_dBm = 10 * np.log10(Mag_ch1_on*1e3) 
-				# pow_vec_0 = np.append(pow_vec_0,Mag_ch1_on_dBm)
-				# pow_vec_1 = np.append(pow_vec_1,Mag_ch2_on_dBm)
+			pow_tmp = runner.run([dict(settings=[(Vaunix_FS_device.phase_shift, phase)]) for phase in phase_vec])
+			pow_vec_0 = np.array([power[0][0] for power in pow_tmp])
+			pow_vec_1 = np.array([power[1][0] for power in pow_tmp])
 
 			if display_plots:
 
@@ -1339,16 +1147,11 @@ class pump_cancellation_cls:
 			# optimize attn 
 
 			attn_vec = np.linspace(attn_range[0],attn_range[1],attn_points)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for attn in attn_vec:
-				if attn < 0.0:
-					attn = 0.0
-					print('attn cannot be < 0, set to be = 0')
-				Vaunix_Att_device.attn(attn)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
+			if np.any(attn_vec < 0.0):
+				print('attn cannot be < 0, set to be = 0')
+			pow_tmp = runner.run([dict(settings=[(Vaunix_Att_device.attn, max(attn, 0.0))]) for attn in attn_vec])
+			pow_vec_0 = np.array([power[0][0] for power in pow_tmp])
+			pow_vec_1 = np.array([power[1][0] for power in pow_tmp])
 
 			if display_plots:
 
@@ -1439,278 +1242,126 @@ class pump_cancellation_cls:
 		# 			 'dc_offset':self.dc_offset_Q_pump*1e-3,
 		# 			 'phase_offset':np.pi*phase_offset_if/180}
 
-		amp_min = amp_if_cancel_range[0]
-
-		for iter_n in range(iter_depth):
-
-			# optimize phase 
-
-			phase_vec_org = np.linspace(phase_range[0],phase_range[1],phase_points)
-			phase_vec = self.process_phase(phase_vec_org)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-
-			print('Optimal DAC voltage = ' +str(amp_min))
-
-			for phase in bar(phase_vec):
-
-
-
-				param_sin_I_pump = {'amp':amp_if,
-					 'freq':nu_if,
-					 'dc_offset':self.dc_offset_I_pump*1e-3,
-					 'phase_offset':0}
-
-				param_sin_Q_pump = {'amp':amp_if,
-					 'freq':nu_if,
-					 'dc_offset':self.dc_offset_Q_pump*1e-3,
-					 'phase_offset':np.pi*phase_offset_if/180}
-
-
-				param_sin_cancel = {'amp':amp_min,
-					 'freq':nu_if,
-					 'dc_offset':0,
-					 'phase_offset':np.pi*phase/180}
-
-				pulse_pump_I = dict(label='pumpI', 
-							  module='DAC', 
-							  channel=self.dac_pump_I, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_I_pump, 
-							  parent=None)
-
-				pulse_pump_Q = dict(label='pumpQ',
-							  module='DAC',
-							  channel=self.dac_pump_Q, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_Q_pump, 
-							  parent=None)
-
-				pulse_cancel_pump = dict(label='cancel_pump',
-							  module='DAC',
-							  channel=self.dac_pump_cancel, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_cancel, 
-							  parent=None)
-				
-
-				record_both = dict(label='record_both', 
-							  module='ADC', 
-							  channel=1, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
-				record_both2 = dict(label='record_both2', 
-							  module='ADC', 
-							  channel=2, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
+		rfsoc_device.acquisition_mode('IQ')
 
+		rfsoc_device.ADC1.fmixer(nu_if)
+		rfsoc_device.ADC2.fmixer(nu_if)
+		rfsoc_device.ADC1.decfact(1)
+		rfsoc_device.ADC2.decfact(1)
+		rfsoc_device.freq_sync(1e6)
+		rfsoc_device.ADC1.status('ON')
+		rfsoc_device.ADC2.status('ON')
+		rfsoc_device.output_format('BIN')
+		rfsoc_device.n_rep(num_rep)
 
-				pulses = pd.DataFrame()
-				pulses = pulses.append(pulse_pump_I, ignore_index=True)
-				pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-				pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
-				pulses = pulses.append(record_both, ignore_index=True)
-				pulses = pulses.append(record_both2, ignore_index=True)
+		runner = rfp.CalibrationRunner(rfsoc_device)
+		pow_vec_0 = np.array([])
+		pow_vec_1 = np.array([])
 
-				rfsoc_device.pulses = pulses
+		def measure(point):
 
-				rfsoc_device.acquisition_mode('IQ')
+			nonlocal pow_vec_0, pow_vec_1
 
-				rfsoc_device.ADC1.fmixer(nu_if)
-				rfsoc_device.ADC2.fmixer(nu_if)
-				rfsoc_device.ADC1.decfact(1)
-				rfsoc_device.ADC2.decfact(1)
-				rfsoc_device.freq_sync(1e6)
-				rfsoc_device.ADC1.status('ON')
-				rfsoc_device.ADC2.status('ON')
-				rfsoc_device.output_format('BIN')
-				rfsoc_device.n_rep(num_rep)
-
-				rfsoc_device.process_sequencing()
+			param_sin_I_pump = {'amp':amp_if,
+				 'freq':nu_if,
+				 'dc_offset':self.dc_offset_I_pump*1e-3,
+				 'phase_offset':0}
 
+			param_sin_Q_pump = {'amp':amp_if,
+				 'freq':nu_if,
+				 'dc_offset':self.dc_offset_Q_pump*1e-3,
+				 'phase_offset':np.pi*phase_offset_if/180}
 
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
-
-				# IQ_data = []
-				# data_out_I,data_out_Q = rfsoc_device.IQINT_AVG()
-				# data_out1 = np.zeros((2, 8, 2))
-				# data_out1[0][0] = data_out_I[0]
-				# data_out1[1][0] = data_out_Q[0]
-				# IQ_data.append(list(data_out1))
-				# IQ_data = np.array(IQ_data)
-				# I_ch1_on = IQ_data[:, 0, 0, 0]
-				# I_ch2_on = IQ_data[:, 0, 1, 0]
-				# Q_ch1_on = IQ_data[:, 1, 0, 0]
-				# Q_ch2_on = IQ_data[:, 1, 1, 0]
-				# Mag_ch2_on = (I_ch2_on**2 + Q_ch2_on**2)/50 ## W
-				# Mag_ch2_on_dBm = 10 * np.log10(Mag_ch2_on*1e3) 
-				# Mag_ch1_on = (I_ch1_on**2 + Q_ch1_on**2)/50 ## W
-				# Mag_ch1_on_dBm = 10 * np.log10(Mag_ch1_on*1e3) 
-				# pow_vec_0 = np.append(pow_vec_0,Mag_ch1_on_dBm)
-				# pow_vec_1 = np.append(pow_vec_1,Mag_ch2_on_dBm)
 
-			if display_plots:
+			param_sin_cancel = {'amp':point['amplitude'],
+				 'freq':nu_if,
+				 'dc_offset':0,
+				 'phase_offset':np.pi*point['phase']/180}
 
-				fig = plt.figure(figsize=(16,12))
-				ax3 = fig.add_subplot(221)
-				ax3.plot(phase_vec_org,pow_vec_0, label='ch1',  marker = '.', color = 'orange')
-				ax3.plot(phase_vec_org,pow_vec_1, label='ch2',  marker = '.', color = 'blue')
-				plt.legend()
-				plt.xlabel('Phase [degree]', fontsize = 14)
-				plt.ylabel('Power (dBm)', fontsize = 14)
-				plt.grid()
-				plt.show()
-
-			phase_min = phase_vec[np.argmin(pow_vec_0)]
-			
-			phase_sweep_mag = (phase_range[1]-phase_range[0])*phase_window_narrowing/100
-			if phase_sweep_mag<phase_points:
-				phase_sweep_mag = phase_points
-			phase_range = (phase_min-0.5*phase_sweep_mag,phase_min+0.5*phase_sweep_mag)
-
-			# optimize DAc voltage 
+			pulse_pump_I = dict(label='pumpI', 
+						  module='DAC', 
+						  channel=self.dac_pump_I, 
+						  mode='sin', 
+						  start=0, 
+						  length=acq_length+wait_time, 
+						  param=param_sin_I_pump, 
+						  parent=None)
 
-			dac_v_vec = np.linspace(amp_if_cancel_range[0],amp_if_cancel_range[1],amp_if_cancel_points)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([]) 
+			pulse_pump_Q = dict(label='pumpQ',
+						  module='DAC',
+						  channel=self.dac_pump_Q, 
+						  mode='sin', 
+						  start=0, 
+						  length=acq_length+wait_time, 
+						  param=param_sin_Q_pump, 
+						  parent=None)
+
+			pulse_cancel_pump = dict(label='cancel_pump',
+						  module='DAC',
+						  channel=self.dac_pump_cancel, 
+						  mode='sin', 
+						  start=0, 
+						  length=acq_length+wait_time, 
+						  param=param_sin_cancel, 
+						  parent=None)
 			
-			print('Optimal phase = ' +str(phase_min))
-
-			for amp in bar(dac_v_vec):
-				
-				
-				
-
-				param_sin_I_pump = {'amp':amp_if,
-					 'freq':nu_if,
-					 'dc_offset':self.dc_offset_I_pump*1e-3,
-					 'phase_offset':0}
-
-				param_sin_Q_pump = {'amp':amp_if,
-					 'freq':nu_if,
-					 'dc_offset':self.dc_offset_Q_pump*1e-3,
-					 'phase_offset':np.pi*phase_offset_if/180}
-
-
-				param_sin_cancel = {'amp':amp,
-					 'freq':nu_if,
-					 'dc_offset':0,
-					 'phase_offset':np.pi*phase_min/180}
-
-				pulse_pump_I = dict(label='pumpI', 
-							  module='DAC', 
-							  channel=self.dac_pump_I, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_I_pump, 
-							  parent=None)
-
-				pulse_pump_Q = dict(label='pumpQ',
-							  module='DAC',
-							  channel=self.dac_pump_Q, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_Q_pump, 
-							  parent=None)
-
-				pulse_cancel_pump = dict(label='cancel_pump',
-							  module='DAC',
-							  channel=self.dac_pump_cancel, 
-							  mode='sin', 
-							  start=0, 
-							  length=acq_length+wait_time, 
-							  param=param_sin_cancel, 
-							  parent=None)
-				
-
-				record_both = dict(label='record_both', 
-							  module='ADC', 
-							  channel=1, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
-				record_both2 = dict(label='record_both2', 
-							  module='ADC', 
-							  channel=2, 
-							  mode='raw', 
-							  start=adc_start, 
-							  length=acq_length, 
-							  param=None, 
-							  parent=None)
-
 
+			record_both = dict(label='record_both', 
+						  module='ADC', 
+						  channel=1, 
+						  mode='raw', 
+						  start=adc_start, 
+						  length=acq_length, 
+						  param=None, 
+						  parent=None)
 
-				pulses = pd.DataFrame()
-				pulses = pulses.append(pulse_pump_I, ignore_index=True)
-				pulses = pulses.append(pulse_pump_Q, ignore_index=True)
-				pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
-				pulses = pulses.append(record_both, ignore_index=True)
-				pulses = pulses.append(record_both2, ignore_index=True)
+			record_both2 = dict(label='record_both2', 
+						  module='ADC', 
+						  channel=2, 
+						  mode='raw', 
+						  start=adc_start, 
+						  length=acq_length, 
+						  param=None, 
+						  parent=None)
 
-				rfsoc_device.pulses = pulses
 
-				rfsoc_device.acquisition_mode('IQ')
 
-				rfsoc_device.ADC1.fmixer(nu_if)
-				rfsoc_device.ADC2.fmixer(nu_if)
-				rfsoc_device.ADC1.decfact(1)
-				rfsoc_device.ADC2.decfact(1)
-				rfsoc_device.freq_sync(1e6)
-				rfsoc_device.ADC1.status('ON')
-				rfsoc_device.ADC2.status('ON')
-				rfsoc_device.output_format('BIN')
-				rfsoc_device.n_rep(num_rep)
-
-				rfsoc_device.process_sequencing()
-
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
+			pulses = pd.DataFrame()
+			pulses = pulses.append(pulse_pump_I, ignore_index=True)
+			pulses = pulses.append(pulse_pump_Q, ignore_index=True)
+			pulses = pulses.append(pulse_cancel_pump, ignore_index=True)
+			pulses = pulses.append(record_both, ignore_index=True)
+			pulses = pulses.append(record_both2, ignore_index=True)
 
-			if display_plots:
+			pow_tmp = runner.run_point(dict(pulses=pulses))
+			pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
+			pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
 
-				fig = plt.figure(figsize=(16,12))
-				ax3 = fig.add_subplot(221)
-				ax3.plot(dac_v_vec,pow_vec_0, label='ch1',  marker = '.', color = 'orange')
-				ax3.plot(dac_v_vec,pow_vec_1, label='ch2',  marker = '.', color = 'blue')
-				plt.legend()
-				plt.xlabel('Dac voltage [V]', fontsize = 14)
-				plt.ylabel('Power (dBm)', fontsize = 14)
-				plt.grid()
-				plt.show()
+			return 10**(pow_tmp[0][0]/10)
 
-			amp_min = dac_v_vec[np.argmin(pow_vec_0)]
-			
+		# same interference model as get_optimal_attn_phase, with the DAC
+		# amplitude of the cancellation tone instead of the attenuator
+		optimizer = rfcal.CancellationOptimizer(phase=np.mean(phase_range), amplitude=np.mean(amp_if_cancel_range),
+												amplitude_range=amp_if_cancel_range, phase_step=120.,
+												amplitude_step=(amp_if_cancel_range[1]-amp_if_cancel_range[0])/5, budget=self.budget)
+		optimum = optimizer.run(measure)
+		phase_min = optimum['phase']
+		amp_min = optimum['amplitude']
 
+		print('Optimal phase = ' +str(phase_min))
+		print('Optimal DAC voltage = ' +str(amp_min))
 
-			
-			amp_if_cancel_sweep_mag = (amp_if_cancel_range[1]-amp_if_cancel_range[0])*amp_if_cancel_window_narrowing/100
-			amp_if_cancel_range = (amp_min-0.5*amp_if_cancel_sweep_mag,amp_min+0.5*amp_if_cancel_sweep_mag)
-			
-		pow_min = pow_vec_0[np.argmin(pow_vec_0)]
+		if display_plots:
 
+			fig = plt.figure(figsize=(16,12))
+			ax3 = fig.add_subplot(221)
+			ax3.plot(pow_vec_0, label='ch1',  marker = '.', color = 'orange')
+			ax3.plot(pow_vec_1, label='ch2',  marker = '.', color = 'blue')
+			plt.legend()
+			plt.xlabel('Acquisition', fontsize = 14)
+			plt.ylabel('Power (dBm)', fontsize = 14)
+			plt.grid()
+			plt.show()
 
 		rfsoc_device.display_sequence = mem_display_sequence
 		rfsoc_device.display_IQ_progress = mem_display_IQ_progress
@@ -1866,38 +1517,19 @@ class pump_cancellation_cls:
 
 		rfsoc_device.process_sequencing()
 
+		# each scan is run by a CalibrationRunner: the next phase or
+		# attenuation is set while the previous point is reduced
+		runner = rfp.CalibrationRunner(rfsoc_device, settle_time=self.settle_time)
+
 		for iter_n in range(iter_depth):
 
 			# optimize phase 
 
 			phase_vec_org = np.linspace(phase_range[0],phase_range[1],phase_points)
 			phase_vec = self.process_phase(phase_vec_org)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for phase in phase_vec:
-
-				Vaunix_FS_device.phase_shift(phase)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
-
-				# IQ_data = []
-				# data_out_I,data_out_Q = rfsoc_device.IQINT_AVG()
-				# data_out1 = np.zeros((2, 8, 2))
-				# data_out1[0][0] = data_out_I[0]
-				# data_out1[1][0] = data_out_Q[0]
-				# IQ_data.append(list(data_out1))
-				# IQ_data = np.array(IQ_data)
-				# I_ch1_on = IQ_data[:, 0, 0, 0]
-				# I_ch2_on = IQ_data[:, 0, 1, 0]
-				# Q_ch1_on = IQ_data[:, 1, 0, 0]
-				# Q_ch2_on = IQ_data[:, 1, 1, 0]
-				# Mag_ch2_on = (I_ch2_on**2 + Q_ch2_on**2)/50 ## W
-				# Mag_ch2_on_dBm = 10 * np.log10(Mag_ch2_on*1e3) 
-				# Mag_ch1_on = (I_ch1_on**2 + Q_ch1_on**2)/50 ## W
-				# Mag_ch1_on_dBm = 10 * np.log10(Mag_ch1_on*1e3) 
-				# pow_vec_0 = np.append(pow_vec_0,Mag_ch1_on_dBm)
-				# pow_vec_1 = np.append(pow_vec_1,Mag_ch2_on_dBm)
+			pow_tmp = runner.run([dict(settings=[(Vaunix_FS_device.phase_shift, phase)]) for phase in phase_vec])
+			pow_vec_0 = np.array([power[0][0] for power in pow_tmp])
+			pow_vec_1 = np.array([power[1][0] for power in pow_tmp])
 
 			if display_plots:
 
@@ -1922,16 +1554,11 @@ class pump_cancellation_cls:
 			# optimize attn 
 
 			attn_vec = np.linspace(attn_range[0],attn_range[1],attn_points)
-			pow_vec_0 = np.array([])
-			pow_vec_1 = np.array([])
-			for attn in attn_vec:
-				if attn < 0.0:
-					attn = 0.0
-					print('attn cannot be < 0, set to be = 0')
-				Vaunix_Att_device.attn(attn)
-				pow_tmp = rfsoc_device.ADC_power_dBm()
-				pow_vec_0 = np.append(pow_vec_0,pow_tmp[0][0])
-				pow_vec_1 = np.append(pow_vec_1,pow_tmp[1][0])
+			if np.any(attn_vec < 0.0):
+				print('attn cannot be < 0, set to be = 0')
+			pow_tmp = runner.run([dict(settings=[(Vaunix_Att_device.attn, max(attn, 0.0))]) for attn in attn_vec])
+			pow_vec_0 = np.array([power[0][0] for power in pow_tmp])
+			pow_vec_1 = np.array([power[1][0] for power in pow_tmp])
 
 			if display_plots:
 
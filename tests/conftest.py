@@ -0,0 +1,6 @@
+# The rfSoC modules sit at the root of the repository, next to the drivers.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,189 @@
+# Generates the packet captures used by tests/test_rfSoC_acquisition.py.
+# The acquisitions are run against an emulated instrument through
+# rfSoC_acquisition.CaptureRecorder, so the files hold exactly the answers
+# to OUTPUT:DATA? that the acquisition consumed, in the instrument's packet
+# format. Captures recorded on the instrument (CaptureRecorder around an
+# rfSoC.RFSoC) can be added next to them with the same meta data.
+#
+#	python tests/data/make_captures.py
+
+
+
+
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import rfSoC_acquisition as rfa
+
+
+LOCATION = os.path.dirname(os.path.abspath(__file__))
+
+
+
+class EmulatedInstrument:
+	'''
+	Sends the packets of runs[k] after the k-th SEQ:START, then empty
+	packets. SEQ:STOP drops what is left of the run.
+	'''
+
+	def __init__(self, runs):
+
+		self.runs = [list(run) for run in runs]
+		self.packets = []
+
+	def write(self, cmd):
+
+		if cmd == 'SEQ:START':
+			self.packets = self.runs.pop(0)
+		elif cmd == 'SEQ:STOP':
+			self.packets = []
+
+	def ask(self, cmd):
+
+		return self.packets.pop(0) if len(self.packets)>0 else rfa.EMPTY_PACKETS[0]
+
+
+def IQ_event(ch, num_points, I, Q):
+
+	header = np.zeros(8, dtype=np.int16)
+	header[0] = ch
+	header[1:3] = np.array([num_points], dtype=np.int32).view(np.int16)
+	payload = np.array([I, Q], dtype=np.int64).view(np.int16)
+
+	return [int(w) for w in np.concatenate((header, payload))]
+
+
+def RAW_event(ch, samples):
+
+	header = np.zeros(8, dtype=np.int16)
+	header[0] = ch
+	header[1:3] = np.array([len(samples)], dtype=np.int32).view(np.int16)
+
+	return [int(w) for w in np.concatenate((header, np.asarray(samples, dtype=np.int16) << 4))]
+
+
+def split(words, sizes):
+	'''
+	Packets of the given sizes (cycled), not aligned with the events.
+	'''
+
+	packets = []
+	k = 0
+	while k < len(words):
+		size = sizes[len(packets) % len(sizes)]
+		packets.append(words[k:k+size])
+		k += size
+
+	return packets
+
+
+def IQ_capture(rng, n_rep, n_pulses, channels):
+	'''
+	Words of n_rep repetitions of n_pulses accumulated events on each
+	channel (or n_pulses[k] on channels[k]), and the expected I and Q in
+	volts per channel.
+	'''
+
+	num_points = 100
+	n_pulses = np.broadcast_to(n_pulses, len(channels))
+	values = rng.integers(-2000, 2000, size=(2, n_rep, max(n_pulses), len(channels)))
+
+	words = []
+	for rep in range(n_rep):
+		for pulse in range(max(n_pulses)):
+			for k, ch in enumerate(channels):
+				if pulse < n_pulses[k]:
+					I, Q = values[:, rep, pulse, k]
+					words += IQ_event(ch, num_points, 16*num_points*int(I), 16*num_points*int(Q))
+
+	expected_I = {ch: (values[0,:,:n_pulses[k],k].T*rfa.ADC_SCALE).tolist() for k, ch in enumerate(channels)}
+	expected_Q = {ch: (values[1,:,:n_pulses[k],k].T*rfa.ADC_SCALE).tolist() for k, ch in enumerate(channels)}
+
+	return words, expected_I, expected_Q
+
+
+def RAW_capture(rng, n_rep, lengths):
+	'''
+	Words of n_rep repetitions of one raw event per channel (lengths
+	{channel: points}) and the expected traces averaged over the
+	repetitions.
+	'''
+
+	samples = {ch: rng.integers(-2000, 2000, size=(n_rep, n)) for ch, n in lengths.items()}
+
+	words = []
+	for rep in range(n_rep):
+		for ch in lengths:
+			words += RAW_event(ch, samples[ch][rep])
+
+	expected = {ch: (samples[ch].mean(axis=0)*rfa.ADC_SCALE).tolist() for ch in lengths}
+
+	return words, expected
+
+
+def record(name, runs, acquire, **meta):
+
+	recorder = rfa.CaptureRecorder(EmulatedInstrument(runs))
+	acquire(recorder)
+	recorder.save(os.path.join(LOCATION, name + '.json'), **meta)
+
+
+
+if __name__=="__main__":
+
+	time.sleep = lambda t: None
+	rng = np.random.default_rng(2024)
+	empty = rfa.EMPTY_PACKETS
+
+	# IQ: 2 channels, 2 pulses each
+	n_rep, n_pulses, channels = 5, 2, [1, 3]
+	ch_vec = [ch for pulse in range(n_pulses) for ch in channels]
+	ch_active = [1 if ch in channels else 0 for ch in range(1, 9)]
+	length_vec = [[1.]*n_pulses if ch in channels else [] for ch in range(1, 9)]
+	IQ_meta = dict(mode='IQ', n_rep=n_rep, length_vec=length_vec, ch_vec=ch_vec, ch_active=ch_active)
+	acquire = lambda instrument: rfa.acquire_IQ(instrument, n_rep, length_vec, ch_vec, ch_active)
+
+	# packets cut inside events and repetitions, an empty packet in between
+	words, I, Q = IQ_capture(rng, n_rep, n_pulses, channels)
+	packets = split(words, [37, 70, 13])
+	record('iq_split_packets', [packets[:3] + [empty[1]] + packets[3:]], acquire, expected_I=I, expected_Q=Q, restarts=0, **IQ_meta)
+
+	# error in the middle of the acquisition, restarted from the beginning
+	words, I, Q = IQ_capture(rng, n_rep, n_pulses, channels)
+	packets = split(words, [48])
+	record('iq_error_restart', [packets[:2] + ['ERR'], packets], acquire, expected_I=I, expected_Q=Q, restarts=1, **IQ_meta)
+
+	# the instrument stops sending data: restarted after 20 empty packets
+	words, I, Q = IQ_capture(rng, n_rep, n_pulses, channels)
+	packets = split(words, [64])
+	record('iq_idle_timeout', [packets[:3], packets], acquire, expected_I=I, expected_Q=Q, restarts=1, **IQ_meta)
+
+	# RAW: 16 points on channel 1 and 24 on channel 2 per repetition, end of data after 10 empty packets
+	n_rep, lengths = 4, {1: 16, 2: 24}
+	length_vec = [[lengths[ch]] if ch in lengths else [] for ch in range(1, 9)]
+	RAW_meta = dict(mode='RAW', n_rep=n_rep, length_vec=length_vec)
+	acquire = lambda instrument: rfa.acquire_RAW(instrument, n_rep, length_vec)
+
+	words, expected = RAW_capture(rng, n_rep, lengths)
+	record('raw_split_packets', [split(words, [21, 50])], acquire, expected_I=expected, restarts=0, **RAW_meta)
+
+	# error after some data: the data received is dropped and the sequence restarted
+	words, expected = RAW_capture(rng, n_rep, lengths)
+	packets = split(words, [40])
+	record('raw_error_restart', [packets[:2] + ['ERR'], packets], acquire, expected_I=expected, restarts=1, **RAW_meta)
+
+	# IQ: no readout on channel 1, 3 pulses on channel 2 and 1 on channel 4
+	n_rep, n_pulses, channels = 6, [3, 1], [2, 4]
+	ch_vec = [1, 3, 1, 1]
+	ch_active = [1 if ch in channels else 0 for ch in range(1, 9)]
+	length_vec = [[1.]*n_pulses[channels.index(ch)] if ch in channels else [] for ch in range(1, 9)]
+	uneven_meta = dict(mode='IQ', n_rep=n_rep, length_vec=length_vec, ch_vec=ch_vec, ch_active=ch_active)
+	acquire = lambda instrument: rfa.acquire_IQ(instrument, n_rep, length_vec, ch_vec, ch_active)
+
+	words, I, Q = IQ_capture(rng, n_rep, n_pulses, channels)
+	record('iq_uneven_channels', [split(words, [48])], acquire, expected_I=I, expected_Q=Q, restarts=0, **uneven_meta)
@@ -0,0 +1,190 @@
+import os
+import numpy as np
+import pytest
+
+qc = pytest.importorskip('qcodes')
+pytest.importorskip('pyvisa_sim')
+pytest.importorskip('progress_barV2')
+
+from qcodes.instrument.parameter import Parameter
+
+import rfSoC
+import rfSoC_acquisition as rfa
+import rfSoC_dsp as rfd
+import rfSoC_emulator as rfe
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture
+def rfsoc(monkeypatch):
+
+	monkeypatch.setattr(rfa.time, 'sleep', lambda t: None)
+
+	instrument = rfSoC.RFSoC('rfsoc_test', 'TCPIP::rfsoc::INSTR', visalib=os.path.join(DATA, 'rfsoc_sim.yaml') + '@sim')
+	instrument.display_IQ_progress = False
+	instrument.acquisition_mode('IQ')
+
+	yield instrument
+
+	instrument.close()
+
+
+def replay(instrument, name):
+	'''
+	Acquisitions of instrument answered with the capture name, as if its
+	program had been uploaded.
+	'''
+
+	capture, meta = rfa.CaptureReplay.load(os.path.join(DATA, name + '.json'))
+	# reset_output_data reads a packet before the sequence starts
+	capture.packets.insert(0, rfa.EMPTY_PACKETS[0])
+	instrument.write = capture.write
+	instrument.ask = capture.ask
+
+	instrument.n_rep(meta['n_rep'])
+	instrument.length_vec = meta['length_vec']
+	instrument.ch_vec = meta['ch_vec']
+	instrument.ADC_ch_active = np.array(meta['ch_active'])
+
+	return meta
+
+
+@pytest.fixture
+def measurement(tmp_path):
+
+	qc.initialise_or_create_database_at(str(tmp_path / 'shots.db'))
+	qc.load_or_create_experiment('shots', sample_name='replay')
+	flux = Parameter('flux', set_cmd=None)
+	meas = qc.Measurement()
+	meas.register_parameter(flux)
+
+	return meas, flux
+
+
+def test_pulse_count_per_channel(rfsoc):
+
+	replay(rfsoc, 'iq_uneven_channels')
+
+	assert [rfsoc.n_pulses(ch) for ch in (1, 2, 4)] == [0, 3, 1]
+	assert np.array_equal(rfsoc.ADC2.pulse_index(), np.arange(3))
+	assert np.array_equal(rfsoc.ADC4.rep_index(), np.arange(6))
+	rfsoc.ADC2.I_shots.validate_consistent_shape()
+
+
+def test_write_shots_numeric(rfsoc, measurement):
+
+	meta = replay(rfsoc, 'iq_uneven_channels')
+	meas, flux = measurement
+	rfsoc.register_shots(meas, channels=(2, 4), setpoints=(flux,))
+
+	with meas.run() as datasaver:
+		n_out = rfsoc.write_shots(datasaver, channels=(2, 4), chunk_size=4, setpoint_values=[(flux, 0.5)])
+
+	assert n_out == meta['n_rep']
+	# one row per shot
+	data = datasaver.dataset.get_parameter_data()
+	for ch in (2, 4):
+		adc = 'rfsoc_test_ADC{}_'.format(ch)
+		for quadrature in ['I', 'Q']:
+			shots = data[adc + quadrature + '_shots']
+			expected = np.array(meta['expected_' + quadrature][str(ch)])
+			pulse = shots[adc + 'pulse_index'].astype(int)
+			rep = shots[adc + 'rep_index'].astype(int)
+			assert len(shots[adc + quadrature + '_shots']) == expected.size
+			assert np.allclose(shots[adc + quadrature + '_shots'], expected[pulse, rep])
+			assert np.array_equal(np.sort(pulse*meta['n_rep'] + rep), np.arange(expected.size))
+			assert np.all(shots['flux'] == 0.5)
+	# back to all the repetitions once written
+	assert np.array_equal(rfsoc.shot_reps(), np.arange(meta['n_rep']))
+
+
+def test_write_shots_array_holds_blocks(rfsoc, measurement):
+
+	meta = replay(rfsoc, 'iq_uneven_channels')
+	meas, flux = measurement
+	rfsoc.register_shots(meas, channels=(2,), setpoints=(flux,), paramtype='array')
+
+	with meas.run() as datasaver:
+		rfsoc.write_shots(datasaver, channels=(2,), chunk_size=2, setpoint_values=[(flux, 0.5)])
+
+	# one row per block of chunk_size repetitions
+	shots = datasaver.dataset.get_parameter_data()['rfsoc_test_ADC2_I_shots']
+	blocks = shots['rfsoc_test_ADC2_I_shots']
+	assert np.shape(blocks) == (3, 3, 2)
+	assert np.allclose(np.concatenate(list(blocks), axis=1), meta['expected_I']['2'])
+	assert np.array_equal(shots['rfsoc_test_ADC2_rep_index'][:,0], [[0, 1], [2, 3], [4, 5]])
+	assert np.array_equal(shots['rfsoc_test_ADC2_pulse_index'][:,:,0], [np.arange(3)]*3)
+
+
+class ChunkedInstrument:
+	'''
+	Sends, after each SEQ:START, as many repetitions of reps (lists of
+	words) as the loop count of the last SEQ command, in one packet.
+	'''
+
+	def __init__(self, reps):
+
+		self.reps = list(reps)
+		self.packets = []
+		self.writes = []
+		self.n_rep = 0
+
+	def write(self, cmd):
+
+		self.writes.append(cmd)
+		if cmd.startswith('SEQ '):
+			start, commands = rfe.parse_sequence(cmd)
+			self.n_rep = commands[commands[:,0] == rfe.OP_LOOP][0,1] + 1
+		elif cmd == 'SEQ:START':
+			self.packets = [sum(self.reps[:self.n_rep], [])]
+			del self.reps[:self.n_rep]
+		elif cmd == 'SEQ:STOP':
+			self.packets = []
+
+	def ask(self, cmd):
+
+		return self.packets.pop(0) if len(self.packets)>0 else rfa.EMPTY_PACKETS[0]
+
+
+def test_chunked_covariance(rfsoc):
+
+	replay(rfsoc, 'iq_uneven_channels')
+	capture, meta = rfa.CaptureReplay.load(os.path.join(DATA, 'iq_uneven_channels.json'))
+	words = [w for packet in capture.packets if not rfa.is_empty(packet) for w in packet]
+	rep_words = rfa.IQ_EVENT_WORDS*len(meta['ch_vec'])
+	instrument = ChunkedInstrument([words[k:k+rep_words] for k in range(0, len(words), rep_words)])
+	rfsoc.write = instrument.write
+	rfsoc.ask = instrument.ask
+
+	# a loop of 6 repetitions
+	rfsoc.sequence_str = 'SEQ 0,257,5,1,100,513,0'
+	rfsoc.chunk_acquisition = True
+	rfsoc.first_chunk_rep = 2
+	rfsoc.max_chunk_rep = 2
+
+	moments = rfsoc.get_covariance(channels=(2,))
+
+	expected = rfd.CovarianceAccumulator([2], 3)
+	I = [np.zeros((0, 0))] + [np.array(meta['expected_I']['2'])]
+	Q = [np.zeros((0, 0))] + [np.array(meta['expected_Q']['2'])]
+	expected.update(I, Q)
+	assert moments.n_shots == meta['n_rep'] and rfsoc.chunk_planner.n_chunks == 3
+	assert np.allclose(moments.covariance(), expected.covariance())
+	assert instrument.writes[-1] == rfsoc.sequence_str
+
+
+def test_chunked_acquisition_needs_a_program(rfsoc):
+
+	replay(rfsoc, 'iq_uneven_channels')
+	writes = []
+	rfsoc.write = writes.append
+	rfsoc.chunk_acquisition = True
+	rfsoc.first_chunk_rep = 2
+
+	with pytest.raises(ValueError, match='upload_program'):
+		rfsoc.get_covariance(channels=(2,))
+	with pytest.raises(ValueError, match='upload_program'):
+		rfsoc.get_readout_pulse()
+	assert writes == []
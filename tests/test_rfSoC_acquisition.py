@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import pytest
+
+import rfSoC_acquisition as rfa
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+IQ_CAPTURES = ['iq_split_packets', 'iq_error_restart', 'iq_idle_timeout', 'iq_uneven_channels']
+RAW_CAPTURES = ['raw_split_packets', 'raw_error_restart']
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+
+	monkeypatch.setattr(rfa.time, 'sleep', lambda t: None)
+
+
+def load(name):
+
+	return rfa.CaptureReplay.load(os.path.join(DATA, name + '.json'))
+
+
+@pytest.mark.parametrize('name', IQ_CAPTURES)
+def test_IQ_capture(name):
+
+	instrument, meta = load(name)
+	stats = {}
+
+	I, Q = rfa.acquire_IQ(instrument, meta['n_rep'], meta['length_vec'], meta['ch_vec'], meta['ch_active'], stats=stats)
+
+	for ch in range(1, 9):
+		if str(ch) in meta['expected_I']:
+			assert np.allclose(I[ch-1], meta['expected_I'][str(ch)])
+			assert np.allclose(Q[ch-1], meta['expected_Q'][str(ch)])
+		else:
+			assert I[ch-1].size == 0
+	assert stats.get('restarts', 0) == meta['restarts']
+	assert instrument.writes[-1] == 'SEQ:STOP'
+	assert instrument.packets == []
+
+
+@pytest.mark.parametrize('name', IQ_CAPTURES)
+def test_IQ_capture_streamed(name):
+
+	instrument, meta = load(name)
+	blocks = []
+
+	n_rep = rfa.acquire_IQ_stream(instrument, meta['n_rep'], meta['length_vec'], meta['ch_vec'], meta['ch_active'],
+								  lambda I, Q: blocks.append((I, Q)), blocks.clear)
+
+	assert n_rep == meta['n_rep']
+	for ch in meta['expected_I']:
+		I = np.concatenate([block[0][int(ch)-1] for block in blocks], axis=1)
+		assert np.allclose(I, meta['expected_I'][ch])
+
+
+def test_IQ_split_packets_are_not_aligned_with_events():
+
+	instrument, meta = load('iq_split_packets')
+
+	lengths = [len(packet) for packet in instrument.packets if not rfa.is_empty(packet)]
+	assert any(n % rfa.IQ_EVENT_WORDS != 0 for n in lengths)
+	assert any(rfa.is_empty(packet) for packet in instrument.packets)
+
+
+def test_IQ_idle_timeout_restarts():
+
+	instrument, meta = load('iq_idle_timeout')
+	stats = {}
+
+	rfa.acquire_IQ(instrument, meta['n_rep'], meta['length_vec'], meta['ch_vec'], meta['ch_active'], stats=stats, empty_limit=20)
+
+	assert stats['restarts'] == 1
+	assert instrument.writes.count('SEQ:START') == 2
+
+
+@pytest.mark.parametrize('name', RAW_CAPTURES)
+def test_RAW_capture(name):
+
+	instrument, meta = load(name)
+	stats = {}
+
+	I, Q = rfa.acquire_RAW(instrument, meta['n_rep'], meta['length_vec'], stats=stats)
+
+	for ch, trace in meta['expected_I'].items():
+		assert np.allclose(I[int(ch)-1][0], trace)
+	assert stats.get('restarts', 0) == meta['restarts']
+
+
+@pytest.mark.parametrize('name', RAW_CAPTURES)
+def test_RAW_capture_streamed(name):
+
+	instrument, meta = load(name)
+	traces = {}
+
+	def on_pulse(ch, pulse, trace):
+		traces.setdefault(ch, []).append(trace)
+
+	def on_clear():
+		assembler.clear()
+		traces.clear()
+
+	assembler = rfa.PulseAssembler(meta['length_vec'], on_pulse)
+	rfa.acquire_RAW_stream(instrument, meta['n_rep'], meta['length_vec'], lambda ch, I, Q: assembler.add(ch, I), on_clear)
+
+	for ch, trace in meta['expected_I'].items():
+		assert len(traces[int(ch)]) == meta['n_rep']
+		assert np.allclose(np.mean(traces[int(ch)], axis=0), trace)
+
+
+def test_recorder_replay_round_trip(tmp_path):
+
+	instrument, meta = load('iq_split_packets')
+	packets = list(instrument.packets)
+
+	recorder = rfa.CaptureRecorder(instrument)
+	rfa.acquire_IQ(recorder, meta['n_rep'], meta['length_vec'], meta['ch_vec'], meta['ch_active'])
+	recorder.save(str(tmp_path/'capture.json'), n_rep=meta['n_rep'])
+
+	replay, saved_meta = rfa.CaptureReplay.load(str(tmp_path/'capture.json'))
+	assert saved_meta == dict(n_rep=meta['n_rep'])
+	assert replay.packets[:len(packets)] == packets
+
+
+def continuous_packets(ch, samples, size=100):
+	'''
+	Packets of continuous mode events (mixer on: I and Q interleaved) of
+	the given samples, cut every size words.
+	'''
+
+	words = []
+	for event in samples:
+		header = np.zeros(8, dtype=np.int16)
+		header[0] = ch + 256*0x23
+		header[3] = len(event)
+		words += [int(w) for w in np.concatenate((header, np.asarray(event, dtype=np.int16)*16))]
+
+	return [words[k:k+size] for k in range(0, len(words), size)]
+
+
+def test_continuous_error_drops_pending_points():
+
+	before = continuous_packets(2, [np.full(40, 7)])
+	after = continuous_packets(2, [np.arange(64) + 64*k for k in range(4)])
+	# recover drains the instrument until an empty packet
+	instrument = rfa.CaptureReplay(before + ['ERR', rfa.EMPTY_PACKETS[0]] + after)
+
+	with rfa.ContinuousStream(instrument, chunk_size=50, policy='block') as stream:
+		chunks = []
+		for ch, I, Q in stream:
+			chunks.append(I)
+			if len(chunks) == 2:
+				break
+
+	assert np.allclose(np.concatenate(chunks), np.arange(0, 200, 2)*rfa.ADC_SCALE)
+	assert instrument.writes == ['SEQ:START', 'SEQ:STOP', 'SEQ:START', 'SEQ:STOP']
+
+
+def test_continuous_stream_in_chunks():
+
+	# mixer on: events split over packets, streamed in chunks
+	instrument = rfa.CaptureReplay(continuous_packets(2, [np.arange(64)]*8))
+
+	with rfa.ContinuousStream(instrument, chunk_size=50, policy='block') as stream:
+		chunks = []
+		for ch, I, Q in stream:
+			chunks.append(I)
+			if len(chunks) == 5:
+				break
+
+	assert ch == 2 and np.allclose(np.concatenate(chunks)[:32], np.arange(0, 64, 2)*rfa.ADC_SCALE)
+	assert instrument.writes == ['SEQ:START', 'SEQ:STOP']
+
+
+def test_shot_chunker_writes_each_repetition_once():
+
+	chunks = []
+	chunker = rfa.ShotChunker(2, lambda first, I, Q: chunks.append((first, I[1][0].tolist())))
+	block = lambda reps: ([[]] + [np.array([reps])] + [[]]*6, [[]]*8)
+
+	# restart after 3 repetitions
+	chunker.update(*block([0, 1, 2]))
+	chunker.clear()
+	for reps in ([0], [1, 2, 3], [4]):
+		chunker.update(*block(reps))
+	chunker.flush()
+
+	assert chunks == [(0, [0, 1]), (2, [2, 3]), (4, [4])]
+
+
+def test_chunks_merged_into_statistics():
+
+	shots = np.random.default_rng(0).normal(size=(2, 1, 1000))
+	merger = rfa.make_merger('statistics', 1000)
+	planner = rfa.ChunkPlanner(1000, first_chunk=100, target_time=1.)
+	while not planner.done:
+		chunk = planner.next_chunk()
+		part = shots[:,:,planner.n_done:planner.n_done+chunk]
+		merger.update([part[0]]+[np.zeros((1,0))]*7, [part[1]]+[np.zeros((1,0))]*7, chunk)
+		planner.update(chunk, chunk/300.)
+
+	assert np.allclose(merger.result()['I_std'][0], shots[0].std(ddof=1))
+	assert planner.n_chunks == 5
@@ -0,0 +1,41 @@
+import numpy as np
+
+from rfSoC_calibration import IQBalanceOptimizer, CancellationOptimizer
+
+
+def test_IQ_balance_and_LO_leakage():
+
+	rng = np.random.default_rng(0)
+
+	# mixer with 7 degrees and 8 % of imbalance and an LO leakage nulled at (3.1, -4.2) mV
+	def measure(point):
+		z = 1 - point['amp_ratio']/1.08*np.exp(1j*np.radians(point['phase'] - 97.))
+		image = 1e-3*abs(z)**2 + 1e-9
+		leakage = 1e-6*((point['dc_offset_I']-3.1)**2 + 1.3*(point['dc_offset_Q']+4.2)**2) + 1e-9
+		return image*(1 + 0.01*rng.normal()), leakage*(1 + 0.01*rng.normal())
+
+	optimizer = IQBalanceOptimizer(phase=90., dc_offset_I=8., dc_offset_Q=6., dc_step=3.)
+	optimum = optimizer.run(measure)
+
+	assert len(optimizer.points) == 8
+	assert abs(optimum['phase'] - 97.) < 0.5 and abs(optimum['amp_ratio'] - 1.08) < 0.01
+	assert abs(optimum['dc_offset_I'] - 3.1) < 0.2 and abs(optimum['dc_offset_Q'] + 4.2) < 0.2
+	assert measure(optimum)[0] < 1e-3*abs(1 - np.exp(0.5j*np.pi/180))**2*4
+
+
+def test_pump_cancellation_on_quantized_instruments():
+
+	rng = np.random.default_rng(0)
+
+	# pump cancelled through a 0.05 dB attenuator and a 1 degree phase shifter
+	def residual(point):
+		z = 0.8*np.exp(1j*np.radians(40)) + 10**(-point['amplitude']/20)*np.exp(1j*np.radians(point['phase']))
+		return (abs(z)**2 + 1e-7)*(1 + 0.01*rng.normal())
+
+	optimizer = CancellationOptimizer(phase=180., amplitude=25., amplitude_range=(0, 50), amplitude_step=10.,
+									  to_linear=lambda attn: 10**(-attn/20), from_linear=lambda a: -20*np.log10(a),
+									  amplitude_quantum=0.05, phase_quantum=1.)
+	optimum = optimizer.run(residual)
+
+	assert len(optimizer.points) <= 12 and optimum['phase'] == 220. and abs(optimum['amplitude'] - 1.94) < 0.051
+	assert residual(optimum) < 1e-3*0.8**2
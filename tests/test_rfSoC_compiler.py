@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+import rfSoC_compiler as rfc
+
+
+SETTINGS = dict(n_rep=10, acquisition_mode='IQ', freq_sync=1e6, sampling_rate=2e9, FPGA_clock=250e6,
+				DAC_amplitude_calib=[1.08]*8, DAC_memory_rows=16384, link_throughput=None,
+				output_FIFO_size=None, decimation=[1]*8)
+
+
+def sin_pulse(label, start, length, amp, channel=1):
+
+	return dict(label=label, module='DAC', channel=channel, mode='sin', start=start, length=length,
+				param={'amp':amp,'freq':50,'dc_offset':0,'phase_offset':0}, parent=None)
+
+
+def record(start, length):
+
+	return dict(label='record', module='ADC', channel=1, mode='raw', start=start, length=length, param=None, parent=None)
+
+
+def block_data(program, label):
+
+	ch, addr, n_rows = program.DAC_blocks[label]
+
+	return program.DAC_data[ch][addr*11:(addr+n_rows)*11]
+
+
+def test_sweep_of_two_pulses_with_identical_base_waveforms():
+
+	pulses = pd.DataFrame([sin_pulse('P1', 0, 1, 0.1), sin_pulse('P2', 2, 1, 0.1), record(0.5, 2)])
+	sweep = {('P1','amp'): [0.1, 0.2], ('P2','amp'): [0.3, 0.4]}
+
+	programs = rfc.compile_sweep(pulses, sweep, SETTINGS)
+
+	assert programs[0].DAC_blocks['P1'][:2] != programs[0].DAC_blocks['P2'][:2]
+
+	for k, program in enumerate(programs):
+		for label in ['P1', 'P2']:
+			param = dict(sin_pulse(label, 0, 1, sweep[(label,'amp')][k])['param'])
+			expected = rfc.pulse_gen_SCPI('sin', param, 1, 1, SETTINGS).astype(int)
+			assert np.array_equal(block_data(program, label), expected)
+
+
+def test_batched_sweep_budget_from_uncompressed_swept_pulse():
+
+	# amp=0 compresses to a single row, the other points need one row per 8 samples
+	pulses = pd.DataFrame([sin_pulse('P1', 0, 10, 0.), record(0.5, 2)])
+	amps = np.linspace(0, 0.5, 20)
+
+	batches = rfc.compile_batched_sweep(pulses, {('P1','amp'): amps}, SETTINGS)
+
+	assert len(batches) > 1
+	assert sorted(point for batch in batches for point in batch['points']) == list(range(20))
+	for batch in batches:
+		assert all(len(data)//11 <= SETTINGS['DAC_memory_rows']-1 for data in batch['program'].DAC_data.values())
+
+
+def test_batched_sweep_of_start_and_length():
+
+	import rfSoC_emulator as rfe
+
+	# record 0.2 us after the end of P1, whose start and length are swept
+	record_P1 = dict(record(0.2, 0.5), parent='P1')
+	pulses = pd.DataFrame([sin_pulse('P1', 0.5, 1, 0.2), record_P1])
+	starts, lengths = [0.5, 1.5, 2.5], [1, 2, 3]
+
+	batch, = rfc.compile_batched_sweep(pulses, {('P1','start'): starts, ('P1','length'): lengths}, SETTINGS)
+	program = batch['program']
+	report = rfe.SequencerEmulator().run_program(program)
+	assert report['warnings'] == []
+
+	# the longest point lasts 2.5+3+0.2+0.5 us: blocks of 7 us at freq_sync 1 MHz
+	block = 7*250
+	DAC = report['DAC_activity'][1]
+	ADC = report['ADC_activity'][1]
+	assert len(DAC) == len(ADC) == 3
+
+	for k in range(3):
+
+		start, stop, addr = DAC[k]
+		assert addr == program.DAC_blocks['P1#{}'.format(k)][1]
+		assert abs((stop-start) - lengths[k]*250) <= 2
+		assert abs((start-DAC[0][0]) - ((starts[k]-starts[0])*250 + k*block)) <= 10
+		assert abs(ADC[k][0] - (stop + 0.2*250)) <= 3
+		if k+1 < 3:
+			assert ADC[k][1] < DAC[k+1][0]
+
+	assert len(set(program.DAC_blocks['P1#{}'.format(k)][1] for k in range(3))) == 3
+
+	# one ADC event per point
+	I = [np.arange(3).reshape(3, 1)] + [[]]*7
+	data = rfc.demux_batch(I, I, batch)
+	assert [point[0][0].tolist() for point in data] == [[[0]], [[1]], [[2]]]
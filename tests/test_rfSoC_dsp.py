@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+from rfSoC_dsp import (WelchPSD, DDCBank, lowpass_taps, ThresholdDiscriminator, GaussianMixtureDiscriminator,
+					   ShotCounter, CovarianceAccumulator)
+
+
+FS = 2e9
+
+
+def test_white_noise_PSD_over_blocks():
+
+	# white noise of variance sigma^2: 2 sigma^2/fs on the one-sided spectrum
+	sigma = 1e-3
+	noise = np.random.default_rng(0).normal(0, sigma, 2**20)
+	welch = WelchPSD(1024, 'hann', 0.5, FS)
+	for block in np.split(noise, 64):
+		welch.update(block, contiguous=True)
+
+	assert welch.n_segments == 2*len(noise)//1024 - 1
+	assert abs(np.mean(welch.psd()[1:-1])/(2*sigma**2/FS) - 1) < 0.02
+
+
+def test_tone_lands_in_its_bin():
+
+	t = np.arange(2**16)/FS
+	welch = WelchPSD(2048, 'blackman', 0.75, FS)
+	welch.update(np.sin(2*np.pi*100e6*t))
+
+	assert abs(welch.frequencies[np.argmax(welch.psd())] - 100e6) <= FS/2048
+
+
+@pytest.fixture
+def two_tones():
+
+	t = np.arange(2**16)/FS
+
+	return 0.2*np.cos(2*np.pi*250e6*t + 0.3) + 0.05*np.cos(2*np.pi*-30e6*t - 1.) + np.random.default_rng(0).normal(0, 1e-3, len(t))
+
+
+def test_tones_demodulated_at_once(two_tones):
+
+	# a third frequency absent
+	ddc = DDCBank([250e6, 30e6, 100e6], FS)
+
+	assert np.allclose(ddc.demodulate(two_tones), [0.2*np.exp(0.3j), 0.05*np.exp(1j), 0], atol=1e-3)
+
+
+def test_decimated_demodulation(two_tones):
+
+	ddc = DDCBank([250e6], FS, decimation=64, taps=lowpass_taps(128, 20e6, FS))
+	z = ddc.demodulate(two_tones)
+
+	assert z.shape == (1, (len(two_tones)-128)//64 + 1)
+	assert np.allclose(z, 0.2*np.exp(0.3j), atol=1e-2)
+
+
+@pytest.fixture
+def two_level_shots():
+	'''
+	Two channels, two pulses, pulse 0 of channel 1 and pulse 1 of channel 3
+	always in the same state.
+	'''
+
+	rng = np.random.default_rng(0)
+	blobs = np.array([0.01+0.j, 0.01+0.02j])
+	labels = rng.integers(0, 2, size=(2, 2, 20000))
+	labels[1,1] = labels[0,0]
+	noise = rng.normal(0, 3e-3, (2, 2, 20000)) + 1j*rng.normal(0, 3e-3, (2, 2, 20000))
+	calibration = [blobs[0] + noise[0,0,:5000], blobs[1] + noise[0,1,:5000]]
+
+	return blobs[labels] + noise, labels, calibration
+
+
+@pytest.mark.parametrize('fit', [ThresholdDiscriminator.fit, GaussianMixtureDiscriminator.fit,
+								 lambda calibration: GaussianMixtureDiscriminator.fit_mixture(np.concatenate(calibration))])
+def test_discriminators(two_level_shots, fit):
+
+	shots, labels, calibration = two_level_shots
+	disc = fit(calibration)
+
+	assert np.mean(disc.classify(np.real(shots), np.imag(shots)) == labels) > 0.99
+
+
+def test_populations_and_joint_outcomes(two_level_shots):
+
+	shots, labels, calibration = two_level_shots
+	disc = GaussianMixtureDiscriminator.fit_mixture(np.concatenate(calibration))
+	counter = ShotCounter({1: disc, 3: disc}, n_pulses=2)
+	I = [np.real(shots[0]), [], np.real(shots[1])]
+	Q = [np.imag(shots[0]), [], np.imag(shots[1])]
+	for block in range(4):
+		counter.update([i[:, 5000*block:5000*(block+1)] if len(i) else i for i in I], [q[:, 5000*block:5000*(block+1)] if len(q) else q for q in Q])
+
+	assert counter.n_shots == 20000 and counter.joint_counts.shape == (2, 2, 2, 2)
+	assert abs(counter.populations()[1][0,1] - np.mean(labels[0,0])) < 0.01
+	assert counter.joint_counts.sum(axis=(1, 2))[0,1] + counter.joint_counts.sum(axis=(1, 2))[1,0] < 0.01*20000
+
+
+def test_covariance_merged_over_blocks():
+
+	# two mode squeezed like shots
+	cov = np.array([[1, 0, .5, 0], [0, 1, 0, -.5], [.5, 0, 1, 0], [0, -.5, 0, 1]])*1e-6
+	shots = 0.01 + np.random.default_rng(0).multivariate_normal(np.zeros(4), cov, size=(2, 200000))
+	I = [shots[...,0], shots[...,2]]
+	Q = [shots[...,1], shots[...,3]]
+	moments = CovarianceAccumulator([1, 2], n_pulses=2, order=4)
+	for block in range(4):
+		part = moments.empty_like()
+		part.update([i[:, 50000*block:50000*(block+1)] for i in I], [q[:, 50000*block:50000*(block+1)] for q in Q])
+		moments.merge(part)
+
+	assert moments.n_shots == 200000
+	assert np.allclose(moments.covariance()[0], np.cov(shots[0].T), rtol=1e-9, atol=1e-15)
+	assert np.all(np.abs(moments.covariance() - cov) < 5*moments.covariance_error())
+	assert np.allclose(moments.covariance_error()[0,0,0], np.sqrt(2/200000)*1e-6, rtol=0.05)
+	assert np.max(np.abs(moments.cumulant(4))) < 0.05*1e-12 and np.max(np.abs(moments.cumulant(3))) < 0.02*1e-9
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import rfSoC_emulator as rfe
+
+
+def test_plan_repetition_min_cycles():
+
+	# short body of commands, pulses lasting 5000 cycles, sync every 25 cycles
+	plan = rfe.plan_repetition(270, [(260, 1, 2000)], 286331153, period_sync=25, link_throughput=50e6, min_cycles=5000)
+
+	assert plan['period_cycles'] >= 5000
+	assert plan['period_cycles'] % 25 == 0
+	assert plan['wait_arg'] == plan['period_cycles'] - 270 - 4
+
+
+def test_plan_repetition_link_limited():
+
+	plan = rfe.plan_repetition(100, [(90, 1, 20000)], 0, period_sync=25, link_throughput=50e6, min_cycles=200)
+
+	assert plan['limited_by'] == 'link'
+	assert plan['period_cycles'] % 25 == 0
+	assert plan['period_cycles'] >= plan['bytes_per_rep']*250e6/50e6
+
+
+def test_long_DAC_pulse_keeps_period_and_phase_lock():
+
+	pytest.importorskip('matplotlib')
+	import SequenceGeneration_v2 as sqg
+
+	seq = sqg.Sequence()
+	sqg.PulseGeneration(0., 20e-6, 'CH1', 'SIN', [10e6, .5, 0], sequence=seq)
+	sqg.PulseReadout(0., 1e-6, 'CH1', sequence=seq)
+
+	sequence_str = seq.generate_sequence_and_DAC_memory(10, 'SUM', 10e6, link_throughput=50e6)
+	report = rfe.SequencerEmulator().run(sequence_str)
+
+	# 20 us at 4 ns per cycle, multiple of the 10 MHz period (25 cycles)
+	assert report['period_cycles'] >= 5000
+	assert report['period_cycles'] % 25 == 0
+
+
+def test_clone_does_not_share_waveform_parameters():
+
+	pytest.importorskip('matplotlib')
+	import SequenceGeneration_v2 as sqg
+
+	seq = sqg.Sequence()
+	pulse = sqg.PulseGeneration(0., 1e-6, 'CH1', 'SIN', [10e6, .5, 0], sequence=seq)
+	sqg.PulseReadout(0., 1e-6, 'CH1', parent=pulse, sequence=seq)
+	sequence_str = seq.generate_sequence_and_DAC_memory(10, 'SUM', 10e6)
+
+	clone = seq.clone({pulse: {'params': [10e6, .25, 0]}})
+	copy = clone.DAC_pulses[0]
+
+	assert pulse.params == (10e6, .5, 0) and copy.params == (10e6, .25, 0)
+	assert seq.generate_sequence_and_DAC_memory(10, 'SUM', 10e6) == sequence_str
+	with pytest.raises(TypeError):
+		copy.params[1] = 0.
+
+	# assigning new parameters regenerates the DAC memory of the copy only
+	copy.params = [10e6, .5, 0]
+	assert clone.generate_sequence_and_DAC_memory(10, 'SUM', 10e6) == sequence_str
+
+
+def test_folded_CW_plays_the_unfolded_waveform():
+
+	pytest.importorskip('matplotlib')
+	import SequenceGeneration_v2 as sqg
+
+	# 12.5 MHz: 20 rows hold a whole number of periods instead of 2500
+	seq = sqg.Sequence()
+	cw = sqg.PulseGeneration(0., 10e-6, 'CH2', 'SIN', [12.5e6, .3, 30], CW_mode=True, sequence=seq)
+	cw2 = sqg.PulseGeneration(0., 2e-6, 'CH2', 'SIN', [25e6, .2, 0], CW_mode=True, parent=cw, sequence=seq)
+	sqg.PulseGeneration(0., 1e-6, 'CH2', 'SIN', [10e6, .5, 0], parent=cw2, sequence=seq)
+	sqg.PulseReadout(0., 1e-6, 'CH1', sequence=seq)
+	sequence_str = seq.generate_sequence_and_DAC_memory(10, 'SUM', 10e6)
+
+	values = [int(v) for v in cw._DAC_2D_memory.split(' ')[1].split(',')]
+	address, table = values[0], values[1:]
+	assert len(table) == 20*11
+	# the rows reserved at the end of the memory, one block per CW pulse,
+	# kept apart from the other pulses
+	address2 = int(cw2._DAC_2D_memory.split(' ')[1].split(',')[0])
+	assert address == 16384 - 20 and address2 == address - 10 == seq.DAC_memory.capacity[1]
+	assert seq.DAC_memory.rows[1] <= address2
+
+	# 10 us of CW: 2500 cycles of the 20 folded rows
+	played = rfe.DAC_samples(table, 2500)
+
+	N_point = int(round(cw.t_duration/0.5e-9))
+	offset, oscillation = sqg.DAC_WAVEFORMS['SIN'](np.array([[12.5e6, .3, 30]]), np.zeros(1), np.array([N_point*0.5e-9]),
+												  np.arange(N_point)*2*np.pi/N_point)
+	assert np.allclose(played, offset + oscillation[0], atol=1)
+	assert rfe.SequencerEmulator().run(sequence_str)['warnings'] == []
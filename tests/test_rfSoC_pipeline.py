@@ -0,0 +1,187 @@
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+
+import rfSoC_pipeline as rfp
+
+
+SETTINGS = dict(n_rep=10, acquisition_mode='IQ', freq_sync=1e6, sampling_rate=2e9, FPGA_clock=250e6,
+				DAC_amplitude_calib=[1.08]*8, DAC_memory_rows=16384, link_throughput=None,
+				output_FIFO_size=None, decimation=[1]*8)
+
+
+def pulses(amp):
+
+	return pd.DataFrame([dict(label='pump', module='DAC', channel=1, mode='sin', start=0, length=2,
+							  param={'amp':amp,'freq':271,'dc_offset':0,'phase_offset':0}, parent=None),
+						 dict(label='record', module='ADC', channel=1, mode='raw', start=0.5, length=1,
+							  param=None, parent=None)])
+
+
+class FakeClock:
+	'''
+	time of rfSoC_pipeline: perf_counter only moves when sleep is called,
+	the sleeps are recorded in events.
+	'''
+
+	def __init__(self, events):
+
+		self.events = events
+		self.now = 0.
+
+	def perf_counter(self):
+
+		return self.now
+
+	def sleep(self, t):
+
+		self.events.append(('sleep', t))
+		self.now += t
+
+
+class FakeInstrument:
+	'''
+	Parameter set by the runner. The instruments of a point share barrier,
+	which only lets them through if they are set at the same time.
+	'''
+
+	def __init__(self, events, name, barrier):
+
+		self.events = events
+		self.name = name
+		self.barrier = barrier
+		self.value = None
+
+	def __call__(self, value):
+
+		self.barrier.wait(timeout=5)
+		self.events.append(('set '+self.name, value))
+		self.value = value
+
+
+class FakeRFSoC:
+
+	debug_mode = False
+
+	def __init__(self, events, ping_pong, att):
+
+		self.events = events
+		self.DAC_ping_pong = ping_pong
+		self.att = att
+		self.pulses = None
+
+	def compile_settings(self):
+
+		return SETTINGS
+
+	def active_program_cache(self):
+
+		return None
+
+	def upload_program(self, program):
+
+		self.events.append(('upload', None))
+
+	def stage_program(self, program):
+
+		self.events.append(('stage', None))
+
+	def swap_program(self):
+
+		self.events.append(('swap', None))
+
+	def get_readout_pulse(self, while_running=None):
+
+		self.events.append(('acquire', self.att.value))
+		if while_running is not None:
+			while_running()
+		level = 1e-3*(1 + self.att.value)
+		self.events.append(('done', None))
+
+		return [[np.full(10, level)]] + [[]]*7, [[np.zeros(10)]] + [[]]*7
+
+
+@pytest.fixture
+def events(monkeypatch):
+
+	events = []
+	monkeypatch.setattr(rfp, 'time', FakeClock(events))
+
+	return events
+
+
+def run(events, ping_pong, points=4, settle=None):
+
+	barrier = threading.Barrier(2)
+	att = FakeInstrument(events, 'att', barrier)
+	fs = FakeInstrument(events, 'fs', barrier)
+	device = FakeRFSoC(events, ping_pong, att)
+	runner = rfp.CalibrationRunner(device, settle_time=0.02)
+
+	points = [dict(settings=[(att, a), (fs, 10*a)], pulses=pulses(0.1*(a+1))) for a in range(points)]
+	if settle is not None:
+		points[1]['settle'] = settle
+
+	return runner.run(points), device, points
+
+
+@pytest.mark.parametrize('ping_pong', [False, True])
+def test_results_in_order_of_the_points(events, ping_pong):
+
+	results, device, points = run(events, ping_pong)
+
+	assert np.allclose([r[0][0] for r in results], [10*np.log10(1e3*(1e-3*(1+a))**2/100) for a in range(4)])
+	assert device.pulses is points[-1]['pulses']
+	# each point acquired with its own settings
+	assert [value for name, value in events if name == 'acquire'] == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize('ping_pong', [False, True])
+def test_instruments_set_in_parallel_between_acquisitions(events, ping_pong):
+
+	run(events, ping_pong)
+
+	acquiring = False
+	pending = set()
+	for name, value in events:
+		if name == 'acquire':
+			# every instrument of the point is set, then the runner waits for them to settle
+			assert not acquiring and pending == set()
+			acquiring = True
+		elif name == 'done':
+			acquiring = False
+		elif name.startswith('set'):
+			assert not acquiring
+			pending.add(name)
+		elif name == 'sleep':
+			assert pending == {'set att', 'set fs'}
+			pending = set()
+
+
+def test_settle_time_of_each_point(events):
+
+	run(events, False, settle=0.5)
+
+	# the clock only moves when sleeping: each point waits its full settle time
+	assert [value for name, value in events if name == 'sleep'] == pytest.approx([0.02, 0.5, 0.02, 0.02])
+
+
+def test_ping_pong_stages_the_next_program_while_acquiring(events):
+
+	run(events, True)
+
+	staging = [name for name, value in events if name in ('upload', 'stage', 'swap', 'acquire', 'done')]
+	assert staging == ['upload', 'acquire', 'stage', 'done'] + ['swap', 'acquire', 'stage', 'done']*2 + ['swap', 'acquire', 'done']
+
+
+def test_without_ping_pong_each_program_is_uploaded(events):
+
+	run(events, False)
+
+	assert [name for name, value in events if name in ('upload', 'stage', 'swap')] == ['upload']*4
+
+
+def test_no_points(events):
+
+	assert rfp.CalibrationRunner(FakeRFSoC(events, True, None)).run([]) == []
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from rfSoC_store import ShotStore, encode_chunk, decode_chunk
+
+
+@pytest.mark.parametrize('data', [np.random.default_rng(0).normal(0, 1e-3, 1000),
+								  np.cumsum(np.random.default_rng(1).integers(-50, 50, 1000)),
+								  np.zeros(0)])
+def test_chunks_are_lossless(data):
+
+	assert np.array_equal(decode_chunk(encode_chunk(data), data.dtype, len(data)), data)
+
+
+def test_accumulated_integers_compress():
+
+	data = (np.cumsum(np.random.default_rng(0).integers(-100, 100, 100000))*16).astype(np.int64)
+
+	assert len(encode_chunk(data)) < 0.35*data.nbytes
+
+
+def test_shots_read_back_across_chunks(tmp_path):
+
+	location = str(tmp_path)
+	shots = np.random.default_rng(0).normal(0, 1e-3, (2, 2, 10000))
+	with ShotStore(location, chunk_reps=1500) as store:
+		for first in range(0, 10000, 700):
+			block = shots[:,:,first:first+700]
+			store.append([block[0], []] + [[]]*6, [block[1], []] + [[]]*6, point=3)
+
+	store = ShotStore(location)
+	I = store.shots(1, pulse=1, quadrature='I', point=3)
+
+	assert len(I) == 10000 and len(store.index[I.key]) == 7
+	assert np.array_equal(I[2900:3100], shots[0,1,2900:3100])
+	assert np.array_equal(np.asarray(store.shots(1, 0, 'Q', 3)), shots[1,0])
+	assert I[-1] == shots[0,1,-1] and np.array_equal(I[-1:-5:-2], shots[0,1,-1:-5:-2])
+	assert (3, 1, 0, 'Q') in store.keys()